@@ -0,0 +1,173 @@
+"""
+action_executor.py - Ejecución de acciones de reglas fuera del hilo de ingesta
+"""
+
+from __future__ import annotations
+import datetime as dt
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+# Log aparte para poder enviarlo a un fichero/handler propio
+deadletter_logger = logging.getLogger("rule_engine.deadletter")
+
+
+class ActionTimeout(Exception):
+    """La acción superó su tiempo máximo y ya no puede usar el controller."""
+
+
+@dataclass(frozen=True)
+class DeadLetter:
+    """Acción que no llegó a ejecutarse o que falló."""
+    rule: str
+    device_id: str
+    payload: str
+    reason: str          # queue_full | rule_busy | timeout | error
+    detail: str
+    at: dt.datetime
+
+
+class _DeadlineProxy:
+    """
+    Envuelve al controller: pasado el plazo, cualquier acceso lanza
+    ActionTimeout. Un hilo no se puede matar, pero así una acción que se
+    ha pasado de tiempo deja de publicar comandos.
+    """
+
+    def __init__(self, target: Any, deadline: float) -> None:
+        self._target = target
+        self._deadline = deadline
+
+    def __getattr__(self, name: str) -> Any:
+        if time.monotonic() > self._deadline:
+            raise ActionTimeout(f"plazo agotado al acceder a '{name}'")
+        return getattr(self._target, name)
+
+
+class ActionExecutor:
+    """
+    Pool acotado de hilos para las acciones de las reglas.
+
+    - Como mucho `queue_size` acciones pendientes o en curso; el resto se
+      rechaza a la cola de dead-letter en vez de acumularse.
+    - Como mucho `max_per_rule` ejecuciones simultáneas de la misma regla.
+    - Un hilo vigilante marca como timeout las que superan `timeout`.
+    """
+
+    def __init__(
+        self,
+        controller,
+        workers: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        max_per_rule: Optional[int] = None,
+    ) -> None:
+        self.controller = controller
+        self.queue_size = queue_size or config.RULE_ACTION_QUEUE_SIZE
+        self.timeout = timeout or config.RULE_ACTION_TIMEOUT
+        self.max_per_rule = max_per_rule or config.RULE_ACTION_MAX_PER_RULE
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers or config.RULE_ACTION_WORKERS,
+            thread_name_prefix="rule-action",
+        )
+        self._lock = threading.Condition()
+        self._pending = 0
+        self._per_rule: Dict[str, int] = {}
+        # id de ejecución -> (regla, evento, instante límite, ya avisado de timeout)
+        self._running: Dict[int, Tuple[str, Any, float, List[bool]]] = {}
+        self._seq = 0
+        self.dead_letters: Deque[DeadLetter] = deque(maxlen=config.RULE_DEADLETTER_SIZE)
+        self._closed = False
+        self._watchdog = threading.Thread(target=self._watch, name="rule-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def submit(self, rule: str, event, action: Callable[[Any], None]) -> bool:
+        """
+        Encola action(controller) para la regla `rule` disparada por `event`.
+        `rule` identifica la regla (también para el límite de concurrencia).
+        Devuelve False si se ha rechazado (queda en dead-letter).
+        """
+        with self._lock:
+            if self._closed:
+                # Al apagar, la ingesta aún vacía sus colas tras cerrar el motor
+                reason = "closed"
+            elif self._pending >= self.queue_size:
+                reason = "queue_full"
+            elif self._per_rule.get(rule, 0) >= self.max_per_rule:
+                reason = "rule_busy"
+            else:
+                reason = None
+                self._pending += 1
+                self._per_rule[rule] = self._per_rule.get(rule, 0) + 1
+                self._seq += 1
+                run_id = self._seq
+        if reason:
+            self._dead_letter(rule, event, reason, "acción descartada")
+            return False
+        self._pool.submit(self._run, run_id, rule, event, action)
+        return True
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que no quede ninguna acción pendiente. False si vence el plazo."""
+        with self._lock:
+            return self._lock.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self) -> None:
+        self._closed = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    # - Internos -
+    def _run(self, run_id: int, rule: str, event, action: Callable[[Any], None]) -> None:
+        deadline = time.monotonic() + self.timeout
+        flagged = [False]
+        with self._lock:
+            self._running[run_id] = (rule, event, deadline, flagged)
+        try:
+            action(_DeadlineProxy(self.controller, deadline))
+        except ActionTimeout as exc:
+            if not flagged[0]:
+                self._dead_letter(rule, event, "timeout", str(exc))
+        except Exception as exc:
+            self._dead_letter(rule, event, "error", repr(exc))
+        finally:
+            with self._lock:
+                self._running.pop(run_id, None)
+                self._pending -= 1
+                self._per_rule[rule] -= 1
+                if not self._per_rule[rule]:
+                    del self._per_rule[rule]
+                self._lock.notify_all()
+
+    def _watch(self) -> None:
+        period = min(self.timeout / 2, 0.5)
+        while not self._closed:
+            time.sleep(period)
+            now = time.monotonic()
+            with self._lock:
+                late = [(rule, event) for rule, event, deadline, flagged in self._running.values()
+                        if now > deadline and not flagged[0]]
+                for _, _, deadline, flagged in self._running.values():
+                    if now > deadline:
+                        flagged[0] = True
+            for rule, event in late:
+                self._dead_letter(rule, event, "timeout", f"sigue ejecutándose tras {self.timeout}s")
+
+    def _dead_letter(self, rule: str, event, reason: str, detail: str) -> None:
+        entry = DeadLetter(
+            rule=rule,
+            device_id=getattr(event, "device_id", ""),
+            payload=getattr(event, "payload", ""),
+            reason=reason,
+            detail=detail,
+            at=dt.datetime.utcnow(),
+        )
+        self.dead_letters.append(entry)
+        deadletter_logger.warning("Regla '%s' (%s): %s [%s=%s]",
+                                  rule, reason, detail, entry.device_id, entry.payload)
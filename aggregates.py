@@ -0,0 +1,160 @@
+"""
+aggregates.py - Agregados incrementales por dispositivo en ventana deslizante
+"""
+
+from __future__ import annotations
+import datetime as dt
+import math
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import config
+
+NAN = float("nan")
+
+
+def event_time(created_at: Optional[dt.datetime]) -> float:
+    """Instante epoch de un Event (created_at es UTC naive); ahora si no tiene."""
+    if created_at is None:
+        return time.time()
+    return created_at.replace(tzinfo=dt.timezone.utc).timestamp()
+
+
+class DeviceWindow:
+    """
+    Últimas muestras numéricas de un dispositivo: como mucho `max_samples`
+    y de los últimos `max_age` segundos.
+
+    Cada push/evicción es O(1) amortizado: la media sale de una suma
+    acumulada y el mínimo/máximo de deques monótonas. Si la ventana está
+    vacía los agregados valen NaN (cualquier comparación da False).
+    """
+
+    def __init__(self, max_samples: int, max_age: float) -> None:
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self._samples: Deque[Tuple[int, float, float]] = deque()  # (seq, ts, valor)
+        self._min: Deque[Tuple[int, float]] = deque()             # (seq, valor) creciente
+        self._max: Deque[Tuple[int, float]] = deque()             # (seq, valor) decreciente
+        self._sum = 0.0
+        self._seq = 0
+        self.last_ts: Optional[float] = None   # último evento (numérico o no)
+        self.prev_ts: Optional[float] = None   # el anterior al último
+        self._lock = threading.Lock()
+
+    def push(self, ts: float, value: Optional[float]) -> None:
+        """Registra un evento; `value` None para payloads no numéricos."""
+        with self._lock:
+            self.prev_ts, self.last_ts = self.last_ts, ts
+            if value is None or math.isnan(value):
+                return
+            if len(self._samples) >= self.max_samples:
+                self._pop_oldest()
+            self._seq += 1
+            self._samples.append((self._seq, ts, value))
+            self._sum += value
+            while self._min and self._min[-1][1] >= value:
+                self._min.pop()
+            self._min.append((self._seq, value))
+            while self._max and self._max[-1][1] <= value:
+                self._max.pop()
+            self._max.append((self._seq, value))
+            self._expire(ts)
+
+    def _pop_oldest(self) -> None:
+        seq, _, value = self._samples.popleft()
+        self._sum -= value
+        if self._min and self._min[0][0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0][0] == seq:
+            self._max.popleft()
+        if not self._samples:
+            self._sum = 0.0  # evita arrastrar error de redondeo
+
+    def _expire(self, now: float) -> None:
+        limit = now - self.max_age
+        while self._samples and self._samples[0][1] < limit:
+            self._pop_oldest()
+
+    def _fresh(self) -> None:
+        self._expire(time.time())
+
+    # - Agregados (se usan desde las reglas) -
+    @property
+    def count(self) -> int:
+        with self._lock:
+            self._fresh()
+            return len(self._samples)
+
+    @property
+    def mean(self) -> float:
+        with self._lock:
+            self._fresh()
+            return self._sum / len(self._samples) if self._samples else NAN
+
+    @property
+    def min(self) -> float:
+        with self._lock:
+            self._fresh()
+            return self._min[0][1] if self._min else NAN
+
+    @property
+    def max(self) -> float:
+        with self._lock:
+            self._fresh()
+            return self._max[0][1] if self._max else NAN
+
+    @property
+    def rate(self) -> float:
+        """Variación por segundo entre la muestra más antigua y la última."""
+        with self._lock:
+            self._fresh()
+            if len(self._samples) < 2:
+                return NAN
+            _, t0, v0 = self._samples[0]
+            _, t1, v1 = self._samples[-1]
+            return (v1 - v0) / (t1 - t0) if t1 > t0 else NAN
+
+    @property
+    def since_last(self) -> float:
+        """Segundos desde el último evento del dispositivo (inf si no hubo)."""
+        return time.time() - self.last_ts if self.last_ts is not None else math.inf
+
+    @property
+    def gap(self) -> float:
+        """Segundos entre el último evento y el anterior (inf si no hubo dos)."""
+        if self.last_ts is None or self.prev_ts is None:
+            return math.inf
+        return self.last_ts - self.prev_ts
+
+
+class WindowStore:
+    """Ventanas por dispositivo, creadas bajo demanda con el tamaño configurado."""
+
+    def __init__(self, max_samples: Optional[int] = None, max_age: Optional[float] = None) -> None:
+        self.max_samples = max_samples or config.RULE_WINDOW_SAMPLES
+        self.max_age = max_age or config.RULE_WINDOW_SECONDS
+        self._windows: Dict[str, DeviceWindow] = {}
+        self._lock = threading.Lock()
+        self._empty = DeviceWindow(1, self.max_age)
+
+    def push(self, device_id: str, ts: float, value: Optional[float]) -> DeviceWindow:
+        window = self._windows.get(device_id)
+        if window is None:
+            with self._lock:
+                window = self._windows.setdefault(
+                    device_id, DeviceWindow(self.max_samples, self.max_age)
+                )
+        window.push(ts, value)
+        return window
+
+    def get(self, device_id: str) -> DeviceWindow:
+        """Ventana de un dispositivo (una vacía si aún no tiene eventos)."""
+        return self._windows.get(device_id, self._empty)
+
+    def discard(self, device_id: str) -> None:
+        """Olvida la ventana de un dispositivo dado de baja."""
+        with self._lock:
+            self._windows.pop(device_id, None)
@@ -0,0 +1,107 @@
+"""
+async_persistence.py - Acceso asíncrono a la BD (aiosqlite) para el bot y el Bridge
+
+El lado MQTT (ingesta, motor de reglas) sigue usando las sesiones síncronas
+de persistence.py desde sus hilos; todo lo que corre en el bucle de eventos
+de discord.py pasa por aquí para no bloquearlo. Ambos motores apuntan al
+mismo fichero SQLite y comparten modelos.
+"""
+
+from __future__ import annotations
+import logging
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import config
+import persistence as db
+
+logger = logging.getLogger(__name__)
+
+_engine = create_async_engine(f"sqlite+aiosqlite:///{config.SQLITE_DB}", echo=config.DEBUG)
+AsyncSessionLocal = async_sessionmaker(bind=_engine, expire_on_commit=False)
+
+def get_session() -> AsyncSession:
+    return AsyncSessionLocal()
+
+async def dispose() -> None:
+    """Cierra las conexiones del pool (al apagar el bot)."""
+    await _engine.dispose()
+
+# - Dispositivos -
+async def add_device(device_id: str, device_type: str) -> db.Device | None:
+    """Crea el dispositivo. None si ya existe uno con ese ID."""
+    async with get_session() as s:
+        existing = await s.scalar(select(db.Device).filter_by(device_id=device_id))
+        if existing:
+            return None
+        dev = db.Device(device_id=device_id, device_type=device_type)
+        s.add(dev)
+        await s.commit()
+        return dev
+
+async def set_device_type(device_id: str, device_type: str) -> bool:
+    async with get_session() as s:
+        dev = await s.scalar(select(db.Device).filter_by(device_id=device_id))
+        if not dev:
+            return False
+        dev.device_type = device_type
+        await s.commit()
+        return True
+
+async def delete_device(device_id: str) -> bool:
+    async with get_session() as s:
+        dev = await s.scalar(select(db.Device).filter_by(device_id=device_id))
+        if not dev:
+            return False
+        await s.delete(dev)
+        await s.commit()
+        return True
+
+# - Reglas versionadas (mismo contrato que persistence.add_rule/delete_rule/list_rules) -
+async def add_rule(model: type[db.Rule] | type[db.ThresholdRule], **fields) -> db.Rule | db.ThresholdRule:
+    async with get_session() as s:
+        obj = model(**fields)
+        obj.version = await s.run_sync(db._bump_rules_version)
+        s.add(obj)
+        await s.commit()
+        return obj
+
+async def delete_rule(model: type[db.Rule] | type[db.ThresholdRule], rule_id: int) -> bool:
+    async with get_session() as s:
+        obj = await s.get(model, rule_id)
+        if obj is None or obj.deleted:
+            return False
+        obj.deleted = True
+        obj.version = await s.run_sync(db._bump_rules_version)
+        await s.commit()
+        return True
+
+async def list_rules(model: type[db.Rule] | type[db.ThresholdRule]) -> list:
+    async with get_session() as s:
+        res = await s.scalars(select(model).where(model.deleted.is_not(True)).order_by(model.id))
+        return list(res)
+
+# - Suscripciones de canales -
+async def add_subscription(channel_id: int, kind: str, target: str) -> bool:
+    """False si el canal ya estaba suscrito a eso."""
+    async with get_session() as s:
+        existing = await s.scalar(
+            select(db.Subscription).filter_by(channel_id=channel_id, kind=kind, target=target)
+        )
+        if existing:
+            return False
+        s.add(db.Subscription(channel_id=channel_id, kind=kind, target=target))
+        await s.commit()
+        return True
+
+async def delete_subscription(channel_id: int, kind: str, target: str) -> bool:
+    async with get_session() as s:
+        res = await s.execute(
+            delete(db.Subscription).filter_by(channel_id=channel_id, kind=kind, target=target)
+        )
+        await s.commit()
+        return res.rowcount > 0
+
+async def list_subscriptions() -> list:
+    async with get_session() as s:
+        res = await s.scalars(select(db.Subscription).order_by(db.Subscription.id))
+        return list(res)
@@ -2,13 +2,93 @@
 bot.py - Bot de Discord para gestionar dispositivos y reglas
 """
 
+import asyncio
+import datetime as dt
+import io
+import itertools
 import logging
+import re
 import discord
 from discord.ext import commands
+import async_persistence as adb
+import config
 import persistence as db
+import threshold_rules
+from export import write_columns
+from messages import pack_lines
+from rule_stats import SORT_KEYS
+from subscriptions import describe_target, parse_target
 
 logger = logging.getLogger(__name__)
 
+_RULE_OPTION = re.compile(r"^(edge|(cooldown|hyst|rearm)=(.+))$", re.IGNORECASE)
+
+def split_rule_options(args):
+    """
+    Separa las opciones finales de !rule add/threshold:
+      cooldown=<seg>   edge   hyst=<banda> (umbral)   rearm=<expr> (Python)
+    Devuelve (argumentos posicionales, dict de opciones).
+    """
+    args = list(args)
+    opts = {}
+    while args:
+        m = _RULE_OPTION.match(args[-1])
+        if not m:
+            break
+        args.pop()
+        if m.group(1).lower() == "edge":
+            opts["edge"] = True
+        else:
+            opts[m.group(2).lower()] = m.group(3)
+    return args, opts
+
+_RELATIVE = re.compile(r"^(\d+)([smhd])$", re.IGNORECASE)
+_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+def parse_when(text, now=None):
+    """
+    Convierte un instante de !history a datetime UTC: relativo al momento
+    actual ('30m', '2h', '7d') o fecha ISO ('2024-05-01', '2024-05-01T10:30').
+    Lanza ValueError si no lo reconoce.
+    """
+    m = _RELATIVE.match(text)
+    if m:
+        delta = dt.timedelta(**{_UNITS[m.group(2).lower()]: int(m.group(1))})
+        return (now or dt.datetime.utcnow()) - delta
+    return dt.datetime.fromisoformat(text)
+
+class DevicePager(discord.ui.View):
+    """Botones ◀ ▶ para recorrer las páginas ya renderizadas de un listado."""
+
+    def __init__(self, listing, timeout: float = 180):
+        super().__init__(timeout=timeout)
+        self.listing = listing
+        self.page = 0
+        self._sync()
+
+    def embed(self) -> discord.Embed:
+        embed = discord.Embed(title="Dispositivos", description=self.listing.pages[self.page])
+        embed.set_footer(text=f"Página {self.page + 1}/{len(self.listing.pages)} · "
+                              f"{self.listing.total} dispositivos")
+        return embed
+
+    def _sync(self) -> None:
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page >= len(self.listing.pages) - 1
+
+    async def _show(self, interaction: discord.Interaction, page: int) -> None:
+        self.page = page
+        self._sync()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, min(self.page + 1, len(self.listing.pages) - 1))
+
 class HomeBot(commands.Bot):
     def __init__(self, bridge_factory, rule_engine):
         """
@@ -23,22 +103,39 @@ class HomeBot(commands.Bot):
         self.bridge = None
         self.rule_engine = rule_engine
 
+    async def reload_rules(self):
+        """Recarga incremental de reglas (lectura síncrona de BD) fuera del bucle de eventos."""
+        await asyncio.to_thread(self.rule_engine.reload_rules)
+
+    async def close(self):
+        await super().close()
+        await adb.dispose()
+
+    async def send_device_listing(self, ctx, filters):
+        """Primera página del listado con botones para recorrer el resto."""
+        opts = dict(f.split("=", 1) for f in filters if "=" in f)
+        unknown = [f for f in filters if "=" not in f or f.split("=", 1)[0] not in ("type", "state")]
+        if unknown:
+            await ctx.send("Filtros: type=<tipo> state=<estado>")
+            return
+        listing = self.bridge.device_listing(opts.get("type"), opts.get("state"))
+        if not listing.total:
+            await ctx.send("No hay dispositivos registrados." if not opts else "Ningún dispositivo cumple el filtro.")
+            return
+        pager = DevicePager(listing)
+        await ctx.send(embed=pager.embed(), view=pager if len(listing.pages) > 1 else None)
+
     async def setup_hook(self):
         # Se crea el Bridge cuando el bot ya está inicializado
         self.bridge = self.bridge_factory(self)
 
         @self.command(name="devices")
-        async def _devices(ctx):
-            """Muestra la lista de dispositivos registrados en la BD."""
-            devices = self.bridge.list_devices()
-            if not devices:
-                await ctx.send("(Sin dispositivos registrados)")
-                return
-            lines = [
-                f"• **{d.device_id}** ({d.device_type}) — último estado: `{d.last_state}`"
-                for d in devices
-            ]
-            await ctx.send("\n".join(lines))
+        async def _devices(ctx, *filters):
+            """
+            Muestra los dispositivos registrados, paginados.
+            Uso: !devices [type=<tipo>] [state=<estado>]
+            """
+            await self.send_device_listing(ctx, filters)
 
         @self.command(name="state")
         async def _state(ctx, device_id: str):
@@ -61,23 +158,147 @@ class HomeBot(commands.Bot):
                 await ctx.send("Uso: !switch <device_id> <on|off>")
                 return
             payload = onoff.upper()
-            self.bridge.switch_device(device_id, payload)
-            await ctx.send(f"Enviado {payload} a {device_id}")
+            try:
+                latency = await self.bridge.switch_device(device_id, payload)
+            except ConnectionError as exc:
+                await ctx.send(f"No se pudo enviar {payload} a {device_id}: {exc}")
+                return
+            if latency is None:
+                await ctx.send(f"Enviado {payload} a {device_id} (sin confirmación del broker todavía)")
+            else:
+                await ctx.send(f"Enviado {payload} a {device_id} (confirmado en {latency * 1e3:.0f} ms)")
 
         # Comando para “forzar” a un sensor que publique su estado
         @self.command(name="ask")
         async def _ask(ctx, device_id: str):
             """
-            Pregunta al dispositivo su estado, publicando un payload GET_STATE en <base>/<device_id>
-            El dispositivo responderá a su /status.
+            Pregunta al dispositivo su estado, publicando un payload GET_STATE en <base>/<device_id>,
+            y espera a que responda en su /status (como mucho REQUEST_TIMEOUT segundos).
             """
             dev = self.bridge.get_device(device_id)
             if not dev:
                 await ctx.send(f"No se encontró el dispositivo '{device_id}' en la BD.")
                 return
-            # Enviamos "GET_STATE" para que el sensor responda
-            self.bridge.ask_device_status(device_id)
-            await ctx.send(f"Estado solicitado a '{device_id}'. Espera su respuesta...")
+            reply = await self.bridge.ask_device(device_id)
+            if reply is None:
+                await ctx.send(
+                    f"'{device_id}' no respondió en {config.REQUEST_TIMEOUT:g}s. "
+                    f"Último estado conocido: `{dev.last_state}`"
+                )
+                return
+            await ctx.send(f"'{device_id}' responde `{reply.payload}` ({reply.rtt * 1e3:.0f} ms)")
+
+        @self.command(name="rtt")
+        async def _rtt(ctx):
+            """Tiempos de respuesta a !ask (GET_STATE) de toda la flota."""
+            await ctx.send(self.bridge.controller.requests.describe())
+
+        @self.command(name="mqtt")
+        async def _mqtt(ctx):
+            """Estado de la conexión MQTT: reconexiones, tiempo sin conexión y cola offline."""
+            await ctx.send(self.bridge.controller.mqtt_status())
+
+        @self.command(name="history")
+        async def _history(ctx, device_id: str, *args):
+            """
+            Muestra eventos pasados de un dispositivo.
+            Uso: !history <device_id> [desde] [hasta] [límite]
+              desde/hasta: 30m, 2h, 7d o fecha ISO (UTC). Sin 'desde', los más recientes primero.
+            """
+            args = list(args)
+            limit = config.HISTORY_DEFAULT_LIMIT
+            if args and args[-1].isdigit():
+                limit = min(int(args.pop()), config.HISTORY_MAX_LIMIT)
+            try:
+                since = parse_when(args[0]) if len(args) > 0 else None
+                until = parse_when(args[1]) if len(args) > 1 else None
+            except ValueError:
+                await ctx.send("Uso: !history <device_id> [desde] [hasta] [límite] (desde/hasta: 30m, 2h, 7d o fecha ISO)")
+                return
+            if len(args) > 2 or limit <= 0:
+                await ctx.send("Uso: !history <device_id> [desde] [hasta] [límite]")
+                return
+
+            rows = self.bridge.history(device_id, since, until, limit, newest_first=since is None)
+            # Se lee por páginas en un hilo y se envía según se llenan los mensajes;
+            # el último trozo se guarda por si caben más líneas
+            pending, sent = [], 0
+            while True:
+                batch = await asyncio.to_thread(list, itertools.islice(rows, config.HISTORY_PAGE_SIZE))
+                pending.extend(f"`{r.created_at:%Y-%m-%d %H:%M:%S}` {r.payload}" for r in batch)
+                sent += len(batch)
+                chunks = pack_lines(pending)
+                if not batch:
+                    break
+                for chunk in chunks[:-1]:
+                    await ctx.send(chunk)
+                pending = chunks[-1:]
+            if not sent:
+                await ctx.send(f"Sin eventos de '{device_id}' en ese rango.")
+                return
+            for chunk in chunks:
+                await ctx.send(chunk)
+
+        @self.command(name="export")
+        async def _export(ctx, device_id: str, *args):
+            """
+            Adjunta el historial numérico de un dispositivo como fichero columnar (.evcol).
+            Uso: !export <device_id> [desde] [hasta]
+            """
+            try:
+                since = parse_when(args[0]) if len(args) > 0 else None
+                until = parse_when(args[1]) if len(args) > 1 else None
+            except ValueError:
+                await ctx.send("Uso: !export <device_id> [desde] [hasta] (desde/hasta: 30m, 2h, 7d o fecha ISO)")
+                return
+            cols = await asyncio.to_thread(self.bridge.export, device_id, since, until)
+            if not len(cols):
+                await ctx.send(f"Sin valores numéricos de '{device_id}' en ese rango.")
+                return
+            buf = io.BytesIO()
+            write_columns(cols, buf)
+            buf.seek(0)
+            await ctx.send(
+                f"{len(cols)} valores de '{device_id}'",
+                file=discord.File(buf, filename=f"{device_id}.evcol"),
+            )
+
+        @self.command(name="subscribe")
+        async def _subscribe(ctx, target: str, channel: discord.TextChannel = None):
+            """
+            Envía a un canal los eventos de un dispositivo, de un tipo o de un patrón.
+            Uso: !subscribe <device_id | type:<tipo> | patrón> [#canal]
+            Ej: !subscribe temp01   !subscribe type:switch #casa   !subscribe "temp*"
+            Mientras no haya ninguna suscripción, todo va al canal por defecto.
+            """
+            channel = channel or ctx.channel
+            kind, value = parse_target(target)
+            if await self.bridge.subscribe(channel.id, kind, value):
+                await ctx.send(f"{channel.mention} suscrito a {describe_target(kind, value)}")
+            else:
+                await ctx.send(f"{channel.mention} ya estaba suscrito a {describe_target(kind, value)}")
+
+        @self.command(name="unsubscribe")
+        async def _unsubscribe(ctx, target: str, channel: discord.TextChannel = None):
+            """Uso: !unsubscribe <device_id | type:<tipo> | patrón> [#canal]"""
+            channel = channel or ctx.channel
+            kind, value = parse_target(target)
+            if await self.bridge.unsubscribe(channel.id, kind, value):
+                await ctx.send(f"{channel.mention} ya no recibe {describe_target(kind, value)}")
+            else:
+                await ctx.send(f"{channel.mention} no estaba suscrito a {describe_target(kind, value)}")
+
+        @self.command(name="subscriptions")
+        async def _subscriptions(ctx):
+            """Lista las suscripciones de canales."""
+            subs = await adb.list_subscriptions()
+            if not subs:
+                await ctx.send("Sin suscripciones: los eventos van al canal por defecto.")
+                return
+            for chunk in pack_lines(
+                f"<#{sub.channel_id}> ← {describe_target(sub.kind, sub.target)}" for sub in subs
+            ):
+                await ctx.send(chunk)
 
         # Comando para gestionar dispositivos
         @self.command(name="device")
@@ -85,7 +306,7 @@ class HomeBot(commands.Bot):
             """
             Gestiona dispositivos: list, add, edit, delete
             Ejemplos:
-              !device list
+              !device list [type=<tipo>] [state=<estado>]
               !device add <device_id> <device_type>
               !device edit <device_id> <new_type>
               !device delete <device_id>
@@ -93,12 +314,8 @@ class HomeBot(commands.Bot):
             subcmd = subcmd.lower()
 
             if subcmd == "list":
-                devs = self.bridge.list_devices()
-                if not devs:
-                    await ctx.send("No hay dispositivos registrados.")
-                    return
-                lines = [f"**{d.device_id}** ({d.device_type}) - last: {d.last_state}" for d in devs]
-                await ctx.send("\n".join(lines))
+                # !device list [type=<tipo>] [state=<estado>]
+                await self.send_device_listing(ctx, args)
 
             elif subcmd == "add":
                 # !device add <device_id> <device_type>
@@ -106,7 +323,7 @@ class HomeBot(commands.Bot):
                     await ctx.send("Uso: !device add <device_id> <device_type>")
                     return
                 device_id, device_type = args
-                ok, msg = self.bridge.add_device(device_id, device_type)
+                ok, msg = await self.bridge.add_device(device_id, device_type)
                 await ctx.send(msg)
 
             elif subcmd == "edit":
@@ -115,7 +332,7 @@ class HomeBot(commands.Bot):
                     await ctx.send("Uso: !device edit <device_id> <new_type>")
                     return
                 device_id, new_type = args
-                ok, msg = self.bridge.edit_device_type(device_id, new_type)
+                ok, msg = await self.bridge.edit_device_type(device_id, new_type)
                 await ctx.send(msg)
 
             elif subcmd == "delete":
@@ -124,7 +341,7 @@ class HomeBot(commands.Bot):
                     await ctx.send("Uso: !device delete <device_id>")
                     return
                 device_id = args[0]
-                ok, msg = self.bridge.delete_device(device_id)
+                ok, msg = await self.bridge.delete_device(device_id)
                 await ctx.send(msg)
 
             else:
@@ -143,28 +360,42 @@ class HomeBot(commands.Bot):
         @self.command(name="rule")
         async def _rule(ctx, subcommand: str = "", *args):
             """
-            Gestiona reglas: list, add, delete
+            Gestiona reglas: list, add, threshold, delete, stats
             Ejemplos:
               !rule list
               !rule add "ReglaTemperatura" "float(event.payload)>25" "controller.send_command('boiler','ON')"
+              !rule add "MediaAlta" "window.count>=5 and window.mean>25" "controller.send_command('boiler','OFF')"
+              !rule threshold "TempAlta" temp01 > 25 boiler ON
+              !rule threshold "Confort" temp01 between 19 22 boiler OFF
+              !rule threshold "Caldera" temp01 < 19 boiler ON edge hyst=0.5 cooldown=60
               !rule delete 3
+              !rule delete T1
+              !rule stats [total_time|evaluations|fires|errors] [n]
             """
             subcommand = subcommand.lower()
 
             if subcommand == "list":
-                with db.get_session() as session:
-                    all_rules = session.query(db.Rule).all()
-                    if not all_rules:
-                        await ctx.send("No hay reglas registradas.")
-                        return
-                    lines = []
-                    for r in all_rules:
-                        lines.append(
-                            f"**ID {r.id}**: {r.name}\n"
-                            f"  - condition: `{r.condition}`\n"
-                            f"  - action: `{r.action}`"
-                        )
-                    await ctx.send("\n\n".join(lines))
+                all_rules = await adb.list_rules(db.Rule)
+                all_thresholds = await adb.list_rules(db.ThresholdRule)
+                if not all_rules and not all_thresholds:
+                    await ctx.send("No hay reglas registradas.")
+                    return
+                lines = []
+                for r in all_rules:
+                    text = (
+                        f"**ID {r.id}**: {r.name}\n"
+                        f"  - condition: `{r.condition}`\n"
+                        f"  - action: `{r.action}`"
+                    )
+                    if r.edge or r.rearm or r.cooldown:
+                        text += (f"\n  - flanco: {bool(r.edge)}, rearm: `{r.rearm}`, "
+                                 f"cooldown: {r.cooldown or 0}s")
+                    lines.append(text)
+                for t in all_thresholds:
+                    spec = threshold_rules.ThresholdSpec.from_row(t)
+                    lines.append(f"**ID T{t.id}**: {t.name}\n  - {spec.describe()}")
+                for chunk in pack_lines(lines, sep="\n\n"):
+                    await ctx.send(chunk)
 
             elif subcommand == "add":
                 """
@@ -172,51 +403,119 @@ class HomeBot(commands.Bot):
                   1) Nombre de la regla
                   2) condition (expresión Python, p.ej. float(event.payload)>25)
                   3) action (código Python, p.ej. controller.send_command('boiler','ON'))
+                y opcionalmente: cooldown=<seg>, edge, rearm="<expr>"
                 """
+                positional, opts = split_rule_options(args)
                 try:
-                    rule_name, rule_condition, rule_action = args
+                    rule_name, rule_condition, rule_action = positional
+                    cooldown = float(opts.get("cooldown", 0))
                 except ValueError:
                     usage_text = (
-                        "Uso: !rule add \"<nombre>\" \"<cond>\" \"<action>\"\n"
+                        "Uso: !rule add \"<nombre>\" \"<cond>\" \"<action>\" "
+                        "[cooldown=<seg>] [edge] [\"rearm=<expr>\"]\n"
                         "Ej: !rule add \"ReglaTempAlta\" \"float(event.payload)>25\" "
                         "\"controller.send_command('boiler','ON')\""
                     )
                     await ctx.send(usage_text)
                     return
 
-                with db.get_session() as session:
-                    new_rule = db.Rule(
-                        name=rule_name,
-                        condition=rule_condition,
-                        action=rule_action,
-                    )
-                    session.add(new_rule)
-                    session.commit()
+                # Validamos que compile antes de guardarla
+                try:
+                    compile(rule_condition, "<condition>", "eval")
+                    compile(rule_action, "<action>", "exec")
+                    if "rearm" in opts:
+                        compile(opts["rearm"], "<rearm>", "eval")
+                except SyntaxError as exc:
+                    await ctx.send(f"La regla no es válida: {exc}")
+                    return
+
+                await adb.add_rule(
+                    db.Rule,
+                    name=rule_name,
+                    condition=rule_condition,
+                    action=rule_action,
+                    cooldown=cooldown,
+                    edge=opts.get("edge", False),
+                    rearm=opts.get("rearm"),
+                )
 
-                self.rule_engine.reload_rules()
+                await self.reload_rules()
                 await ctx.send(f"Regla '{rule_name}' añadida con éxito.")
 
+            elif subcommand == "threshold":
+                # !rule threshold <nombre> <device> <op> <valor> [<valor2>] <target> <payload>
+                usage_text = (
+                    "Uso: !rule threshold \"<nombre>\" <device> <op> <valor> [<valor2>] <target> <payload> "
+                    "[edge] [hyst=<banda>] [cooldown=<seg>]\n"
+                    f"  op: {' | '.join(threshold_rules.OPS)} ('between' lleva dos valores)\n"
+                    "Ej: !rule threshold \"TempAlta\" temp01 > 25 boiler ON"
+                )
+                args, opts = split_rule_options(args)
+                try:
+                    name, device_id, op = args[:3]
+                    if op == "between":
+                        low, high = float(args[3]), float(args[4])
+                        target, command = args[5:]
+                    else:
+                        low, high = float(args[3]), None
+                        target, command = args[4:]
+                    cooldown = float(opts.get("cooldown", 0))
+                    hysteresis = float(opts.get("hyst", 0))
+                except (ValueError, IndexError):
+                    await ctx.send(usage_text)
+                    return
+                try:
+                    threshold_rules.validate(op, low, high)
+                except ValueError as exc:
+                    await ctx.send(str(exc))
+                    return
+
+                await adb.add_rule(
+                    db.ThresholdRule,
+                    name=name, device_id=device_id, op=op, low=low, high=high,
+                    target_device=target, command=command,
+                    cooldown=cooldown, edge=opts.get("edge", False), hysteresis=hysteresis,
+                )
+
+                await self.reload_rules()
+                await ctx.send(f"Regla de umbral '{name}' añadida con éxito.")
+
             elif subcommand == "delete":
-                # Elimina la regla según su ID en la tabla 'rules'
+                # Elimina la regla según su ID en 'rules' (o 'threshold_rules' con prefijo T)
                 if not args:
                     await ctx.send("Uso: !rule delete <rule_id>")
                     return
 
                 rule_id = args[0]
-                with db.get_session() as session:
-                    rule_obj = session.query(db.Rule).get(rule_id)
-                    if not rule_obj:
-                        await ctx.send(f"No se encontró la regla con ID {rule_id}")
-                        return
-                    session.delete(rule_obj)
-                    session.commit()
-
-                self.rule_engine.reload_rules()
-                await ctx.send(f"Regla con ID {rule_id} eliminada.")
+                model = db.Rule
+                if rule_id[:1].upper() == "T":
+                    model, rule_id = db.ThresholdRule, rule_id[1:]
+                if not rule_id.isdigit() or not await adb.delete_rule(model, int(rule_id)):
+                    await ctx.send(f"No se encontró la regla con ID {args[0]}")
+                    return
+
+                await self.reload_rules()
+                await ctx.send(f"Regla con ID {args[0]} eliminada.")
+            elif subcommand == "stats":
+                # !rule stats [orden] [n]: métricas por regla, por defecto las 10 más costosas
+                sort_by = args[0] if args else "total_time"
+                try:
+                    limit = int(args[1]) if len(args) > 1 else 10
+                    rows = self.rule_engine.stats(sort_by)[:limit]
+                except ValueError:
+                    await ctx.send(f"Uso: !rule stats [{'|'.join(SORT_KEYS)}] [n]")
+                    return
+                if not rows:
+                    await ctx.send("No hay reglas cargadas.")
+                    return
+                for chunk in pack_lines(row.describe() for row in rows):
+                    await ctx.send(chunk)
             else:
                 await ctx.send(
-                    "Subcomandos disponibles: list, add, delete\n"
+                    "Subcomandos disponibles: list, add, threshold, delete, stats\n"
                     "Ej: !rule list\n"
                     "    !rule add \"nombre\" \"cond\" \"action\"\n"
-                    "    !rule delete <id>"
+                    "    !rule threshold \"nombre\" <device> <op> <valor> <target> <payload>\n"
+                    "    !rule delete <id> | T<id>\n"
+                    "    !rule stats [orden] [n]"
                 )
@@ -6,83 +6,152 @@ from __future__ import annotations
 import asyncio
 import logging
 import discord
-import persistence as db
+import async_persistence as adb
 import config
+from device_listing import DeviceListingCache
+from export import export_columns
+from handoff import LoopHandoff
+from publisher import EventPublisher
+from registry import DeviceInfo
+from subscriptions import SubscriptionIndex
 
 logger = logging.getLogger(__name__)
 
 class Bridge:
     def __init__(self, controller, bot):
         self.controller = controller
+        self.registry = controller.registry
+        self.listings = DeviceListingCache(self.registry)
         self.bot: discord.Client | discord.ext.commands.Bot = bot
-        self.event_q: asyncio.Queue[db.Event] = asyncio.Queue()
+        # Los eventos llegan desde los hilos de ingesta: cola acotada y segura
+        # entre hilos que despierta al bucle del bot
+        self.event_q = LoopHandoff(
+            bot.loop, config.BRIDGE_QUEUE_SIZE, config.BRIDGE_OVERFLOW,
+            key=lambda ev: ev.device_id,
+        )
+        self.publisher: EventPublisher | None = None
+        # Qué canales quieren qué eventos; sin suscripciones, el canal por defecto
+        self.subscriptions = SubscriptionIndex()
+        self.default_channel: discord.abc.Messageable | None = None
 
         # Controller -> cola interna
-        controller.register_listener(lambda ev: self.event_q.put_nowait(ev))
+        controller.register_listener(self.event_q.put)
         # Tarea asíncrona que publicará en Discord
         bot.loop.create_task(self._publisher_task())
 
     # - Métodos usados por el bot -
+    # Las lecturas salen del registro en memoria; las escrituras van a la BD
+    # (async, sin bloquear el bucle de Discord) y después al registro (write-through).
     def list_devices(self):
-        with db.get_session() as s:
-            return s.query(db.Device).all()
+        return self.registry.all()
+
+    def device_listing(self, device_type=None, state=None):
+        """Listado paginado (y cacheado) con filtros opcionales por tipo y estado."""
+        return self.listings.get(device_type, state)
 
     def get_device(self, device_id: str):
-        with db.get_session() as s:
-            return s.query(db.Device).filter_by(device_id=device_id).one_or_none()
-
-    def add_device(self, device_id: str, device_type: str):
-        with db.get_session() as s:
-            existing = s.query(db.Device).filter_by(device_id=device_id).one_or_none()
-            if existing:
-                return False, "Ya existe un dispositivo con ese ID"
-            new_dev = db.Device(device_id=device_id, device_type=device_type)
-            s.add(new_dev)
-            s.commit()
+        return self.registry.get(device_id)
+
+    async def add_device(self, device_id: str, device_type: str):
+        if await adb.add_device(device_id, device_type) is None:
+            return False, "Ya existe un dispositivo con ese ID"
+        self.registry.put(DeviceInfo(device_id, device_type))
         return True, "Dispositivo creado correctamente"
 
-    def edit_device_type(self, device_id: str, new_type: str):
-        with db.get_session() as s:
-            dev = s.query(db.Device).filter_by(device_id=device_id).one_or_none()
-            if not dev:
-                return False, "Dispositivo no encontrado"
-            dev.device_type = new_type
-            s.commit()
+    async def edit_device_type(self, device_id: str, new_type: str):
+        if not await adb.set_device_type(device_id, new_type):
+            return False, "Dispositivo no encontrado"
+        self.registry.set_type(device_id, new_type)
         return True, "Tipo de dispositivo actualizado"
 
-    def delete_device(self, device_id: str):
-        with db.get_session() as s:
-            dev = s.query(db.Device).filter_by(device_id=device_id).one_or_none()
-            if not dev:
-                return False, "Dispositivo no encontrado"
-            s.delete(dev)
-            s.commit()
+    async def delete_device(self, device_id: str):
+        if not await adb.delete_device(device_id):
+            return False, "Dispositivo no encontrado"
+        self.registry.remove(device_id)
         return True, "Dispositivo borrado correctamente"
 
     def get_state(self, device_id: str):
-        with db.get_session() as s:
-            dev = s.query(db.Device).filter_by(device_id=device_id).one_or_none()
-            return dev.last_state if dev else None
+        dev = self.registry.get(device_id)
+        return dev.last_state if dev else None
+
+    def history(self, device_id: str, since=None, until=None, limit=None, newest_first=False):
+        """Generador paginado de eventos pasados (ver EventBackend.history)."""
+        return self.controller.event_store.history(device_id, since, until, limit, newest_first)
 
-    def switch_device(self, device_id: str, payload: str):
-        self.controller.send_command(device_id, payload)
+    def export(self, device_id: str, since=None, until=None):
+        """Historial numérico en columnas (export.Columns). Bloqueante: llamar en un hilo."""
+        return export_columns(self.controller.event_store, device_id, since, until)
+
+    async def switch_device(self, device_id: str, payload: str, timeout=None):
+        """
+        Envía el comando y espera la confirmación del broker. Devuelve la
+        latencia en segundos; None si no llega en `timeout` segundos
+        (REQUEST_TIMEOUT por defecto). Los errores de entrega se propagan.
+        """
+        # Un comando manual se envía siempre, aunque repita el anterior
+        fut = self.controller.send_command(device_id, payload, dedup=False)
+        timeout = config.REQUEST_TIMEOUT if timeout is None else timeout
+        try:
+            # shield: sin confirmación a tiempo el comando sigue su curso
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), timeout)
+        except asyncio.TimeoutError:
+            return None
 
     def ask_device_status(self, device_id: str):
         """Publica un mensaje de 'GET_STATE' hacia el dispositivo para que responda."""
-        self.controller.request_status(device_id)
+        return self.controller.request_status(device_id)
+
+    async def ask_device(self, device_id: str, timeout=None):
+        """
+        Pregunta el estado y espera la respuesta (StatusReply con el RTT).
+        None si no contesta en `timeout` segundos (REQUEST_TIMEOUT por defecto).
+        """
+        timeout = config.REQUEST_TIMEOUT if timeout is None else timeout
+        fut = self.controller.request_status(device_id)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+        except asyncio.TimeoutError:
+            self.controller.requests.discard(device_id, fut)
+            return None
+
+    # - Suscripciones (BD async + índice en memoria, write-through) -
+    async def load_subscriptions(self) -> None:
+        rows = await adb.list_subscriptions()
+        self.subscriptions = SubscriptionIndex((r.channel_id, r.kind, r.target) for r in rows)
+
+    async def subscribe(self, channel_id: int, kind: str, target: str) -> bool:
+        if not await adb.add_subscription(channel_id, kind, target):
+            return False
+        await self.load_subscriptions()
+        return True
+
+    async def unsubscribe(self, channel_id: int, kind: str, target: str) -> bool:
+        if not await adb.delete_subscription(channel_id, kind, target):
+            return False
+        await self.load_subscriptions()
+        return True
+
+    def route(self, event):
+        """Canales a los que va un evento: una búsqueda en el índice de suscripciones."""
+        if not len(self.subscriptions):
+            return (self.default_channel,) if self.default_channel else ()
+        info = self.registry.get(event.device_id)
+        ids = self.subscriptions.channels_for(event.device_id, info.device_type if info else None)
+        return [ch for ch in map(self.bot.get_channel, ids) if ch is not None]
 
     #Publicamos eventos en discord
     async def _publisher_task(self):
         await self.bot.wait_until_ready()
-        channel = self._find_default_channel()
-        if not channel:
+        await self.load_subscriptions()
+        self.default_channel = self._find_default_channel()
+        if self.default_channel:
+            logger.info("Bridge publicará eventos sin suscripción en #%s", self.default_channel.name)
+        elif not len(self.subscriptions):
             logger.warning("Bridge: no se encontró canal con permisos de envío")
-            return
 
-        logger.info("Bridge publicará eventos en #%s", channel.name)
-        while True:
-            ev = await self.event_q.get()
-            await channel.send(f"📟 **{ev.device_id}** → `{ev.payload}`")
+        # Por lotes: último valor por dispositivo y mensajes empaquetados
+        self.publisher = EventPublisher(self.event_q, self.route)
+        await self.publisher.run()
 
     def _find_default_channel(self):
         for guild in self.bot.guilds:
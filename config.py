@@ -10,6 +10,21 @@ load_dotenv()
 MQTT_BROKER: str = os.getenv("MQTT_BROKER", "localhost")
 MQTT_PORT: int = int(os.getenv("MQTT_PORT", 1883))
 MQTT_BASE_TOPIC: str = os.getenv("MQTT_BASE_TOPIC", "redes2/2303/01")
+# "thread": paho's own network thread; "asyncio": driven by the bot's event loop
+MQTT_LOOP: str = os.getenv("MQTT_LOOP", "thread")
+# Reconnect backoff doubles from MIN to MAX seconds; publishes made while
+# disconnected wait in a bounded queue and are dropped after OFFLINE_TTL seconds
+MQTT_RECONNECT_MIN: int = int(os.getenv("MQTT_RECONNECT_MIN", 1))
+MQTT_RECONNECT_MAX: int = int(os.getenv("MQTT_RECONNECT_MAX", 60))
+MQTT_OFFLINE_QUEUE: int = int(os.getenv("MQTT_OFFLINE_QUEUE", 500))
+MQTT_OFFLINE_TTL: float = float(os.getenv("MQTT_OFFLINE_TTL", 60.0))
+# Per-topic QoS as "filter=qos;filter=qos" (first match wins); commands use QoS 1
+MQTT_QOS: str = os.getenv("MQTT_QOS", f"{MQTT_BASE_TOPIC}/+/set=1")
+MQTT_QOS_DEFAULT: int = int(os.getenv("MQTT_QOS_DEFAULT", 0))
+# At most MAX_INFLIGHT unacknowledged QoS>0 publishes; up to MAX_QUEUED wait
+# in paho's queue behind them, beyond that publishes are rejected
+MQTT_MAX_INFLIGHT: int = int(os.getenv("MQTT_MAX_INFLIGHT", 20))
+MQTT_MAX_QUEUED: int = int(os.getenv("MQTT_MAX_QUEUED", 1000))
 
 # SQLite database file
 SQLITE_DB: str = os.getenv("SQLITE_DB", "home_auto.db")
@@ -22,5 +37,73 @@ assert DISCORD_TOKEN, (
     "DISCORD_TOKEN is not set! Add it to .env or env‑vars before running."
 )
 
+# Ingest (write-behind): status messages are persisted in batches
+INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", 4))  # shards by device_id
+INGEST_QUEUE_SIZE: int = int(os.getenv("INGEST_QUEUE_SIZE", 10000))  # per shard
+INGEST_FLUSH_SIZE: int = int(os.getenv("INGEST_FLUSH_SIZE", 500))
+INGEST_FLUSH_INTERVAL: float = float(os.getenv("INGEST_FLUSH_INTERVAL", 0.05))
+INGEST_PUT_TIMEOUT: float = float(os.getenv("INGEST_PUT_TIMEOUT", 0.5))
+# A failed batch (e.g. "database is locked") is retried with backoff, then
+# written message by message so only the bad ones are dropped
+INGEST_WRITE_RETRIES: int = int(os.getenv("INGEST_WRITE_RETRIES", 3))
+INGEST_RETRY_BACKOFF: float = float(os.getenv("INGEST_RETRY_BACKOFF", 0.05))
+
+# Event storage: "table" (single events table), "partitioned" (daily tables
+# rolled up into event_rollups and dropped after EVENT_RETENTION_DAYS) or
+# "log" (append-only binary segments under EVENT_LOG_DIR, see event_log.py)
+EVENT_BACKEND: str = os.getenv("EVENT_BACKEND", "table")
+EVENT_RETENTION_DAYS: int = int(os.getenv("EVENT_RETENTION_DAYS", 30))
+EVENT_ROLLUP_SECONDS: int = int(os.getenv("EVENT_ROLLUP_SECONDS", 3600))
+EVENT_MAINTENANCE_INTERVAL: float = float(os.getenv("EVENT_MAINTENANCE_INTERVAL", 3600))
+EVENT_LOG_DIR: str = os.getenv("EVENT_LOG_DIR", "event_log")
+EVENT_LOG_SEGMENT_BYTES: int = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", 64 * 1024 * 1024))
+EVENT_LOG_INDEX_STRIDE: int = int(os.getenv("EVENT_LOG_INDEX_STRIDE", 64))  # sparse index step
+EVENT_LOG_FSYNC: bool = os.getenv("EVENT_LOG_FSYNC", "0") == "1"
+
+# !history reads events in keyset pages of this size; MAX caps one command
+HISTORY_PAGE_SIZE: int = int(os.getenv("HISTORY_PAGE_SIZE", 500))
+HISTORY_DEFAULT_LIMIT: int = int(os.getenv("HISTORY_DEFAULT_LIMIT", 50))
+HISTORY_MAX_LIMIT: int = int(os.getenv("HISTORY_MAX_LIMIT", 5000))
+
+# Rule actions run off the ingest path in a bounded thread pool
+RULE_ACTION_WORKERS: int = int(os.getenv("RULE_ACTION_WORKERS", 4))
+RULE_ACTION_QUEUE_SIZE: int = int(os.getenv("RULE_ACTION_QUEUE_SIZE", 1000))
+RULE_ACTION_TIMEOUT: float = float(os.getenv("RULE_ACTION_TIMEOUT", 5.0))
+RULE_ACTION_MAX_PER_RULE: int = int(os.getenv("RULE_ACTION_MAX_PER_RULE", 2))
+RULE_DEADLETTER_SIZE: int = int(os.getenv("RULE_DEADLETTER_SIZE", 500))
+
+# Seconds between checks of the rules version stamp (0 disables polling)
+RULE_POLL_INTERVAL: float = float(os.getenv("RULE_POLL_INTERVAL", 2.0))
+
+# Per-device sliding windows exposed to rules as `window` / `window_of(id)`
+RULE_WINDOW_SAMPLES: int = int(os.getenv("RULE_WINDOW_SAMPLES", 600))
+RULE_WINDOW_SECONDS: float = float(os.getenv("RULE_WINDOW_SECONDS", 300))
+
+# Identical commands to the same device within this many seconds are dropped
+COMMAND_DEDUP_WINDOW: float = float(os.getenv("COMMAND_DEDUP_WINDOW", 10.0))
+
+# !devices / !device list: rendered pages are cached for DEVICE_LIST_TTL seconds
+DEVICE_LIST_PAGE_SIZE: int = int(os.getenv("DEVICE_LIST_PAGE_SIZE", 25))
+DEVICE_LIST_TTL: float = float(os.getenv("DEVICE_LIST_TTL", 10))
+
+# Controller -> Discord handoff queue; on overflow: drop_oldest, drop_newest
+# or coalesce (keep only the latest pending event per device)
+BRIDGE_QUEUE_SIZE: int = int(os.getenv("BRIDGE_QUEUE_SIZE", 1000))
+BRIDGE_OVERFLOW: str = os.getenv("BRIDGE_OVERFLOW", "coalesce")
+
+# Discord event publisher: latest value per device is sent every interval;
+# the interval doubles when a send is held by Discord's rate limiter
+PUBLISH_MIN_INTERVAL: float = float(os.getenv("PUBLISH_MIN_INTERVAL", 1.0))
+PUBLISH_MAX_INTERVAL: float = float(os.getenv("PUBLISH_MAX_INTERVAL", 30.0))
+PUBLISH_SLOW_SEND: float = float(os.getenv("PUBLISH_SLOW_SEND", 1.0))  # seconds
+
+# Snapshot of registry + compiled rules for fast restarts ("" disables it)
+SNAPSHOT_PATH: str = os.getenv("SNAPSHOT_PATH", f"{SQLITE_DB}.snapshot")
+SNAPSHOT_INTERVAL: float = float(os.getenv("SNAPSHOT_INTERVAL", 60))  # 0 = only on stop
+
+# !ask / GET_STATE requests
+REQUEST_TIMEOUT: float = float(os.getenv("REQUEST_TIMEOUT", 5.0))  # seconds
+REQUEST_MAX_PENDING: int = int(os.getenv("REQUEST_MAX_PENDING", 16))  # per device
+
 # Misc
 DEBUG: bool = os.getenv("DEBUG", "0") == "1"
\ No newline at end of file
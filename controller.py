@@ -1,85 +1,246 @@
 """
-controller.py - recibe mensajes MQTT -> persiste -> notifica
+controller.py - recibe mensajes MQTT -> encola -> persiste por lotes -> notifica
 """
 
 from __future__ import annotations
-import datetime as dt
 import logging
-from typing import Callable, List
-
-from mqtt_client import MQTTClient
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from event_store import make_backend
+from ingest import IngestPool, ShardStats
+from mqtt_client import AsyncMQTTClient, MQTTClient
+from pending_requests import PendingRequests
+from registry import DeviceRegistry
+from topic_router import TopicRouter
+import config
 import persistence as db
+import snapshot
 
 logger = logging.getLogger(__name__)
 
 class Controller:
     def __init__(self, base_topic: str):
         self.base_topic = base_topic.rstrip("/")
-        self._mqtt = MQTTClient(on_message=self._handle_mqtt_message)
+        # MQTT_LOOP=asyncio: la red MQTT la mueve el bucle del bot (start() dentro del bucle)
+        client_cls = AsyncMQTTClient if config.MQTT_LOOP == "asyncio" else MQTTClient
+        self._mqtt = client_cls(on_message=self._handle_mqtt_message)
         self._subscribers: List[Callable[[db.Event], None]] = []
+        self.registry = DeviceRegistry()
+        # Dónde se guardan los eventos: EVENT_BACKEND (table | partitioned | log)
+        self.event_store = make_backend()
+        # En modo asyncio submit() corre en el bucle del bot: sin esperas con la cola llena
+        self._ingest = IngestPool(
+            notify=self._notify, registry=self.registry, backend=self.event_store,
+            put_timeout=0 if config.MQTT_LOOP == "asyncio" else None,
+        )
+        # Último mensaje (de cualquier subtopic) de cada dispositivo, epoch en segundos
+        self.last_seen: Dict[str, float] = {}
+
+        # Supresión de comandos repetidos: device_id -> (payload, instante)
+        self.dedup_window: float = config.COMMAND_DEDUP_WINDOW
+        self._last_command: Dict[str, Tuple[str, float]] = {}
+        self._command_lock = threading.Lock()
+        self.commands_sent = 0
+        self.commands_suppressed: Counter = Counter()  # por device_id
+
+        # Peticiones GET_STATE esperando respuesta (las resuelve _on_status / _on_ack)
+        self.requests = PendingRequests(config.REQUEST_TIMEOUT, config.REQUEST_MAX_PENDING)
+
+        # Snapshot para arrancar sin reconstruir todo desde SQLite. Cada
+        # componente aporta su sección (nombre -> función que la serializa)
+        self.snapshot_path: str = config.SNAPSHOT_PATH
+        self._snapshot_sections: Dict[str, Callable[[], Any]] = {"registry": self.registry.dump}
+        self.snapshot: Optional[Dict[str, Any]] = None  # secciones cargadas al arrancar
+        self.snapshot_load_ms: Optional[float] = None
+        self._snapshot_stop = threading.Event()
+
+        # Topics <base>/<device_id>/<subtopic>, compilados una vez en el router
+        self._router = TopicRouter()
+        self._started = False
+        self.route("status", self._on_status)
+        self.route("telemetry", self._on_telemetry)
+        self.route("heartbeat", self._on_heartbeat)
+        self.route("ack", self._on_ack)
 
     def start(self):
-        """Arranca la conexión MQTT y se suscribe a los topics de estado."""
+        """Arranca la conexión MQTT y se suscribe a los topics registrados."""
+        self._restore_state()
+        self.event_store.start()
+        self._ingest.start()
         self._mqtt.connect_and_start()
-        # Escucha <base>/<device_id>/status
-        self._mqtt.subscribe(f"{self.base_topic}/+/status")
+        for pattern in self._router.patterns:
+            self._mqtt.subscribe(pattern)
+        self._started = True
+        if self.snapshot_path and config.SNAPSHOT_INTERVAL > 0:
+            threading.Thread(target=self._snapshot_loop, name="snapshot", daemon=True).start()
+
+    # - Snapshot -
+    def _restore_state(self) -> None:
+        """
+        Carga el registro desde el snapshot si lo hay (y lo reconcilia con la
+        BD en segundo plano); si no, desde SQLite.
+        """
+        data = None
+        if self.snapshot_path:
+            t0 = time.perf_counter()
+            data = snapshot.load(self.snapshot_path)
+            if data and "registry" in data["sections"]:
+                self.registry.restore(data["sections"]["registry"])
+                self.snapshot = data["sections"]
+                self.snapshot_load_ms = (time.perf_counter() - t0) * 1000
+                logger.info("Snapshot %s cargado en %.1f ms: %d dispositivos (de hace %.0f s)",
+                            self.snapshot_path, self.snapshot_load_ms, len(self.registry),
+                            time.time() - data["written_at"])
+                threading.Thread(target=self._reconcile, name="registry-reconcile", daemon=True).start()
+                return
+        self.registry.load()
+
+    def _reconcile(self) -> None:
+        try:
+            added, removed = self.registry.reconcile()
+            logger.info("Registro reconciliado con la BD: %d altas, %d bajas desde el snapshot",
+                        added, removed)
+        except Exception:
+            logger.exception("Error reconciliando el registro con la BD")
+
+    def add_snapshot_section(self, name: str, dump: Callable[[], Any]) -> None:
+        """Incluye en cada snapshot el resultado de dump() (debe ser serializable con marshal)."""
+        self._snapshot_sections[name] = dump
+
+    def write_snapshot(self) -> int:
+        """Escribe el snapshot ahora. Devuelve su tamaño en bytes."""
+        sections = {name: dump() for name, dump in self._snapshot_sections.items()}
+        size = snapshot.save(self.snapshot_path, sections)
+        logger.debug("Snapshot escrito en %s (%d bytes)", self.snapshot_path, size)
+        return size
+
+    def _snapshot_loop(self) -> None:
+        while not self._snapshot_stop.wait(config.SNAPSHOT_INTERVAL):
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Error escribiendo el snapshot")
+
+    def route(self, subtopic: str, handler: Callable[[str, str], None]) -> None:
+        """
+        Registra handler(device_id, payload) para <base>/<device_id>/<subtopic>.
+        Admite comodines MQTT en subtopic (p.ej. "sensors/#").
+        """
+        pattern = f"{self.base_topic}/+/{subtopic}"
+        self._router.add(pattern, lambda caps, payload: handler(caps[0], payload))
+        if self._started:
+            self._mqtt.subscribe(pattern)
+
+    def stop(self):
+        """Corta MQTT, persiste lo que quede en la cola de ingesta y escribe el snapshot."""
+        self._mqtt.stop()
+        self._ingest.stop()
+        self.event_store.stop()
+        self._snapshot_stop.set()
+        if self.snapshot_path:
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Error escribiendo el snapshot final")
+
+    def flush(self) -> None:
+        """Espera a que los mensajes recibidos estén persistidos y notificados."""
+        self._ingest.flush()
+
+    def ingest_stats(self) -> List[ShardStats]:
+        """Profundidad de cola y latencia de cada shard de ingesta."""
+        return self._ingest.stats()
 
     def register_listener(self, callback: Callable[[db.Event], None]) -> None:
         """Permite que RuleEngine/Bridge se enteren de nuevos eventos."""
         self._subscribers.append(callback)
 
-    def send_command(self, device_id: str, payload: str) -> None:
+    def send_command(self, device_id: str, payload: str, dedup: bool = True) -> Optional[Future]:
         """
         Publica <base>/<device_id>/set con el payload especificado.
         Usado para conmutar interruptores (ON/OFF).
+
+        Devuelve el Future de la entrega (ver MQTTClient.publish): se
+        resuelve cuando el broker confirma el comando, con la latencia.
+
+        Si se envió el mismo payload a ese dispositivo hace menos de
+        COMMAND_DEDUP_WINDOW segundos, el comando se suprime (salvo dedup=False)
+        y se devuelve None.
         """
+        now = time.monotonic()
+        with self._command_lock:
+            last = self._last_command.get(device_id)
+            if dedup and last and last[0] == payload and now - last[1] < self.dedup_window:
+                self.commands_suppressed[device_id] += 1
+                logger.debug("Comando repetido suprimido: %s → %s", device_id, payload)
+                return None
+            self._last_command[device_id] = (payload, now)
+            self.commands_sent += 1
+
         topic = f"{self.base_topic}/{device_id}/set"
         logger.info("Publicando comando %s → %s", topic, payload)
-        self._mqtt.publish(topic, payload)
+        return self._mqtt.publish(topic, payload)
 
-    def request_status(self, device_id: str) -> None:
+    def request_status(self, device_id: str, correlation_id: Optional[str] = None) -> Future:
         """
-        Publica un mensaje para “preguntar” el estado actual al dispositivo
+        Publica un mensaje para “preguntar” el estado actual al dispositivo.
+
+        Devuelve un Future que se resuelve con un StatusReply (payload y RTT)
+        cuando llega el siguiente /status del dispositivo, o un /ack que
+        empiece por `correlation_id` si se indicó uno (se envía como
+        "GET_STATE <correlation_id>").
         """
         topic = f"{self.base_topic}/{device_id}"
-        query_payload = "GET_STATE"  # o algo similar
+        query_payload = f"GET_STATE {correlation_id}" if correlation_id else "GET_STATE"
+        fut = self.requests.add(device_id, correlation_id)
         logger.info("Pidiendo estado a %s => %s", device_id, query_payload)
-        self._mqtt.publish(topic, query_payload)
+        # Sin conexión, la petición no tiene sentido más allá de su timeout
+        self._mqtt.publish(topic, query_payload, ttl=self.requests.timeout)
+        return fut
+
+    def mqtt_status(self) -> str:
+        """Estado de la conexión MQTT: reconexiones, tiempo caído y cola offline."""
+        return self._mqtt.describe()
 
     def _handle_mqtt_message(self, topic: str, payload: str):
-        parts = topic.split("/")
-        if len(parts) != 5:
-            logger.warning("Topic mal formado (esperaba 5 partes): %s", topic)
-            return
+        if not self._router.dispatch(topic, payload):
+            logger.warning("Topic sin handler: %s (payload: %s)", topic, payload)
 
-        # parts[0] = redes2
-        # parts[1] = 9999 (grupo)
-        # parts[2] = 99   (pareja)
-        # parts[3] = device_id
-        # parts[4] = status (subtopic)
-        prefix = "/".join(parts[:3])  # "redes2/9999/99"
-        device_id = parts[3]
-        subtopic = parts[4]
-
-        if subtopic != "status":
-            logger.warning("Subtopic inesperado: %s (payload: %s)", subtopic, payload)
+    def _on_status(self, device_id: str, payload: str) -> None:
+        if device_id not in self.registry:
+            logger.warning("Mensaje ignorado: Dispositivo '%s' no registrado", device_id)
             return
-
-        with db.get_session() as session:
-            dev = session.query(db.Device).filter_by(device_id=device_id).one_or_none()
-            if not dev:
-                logger.warning("Mensaje ignorado: Dispositivo '%s' no registrado", device_id)
-                return
-
-            dev.last_state = payload
-            dev.last_updated = dt.datetime.utcnow()
-            session.commit()
-
-            event = db.Event(device_id=device_id, payload=payload)
-            session.add(event)
-            session.commit()
-
-        # Ahora sí notifica a los listeners
+        self.last_seen[device_id] = time.time()
+        self.requests.resolve(device_id, payload)
+
+        # La persistencia y la notificación se hacen por lotes en el shard
+        # del dispositivo, así el hilo de red de paho no espera a SQLite.
+        self._ingest.submit(device_id, payload)
+
+    def _on_telemetry(self, device_id: str, payload: str) -> None:
+        if device_id in self.registry:
+            self.last_seen[device_id] = time.time()
+            logger.debug("Telemetría de %s: %s", device_id, payload)
+
+    def _on_heartbeat(self, device_id: str, payload: str) -> None:
+        if device_id in self.registry:
+            self.last_seen[device_id] = time.time()
+
+    def _on_ack(self, device_id: str, payload: str) -> None:
+        if device_id in self.registry:
+            self.last_seen[device_id] = time.time()
+            logger.info("ACK de %s: %s", device_id, payload)
+            cid, _, rest = payload.partition(" ")
+            if cid:
+                self.requests.resolve(device_id, rest or payload, correlation_id=cid)
+
+    def _notify(self, event: db.Event) -> None:
         for cb in self._subscribers:
-            cb(event)
-
+            try:
+                cb(event)
+            except Exception:
+                logger.exception("Error en listener %r", cb)
@@ -0,0 +1,88 @@
+"""
+device_listing.py - Listados de dispositivos paginados y cacheados para Discord
+
+Renderizar miles de dispositivos en cada !devices es caro y no cabe en un
+mensaje. Las páginas ya renderizadas se guardan por filtro (tipo, estado)
+durante `ttl` segundos; un alta, baja o cambio de tipo en el registro
+(DeviceRegistry.version) las invalida al momento. Los últimos estados sí
+pueden quedar hasta `ttl` segundos atrasados.
+"""
+
+from __future__ import annotations
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import config
+from registry import DeviceInfo, DeviceRegistry
+
+# Límite de la descripción de un embed de Discord
+EMBED_LIMIT = 4096
+
+
+def render_line(info: DeviceInfo) -> str:
+    return f"• **{info.device_id}** ({info.device_type}) — último estado: `{info.last_state}`"
+
+
+@dataclass(frozen=True)
+class Listing:
+    """Resultado renderizado de un filtro: páginas de texto listas para enviar."""
+    pages: Tuple[str, ...]
+    total: int
+
+
+def paginate(lines: List[str], per_page: int, limit: int = EMBED_LIMIT) -> Tuple[str, ...]:
+    """Como mucho `per_page` líneas y `limit` caracteres por página."""
+    pages: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in lines:
+        extra = len(line) + (1 if current else 0)
+        if current and (len(current) >= per_page or size + extra > limit):
+            pages.append("\n".join(current))
+            current, size, extra = [], 0, len(line)
+        current.append(line)
+        size += extra
+    if current:
+        pages.append("\n".join(current))
+    return tuple(pages)
+
+
+class DeviceListingCache:
+    def __init__(
+        self,
+        registry: DeviceRegistry,
+        ttl: Optional[float] = None,
+        per_page: Optional[int] = None,
+    ) -> None:
+        self.registry = registry
+        self.ttl = config.DEVICE_LIST_TTL if ttl is None else ttl
+        self.per_page = per_page or config.DEVICE_LIST_PAGE_SIZE
+        # (tipo, estado) -> (versión del registro, instante, listado)
+        self._cache: Dict[Tuple[Optional[str], Optional[str]], Tuple[int, float, Listing]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_type: Optional[str] = None, state: Optional[str] = None) -> Listing:
+        key = (device_type and device_type.lower(), state and state.lower())
+        version = self.registry.version
+        now = time.monotonic()
+        hit = self._cache.get(key)
+        if hit and hit[0] == version and now - hit[1] < self.ttl:
+            self.hits += 1
+            return hit[2]
+        self.misses += 1
+        if hit and hit[0] != version:
+            # El conjunto de dispositivos cambió: ningún filtro sigue valiendo
+            self._cache.clear()
+        listing = self._render(*key)
+        self._cache[key] = (version, now, listing)
+        return listing
+
+    def _render(self, device_type: Optional[str], state: Optional[str]) -> Listing:
+        devices = sorted(self.registry.all(), key=lambda d: d.device_id)
+        if device_type:
+            devices = [d for d in devices if d.device_type.lower() == device_type]
+        if state:
+            devices = [d for d in devices if (d.last_state or "").lower() == state]
+        return Listing(paginate([render_line(d) for d in devices], self.per_page), len(devices))
@@ -0,0 +1,399 @@
+"""
+event_log.py - Registro de eventos binario, segmentado y de solo anexado (lectura por mmap)
+
+Cada segmento (events-NNNNNNNN.log) empieza con una cabecera de 8 bytes y
+después registros de tamaño fijo:
+
+    uint32 dispositivo · float64 timestamp · uint8 tipo · 3 bytes relleno · float64 valor
+
+Los device_id y los payloads no numéricos se internan en diccionarios de
+texto (devices.txt, strings.txt; una entrada JSON por línea, la línea es
+el índice), así que un registro siempre ocupa 24 bytes. Los payloads
+numéricos se guardan como float64 si se pueden reescribir igual a partir
+del valor; si no ("21.50"), como texto.
+
+Por segmento se mantiene un índice disperso por dispositivo: cada
+`index_stride` registros de un dispositivo se apunta (timestamp, nº de
+registro). Como los eventos de un dispositivo llegan en orden, basta una
+búsqueda binaria para acotar la zona del segmento que hay que recorrer.
+"""
+
+from __future__ import annotations
+import bisect
+import datetime as dt
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EVLOG001"
+RECORD = struct.Struct("<IdB3xd")
+KIND_NUM = 0
+KIND_TEXT = 1
+_READ_CHUNK = 4096   # registros por bloque al recorrer un segmento
+
+_SEGMENT_RE = re.compile(r"^events-(\d{8})\.log$")
+
+
+def _to_ts(created_at: dt.datetime) -> float:
+    return created_at.replace(tzinfo=dt.timezone.utc).timestamp()
+
+
+def _format_num(v: float) -> str:
+    return str(int(v)) if v.is_integer() else repr(v)
+
+
+def _encode_payload(payload: Optional[str]) -> Tuple[int, Optional[float]]:
+    """
+    (KIND_NUM, valor) si el payload es un número finito escrito tal como lo
+    reescribe _format_num; si no (KIND_TEXT, None). "21.50", "007" o "1e3"
+    van como texto para devolver exactamente lo que mandó el dispositivo.
+    """
+    try:
+        v = float(payload)
+    except (TypeError, ValueError):
+        return KIND_TEXT, None
+    if not math.isfinite(v) or _format_num(v) != payload:
+        return KIND_TEXT, None
+    return KIND_NUM, v
+
+
+class LogRecord(NamedTuple):
+    device_id: str
+    ts: float
+    value: Union[float, str]
+
+    @property
+    def created_at(self) -> dt.datetime:
+        return dt.datetime.utcfromtimestamp(self.ts)
+
+    @property
+    def payload(self) -> str:
+        v = self.value
+        return _format_num(v) if isinstance(v, float) else v
+
+
+class _Interner:
+    """Diccionario de texto append-only: valor <-> índice (nº de línea)."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.values: List[str] = []
+        self.ids: Dict[str, int] = {}
+        if os.path.exists(path):
+            good = 0   # bytes hasta la última línea completa
+            with open(path, "r+b") as fh:
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        break   # línea a medias de una escritura interrumpida
+                    self._add(json.loads(line))
+                    good += len(line)
+                if fh.seek(0, os.SEEK_END) != good:
+                    logger.warning("%s: descartada una entrada incompleta", path)
+                    fh.truncate(good)
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def _add(self, value: str) -> int:
+        idx = self.ids[value] = len(self.values)
+        self.values.append(value)
+        return idx
+
+    def intern(self, value: str, pending: List[str]) -> int:
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = self._add(value)
+            pending.append(json.dumps(value, ensure_ascii=False) + "\n")
+        return idx
+
+    def write(self, pending: List[str]) -> None:
+        if pending:
+            self._fh.write("".join(pending))
+            self._fh.flush()
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+@dataclass
+class _Segment:
+    seq: int
+    path: str
+    records: int = 0
+    min_ts: float = math.inf
+    max_ts: float = -math.inf
+    # dispositivo -> ([timestamps], [nº de registro]) muestreados
+    index: Dict[int, Tuple[List[float], List[int]]] = field(default_factory=dict)
+    # dispositivo -> registros vistos en el segmento (para el muestreo)
+    counts: Dict[int, int] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(MAGIC) + self.records * RECORD.size
+
+    @property
+    def index_path(self) -> str:
+        return self.path[:-4] + ".idx"
+
+    def note(self, device: int, ts: float, recno: int, stride: int) -> None:
+        n = self.counts.get(device, 0)
+        if n % stride == 0:
+            keys, pos = self.index.setdefault(device, ([], []))
+            keys.append(ts)
+            pos.append(recno)
+        self.counts[device] = n + 1
+        if ts < self.min_ts:
+            self.min_ts = ts
+        if ts > self.max_ts:
+            self.max_ts = ts
+
+    def bounds(self, device: int, start: float, end: float) -> Tuple[int, int]:
+        """Rango [desde, hasta) de registros que puede contener al dispositivo entre start y end."""
+        keys, pos = self.index.get(device, ((), ()))
+        if not keys:
+            return 0, 0
+        i = bisect.bisect_left(keys, start) - 1
+        lo = pos[i] if i >= 0 else pos[0]
+        j = bisect.bisect_right(keys, end)
+        hi = pos[j] if j < len(pos) else self.records
+        return lo, hi
+
+    def save_index(self) -> None:
+        data = {
+            "records": self.records,
+            "min_ts": self.min_ts,
+            "max_ts": self.max_ts,
+            "index": {str(d): [k, p] for d, (k, p) in self.index.items()},
+            "counts": {str(d): n for d, n in self.counts.items()},
+        }
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(data, fh)
+        os.replace(tmp, self.index_path)
+
+    def load_index(self) -> bool:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if data["records"] != self.records:
+            return False
+        self.min_ts, self.max_ts = data["min_ts"], data["max_ts"]
+        self.index = {int(d): (k, p) for d, (k, p) in data["index"].items()}
+        self.counts = {int(d): n for d, n in data["counts"].items()}
+        return True
+
+
+class EventLog:
+    """
+    Registro de eventos en disco. append() es seguro entre hilos (un cerrojo
+    serializa escrituras); las lecturas mapean cada segmento con mmap hasta
+    el tamaño confirmado en ese momento y no bloquean a los escritores.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 64 * 1024 * 1024,
+        index_stride: int = 64,
+        fsync: bool = False,
+    ) -> None:
+        self.directory = directory
+        self.segment_bytes = max(segment_bytes, len(MAGIC) + RECORD.size)
+        self.index_stride = max(1, index_stride)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._devices = _Interner(os.path.join(directory, "devices.txt"))
+        self._strings = _Interner(os.path.join(directory, "strings.txt"))
+        self._segments: List[_Segment] = []
+        self._fh = None
+        self._open()
+
+    # - Apertura y recuperación -
+    def _open(self) -> None:
+        seqs = sorted(
+            int(m.group(1)) for m in map(_SEGMENT_RE.match, os.listdir(self.directory)) if m
+        )
+        for seq in seqs:
+            seg = _Segment(seq, self._segment_path(seq))
+            size = os.path.getsize(seg.path)
+            records, torn = divmod(max(size - len(MAGIC), 0), RECORD.size)
+            if size < len(MAGIC) or torn:
+                # Registro a medias de una escritura interrumpida: se descarta
+                with open(seg.path, "r+b") as fh:
+                    if size < len(MAGIC):
+                        fh.truncate(0)
+                        fh.write(MAGIC)
+                    else:
+                        fh.truncate(len(MAGIC) + records * RECORD.size)
+                logger.warning("Segmento %s truncado tras una escritura incompleta", seg.path)
+            seg.records = records
+            if not seg.load_index():
+                self._rebuild_index(seg)
+            self._segments.append(seg)
+        if not self._segments:
+            self._new_segment(0)
+        else:
+            self._fh = open(self._segments[-1].path, "ab", buffering=0)
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"events-{seq:08d}.log")
+
+    def _rebuild_index(self, seg: _Segment) -> None:
+        seg.index.clear()
+        seg.counts.clear()
+        for recno, (device, ts, _kind, _value) in enumerate(self._iter_segment(seg, 0, seg.records)):
+            seg.note(device, ts, recno, self.index_stride)
+
+    def _new_segment(self, seq: int) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._segments[-1].save_index()
+        seg = _Segment(seq, self._segment_path(seq))
+        self._fh = open(seg.path, "ab", buffering=0)
+        self._fh.write(MAGIC)
+        self._segments.append(seg)
+
+    # - Escritura -
+    def append(self, events: Iterable[Tuple[str, dt.datetime, Optional[str]]]) -> int:
+        """Anexa (device_id, created_at, payload). Devuelve cuántos registros escribió."""
+        with self._lock:
+            new_devices: List[str] = []
+            new_strings: List[str] = []
+            packed = []
+            for device_id, created_at, payload in events:
+                device = self._devices.intern(device_id, new_devices)
+                kind, value = _encode_payload(payload)
+                if kind == KIND_TEXT:
+                    value = float(self._strings.intern(payload or "", new_strings))
+                packed.append((device, _to_ts(created_at), kind, value))
+            if not packed:
+                return 0
+            # Los diccionarios van antes que los registros que los referencian
+            self._devices.write(new_devices)
+            self._strings.write(new_strings)
+
+            i = 0
+            while i < len(packed):
+                seg = self._segments[-1]
+                room = (self.segment_bytes - seg.size) // RECORD.size
+                if room <= 0:
+                    self._new_segment(seg.seq + 1)
+                    continue
+                chunk = packed[i:i + room]
+                self._fh.write(b"".join(RECORD.pack(*rec) for rec in chunk))
+                for rec in chunk:
+                    seg.note(rec[0], rec[1], seg.records, self.index_stride)
+                    seg.records += 1
+                i += len(chunk)
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+            return len(packed)
+
+    # - Lectura -
+    def _iter_segment(
+        self, seg: _Segment, lo: int, hi: int, reverse: bool = False
+    ) -> Iterator[Tuple[int, float, int, float]]:
+        if hi <= lo:
+            return
+        with open(seg.path, "rb") as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Por bloques: cada slice copia sólo un trozo de páginas ya mapeadas
+                start = len(MAGIC) + lo * RECORD.size
+                end = len(MAGIC) + hi * RECORD.size
+                step = _READ_CHUNK * RECORD.size
+                if not reverse:
+                    while start < end:
+                        yield from RECORD.iter_unpack(mm[start:min(start + step, end)])
+                        start += step
+                    return
+                while end > start:
+                    pos = max(end - step, start)
+                    yield from reversed(list(RECORD.iter_unpack(mm[pos:end])))
+                    end = pos
+
+    def _snapshot(self) -> List[Tuple[_Segment, int]]:
+        with self._lock:
+            return [(seg, seg.records) for seg in self._segments]
+
+    def _decode(self, device: int, ts: float, kind: int, value: float) -> LogRecord:
+        if kind == KIND_TEXT:
+            return LogRecord(self._devices.values[device], ts, self._strings.values[int(value)])
+        return LogRecord(self._devices.values[device], ts, value)
+
+    def replay(self, since: Optional[dt.datetime] = None) -> Iterator[LogRecord]:
+        """Todos los eventos en orden de escritura (desde `since`, si se indica)."""
+        start = _to_ts(since) if since else -math.inf
+        for seg, records in self._snapshot():
+            if seg.max_ts < start:
+                continue
+            for device, ts, kind, value in self._iter_segment(seg, 0, records):
+                if ts >= start:
+                    yield self._decode(device, ts, kind, value)
+
+    def scan(
+        self,
+        device_id: str,
+        start: Optional[dt.datetime] = None,
+        end: Optional[dt.datetime] = None,
+        reverse: bool = False,
+    ) -> Iterator[LogRecord]:
+        """
+        Eventos de `device_id` con start <= created_at <= end, en orden (del
+        más reciente al más antiguo con reverse=True, recorriendo los
+        segmentos hacia atrás por bloques, sin cargar el rango entero).
+        """
+        device = self._devices.ids.get(device_id)
+        if device is None:
+            return
+        t0 = _to_ts(start) if start else -math.inf
+        t1 = _to_ts(end) if end else math.inf
+        segments = self._snapshot()
+        if reverse:
+            segments.reverse()
+        for seg, records in segments:
+            if seg.max_ts < t0 or seg.min_ts > t1:
+                continue
+            lo, hi = seg.bounds(device, t0, t1)
+            for dev, ts, kind, value in self._iter_segment(seg, lo, min(hi, records), reverse):
+                if dev == device and t0 <= ts <= t1:
+                    yield self._decode(dev, ts, kind, value)
+
+    def devices(self) -> List[str]:
+        return list(self._devices.values)
+
+    # - Retención -
+    def drop_before(self, cutoff: dt.datetime) -> int:
+        """Borra los segmentos cerrados cuyo último evento es anterior a `cutoff`."""
+        limit = _to_ts(cutoff)
+        with self._lock:
+            expired = [seg for seg in self._segments[:-1] if seg.max_ts < limit]
+            for seg in expired:
+                self._segments.remove(seg)
+        for seg in expired:
+            for path in (seg.path, seg.index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            logger.info("Segmento %s eliminado por retención", seg.path)
+        return len(expired)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+                self._segments[-1].save_index()
+            self._devices.close()
+            self._strings.close()
@@ -0,0 +1,438 @@
+"""
+event_store.py - Backends de almacenamiento de eventos (tabla única o particionada por día)
+"""
+
+from __future__ import annotations
+import datetime as dt
+import heapq
+import itertools
+import logging
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import (
+    Column, DateTime, Float, Index, Integer, MetaData, String, Table, inspect, insert, select, text,
+    tuple_,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import config
+import persistence as db
+from event_log import EventLog
+from payload_types import NUM, classify
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryRow(NamedTuple):
+    device_id: str
+    created_at: dt.datetime
+    payload: str
+    value_kind: Optional[str] = None
+    value_num: Optional[float] = None
+
+
+def _keyset(
+    table: Table,
+    device_id: str,
+    since: Optional[dt.datetime],
+    until: Optional[dt.datetime],
+    newest_first: bool,
+    page_size: int,
+) -> Iterator[HistoryRow]:
+    """
+    Recorre los eventos de un dispositivo por páginas con paginación keyset
+    sobre (created_at, id): cada página continúa tras la última clave vista,
+    usando el índice (device_id, created_at) en vez de un OFFSET creciente.
+    Cada página abre y cierra su sesión, así que el generador puede
+    consumirse poco a poco y desde hilos distintos.
+    """
+    key = tuple_(table.c.created_at, table.c.id)
+    base = (
+        select(table.c.id, table.c.payload, table.c.created_at, table.c.value_kind, table.c.value_num)
+        .where(table.c.device_id == device_id)
+    )
+    if since is not None:
+        base = base.where(table.c.created_at >= since)
+    if until is not None:
+        base = base.where(table.c.created_at <= until)
+    if newest_first:
+        base = base.order_by(table.c.created_at.desc(), table.c.id.desc())
+    else:
+        base = base.order_by(table.c.created_at, table.c.id)
+
+    last = None
+    while True:
+        stmt = base
+        if last is not None:
+            stmt = stmt.where(key < last if newest_first else key > last)
+        with db.get_session() as s:
+            page = s.execute(stmt.limit(page_size)).all()
+        for id_, payload, created_at, kind, value in page:
+            yield HistoryRow(device_id, created_at, payload, kind, value)
+        if len(page) < page_size:
+            return
+        last = tuple_(page[-1].created_at, page[-1].id)
+
+
+class EventBackend(ABC):
+    """
+    Dónde guarda la ingesta los Event de cada lote. write() se llama dentro
+    de la transacción del lote, junto al UPDATE de last_state.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def write(self, session: Session, events: List[db.Event]) -> None:
+        ...
+
+    def history(
+        self,
+        device_id: str,
+        since: Optional[dt.datetime] = None,
+        until: Optional[dt.datetime] = None,
+        limit: Optional[int] = None,
+        newest_first: bool = False,
+    ) -> Iterator[HistoryRow]:
+        """
+        Eventos de `device_id` entre since y until (inclusive), como mucho
+        `limit`. Es un generador: las filas se leen por páginas según se
+        consumen, nunca todas a la vez.
+        """
+        rows = self._history(device_id, since, until, newest_first)
+        return itertools.islice(rows, limit) if limit is not None else rows
+
+    @abstractmethod
+    def _history(self, device_id, since, until, newest_first) -> Iterator[HistoryRow]:
+        ...
+
+    def start(self) -> None:
+        """Arranca tareas de mantenimiento, si las hay."""
+
+    def stop(self) -> None:
+        """Detiene las tareas de mantenimiento."""
+
+
+class TableEventBackend(EventBackend):
+    """Comportamiento clásico: todos los eventos en la tabla 'events'."""
+
+    name = "table"
+
+    def write(self, session: Session, events: List[db.Event]) -> None:
+        session.add_all(events)
+
+    def _history(self, device_id, since, until, newest_first) -> Iterator[HistoryRow]:
+        return _keyset(db.Event.__table__, device_id, since, until, newest_first,
+                       config.HISTORY_PAGE_SIZE)
+
+
+_PARTITION_RE = re.compile(r"^events_(\d{8})$")
+
+
+def partition_name(day: dt.date) -> str:
+    return f"events_{day:%Y%m%d}"
+
+
+class PartitionedEventBackend(EventBackend):
+    """
+    Una tabla por día (events_YYYYMMDD) en la misma BD.
+
+    Pasados `retention_days`, cada partición se resume en 'event_rollups'
+    (count/min/max/avg por dispositivo y cubeta de `rollup_seconds`) y se
+    elimina con un DROP TABLE en la misma transacción: no hay DELETE masivo
+    ni mantenimiento de índices sobre una tabla gigante, y SQLite reutiliza
+    las páginas liberadas para las particiones nuevas.
+    """
+
+    name = "partitioned"
+
+    def __init__(
+        self,
+        retention_days: Optional[int] = None,
+        rollup_seconds: Optional[int] = None,
+        maintenance_interval: Optional[float] = None,
+    ) -> None:
+        self.retention_days = retention_days or config.EVENT_RETENTION_DAYS
+        self.rollup_seconds = rollup_seconds or config.EVENT_ROLLUP_SECONDS
+        self.maintenance_interval = maintenance_interval or config.EVENT_MAINTENANCE_INTERVAL
+        self._metadata = MetaData()
+        self._created: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # - Tablas -
+    def table(self, name: str) -> Table:
+        with self._lock:
+            table = self._metadata.tables.get(name)
+            if table is None:
+                table = Table(
+                    name, self._metadata,
+                    Column("id", Integer, primary_key=True),
+                    Column("device_id", String, nullable=False),
+                    Column("payload", String),
+                    Column("created_at", DateTime, nullable=False),
+                    Column("value_kind", String),
+                    Column("value_num", Float),
+                    Index(f"ix_{name}_device_created", "device_id", "created_at"),
+                )
+            return table
+
+    def partitions(self, session: Session) -> List[Tuple[dt.date, str]]:
+        """Particiones existentes, de la más antigua a la más reciente."""
+        found = []
+        for name in inspect(session.connection()).get_table_names():
+            m = _PARTITION_RE.match(name)
+            if m:
+                found.append((dt.datetime.strptime(m.group(1), "%Y%m%d").date(), name))
+        return sorted(found)
+
+    def _cutoff(self, now: Optional[dt.datetime] = None) -> dt.date:
+        return (now or dt.datetime.utcnow()).date() - dt.timedelta(days=self.retention_days)
+
+    # - Escritura -
+    def write(self, session: Session, events: List[db.Event]) -> None:
+        cutoff = self._cutoff()
+        by_day: Dict[dt.date, List[dict]] = defaultdict(list)
+        for ev in events:
+            day = ev.created_at.date()
+            if day < cutoff:
+                # Su partición ya se resumió y borró
+                logger.debug("Evento fuera de retención descartado: %s %s", ev.device_id, ev.created_at)
+                continue
+            by_day[day].append({
+                "device_id": ev.device_id, "payload": ev.payload, "created_at": ev.created_at,
+                "value_kind": ev.value_kind, "value_num": ev.value_num,
+            })
+
+        conn = session.connection()
+        for day, rows in by_day.items():
+            conn.execute(insert(self._ready(conn, partition_name(day))), rows)
+
+    def _ready(self, conn, name: str) -> Table:
+        """
+        Tabla de la partición, creada si no existe y con las columnas que
+        añadieron versiones posteriores (una vez por proceso y partición).
+        """
+        table = self.table(name)
+        if name not in self._created:
+            # Varios shards pueden estrenar la partición del día a la vez: IF NOT
+            # EXISTS se evalúa ya con el cerrojo de escritura de SQLite, así que
+            # el que llega segundo no falla (checkfirst miraba antes de esperarlo)
+            conn.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+            existing = {c["name"] for c in inspect(conn).get_columns(name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    try:
+                        conn.execute(text(
+                            f"ALTER TABLE {name} ADD COLUMN {col.name} {col.type.compile(conn.dialect)}"
+                        ))
+                    except OperationalError as exc:
+                        if "duplicate column" not in str(exc):
+                            raise
+            self._created.add(name)
+        return table
+
+    def _history(self, device_id, since, until, newest_first) -> Iterator[HistoryRow]:
+        # Sólo las particiones de los días del rango, en el orden pedido
+        with db.get_session() as s:
+            parts = [
+                name for day, name in self.partitions(s)
+                if (since is None or day >= since.date()) and (until is None or day <= until.date())
+            ]
+            for name in parts:
+                self._ready(s.connection(), name)
+            s.commit()
+        # La tabla 'events' guarda lo escrito antes de pasar a particiones:
+        # va antes que cualquier partición
+        tables = [db.Event.__table__] + [self.table(name) for name in parts]
+        if newest_first:
+            tables.reverse()
+        for table in tables:
+            yield from _keyset(table, device_id, since, until, newest_first,
+                               config.HISTORY_PAGE_SIZE)
+
+    # - Mantenimiento -
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception("Error en el mantenimiento de particiones de eventos")
+            if self._stop.wait(self.maintenance_interval):
+                return
+
+    def maintain(self, now: Optional[dt.datetime] = None) -> int:
+        """
+        Crea por adelantado la partición de mañana y resume y elimina las que
+        quedan fuera de retención. Devuelve cuántas se eliminaron.
+        """
+        cutoff = self._cutoff(now)
+        tomorrow = (now or dt.datetime.utcnow()).date() + dt.timedelta(days=1)
+        with db.get_session() as s:
+            self._ready(s.connection(), partition_name(tomorrow))
+            s.commit()
+            expired = [name for day, name in self.partitions(s) if day < cutoff]
+        for name in expired:
+            self._rollup_and_drop(name)
+        return len(expired)
+
+    def _rollup_and_drop(self, name: str) -> None:
+        size = self.rollup_seconds
+        # (device_id, inicio de cubeta) -> [count, n, min, max, suma, último payload]
+        acc: Dict[Tuple[str, int], list] = {}
+
+        with db.get_session() as s:
+            table = self._ready(s.connection(), name)
+            rows = s.execute(
+                select(table.c.device_id, table.c.payload, table.c.created_at,
+                       table.c.value_kind, table.c.value_num)
+                .order_by(table.c.id)
+                .execution_options(yield_per=5000)
+            )
+            for device_id, payload, created_at, kind, v in rows:
+                ts = created_at.replace(tzinfo=dt.timezone.utc).timestamp()
+                key = (device_id, int(ts // size * size))
+                a = acc.get(key)
+                if a is None:
+                    a = acc[key] = [0, 0, None, None, 0.0, None]
+                a[0] += 1
+                a[5] = payload
+                if kind is None:
+                    # Filas anteriores a las columnas tipadas
+                    kind, v = classify(payload)
+                if kind != NUM:
+                    continue
+                a[1] += 1
+                a[2] = v if a[2] is None else min(a[2], v)
+                a[3] = v if a[3] is None else max(a[3], v)
+                a[4] += v
+
+            if acc:
+                s.execute(insert(db.EventRollup), [
+                    {
+                        "device_id": device_id,
+                        "bucket_start": dt.datetime.utcfromtimestamp(start),
+                        "bucket_seconds": size,
+                        "count": a[0],
+                        "value_count": a[1],
+                        "value_min": a[2],
+                        "value_max": a[3],
+                        "value_avg": a[4] / a[1] if a[1] else None,
+                        "last_payload": a[5],
+                    }
+                    for (device_id, start), a in acc.items()
+                ])
+            table.drop(s.connection())
+            s.commit()
+
+        self._created.discard(name)
+        with self._lock:
+            self._metadata.remove(table)
+        logger.info("Partición %s resumida en %d cubetas y eliminada", name, len(acc))
+
+
+def _log_row(r) -> HistoryRow:
+    # El registro guarda los números como float; el resto se clasifica al leer
+    if isinstance(r.value, float):
+        return HistoryRow(r.device_id, r.created_at, r.payload, NUM, r.value)
+    return HistoryRow(r.device_id, r.created_at, r.payload, *classify(r.value))
+
+
+class LogEventBackend(EventBackend):
+    """
+    Eventos en un registro binario append-only (ver event_log.py) en vez de
+    una fila ORM por lectura. La BD sólo recibe el UPDATE de last_state.
+
+    El anexado ocurre antes del commit del lote: si el commit falla, los
+    eventos quedan en el registro aunque last_state no se actualice.
+    """
+
+    name = "log"
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        retention_days: Optional[int] = None,
+        maintenance_interval: Optional[float] = None,
+    ) -> None:
+        self.log = EventLog(
+            directory or config.EVENT_LOG_DIR,
+            segment_bytes=config.EVENT_LOG_SEGMENT_BYTES,
+            index_stride=config.EVENT_LOG_INDEX_STRIDE,
+            fsync=config.EVENT_LOG_FSYNC,
+        )
+        self.retention_days = retention_days or config.EVENT_RETENTION_DAYS
+        self.maintenance_interval = maintenance_interval or config.EVENT_MAINTENANCE_INTERVAL
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def write(self, session: Session, events: List[db.Event]) -> None:
+        self.log.append((ev.device_id, ev.created_at, ev.payload) for ev in events)
+
+    def _history(self, device_id, since, until, newest_first) -> Iterator[HistoryRow]:
+        logged = (_log_row(r) for r in self.log.scan(device_id, since, until, reverse=newest_first))
+        # Lo escrito en 'events' antes de pasar al registro sigue en el
+        # historial: se intercala por instante, leyéndolo también por páginas
+        legacy = _keyset(db.Event.__table__, device_id, since, until, newest_first,
+                         config.HISTORY_PAGE_SIZE)
+        return heapq.merge(legacy, logged, key=lambda r: r.created_at, reverse=newest_first)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-log-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.log.close()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.maintenance_interval):
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception("Error en la retención del registro de eventos")
+
+    def maintain(self, now: Optional[dt.datetime] = None) -> int:
+        """Borra los segmentos fuera de retención. Devuelve cuántos."""
+        cutoff = (now or dt.datetime.utcnow()) - dt.timedelta(days=self.retention_days)
+        return self.log.drop_before(cutoff)
+
+
+BACKENDS = {
+    TableEventBackend.name: TableEventBackend,
+    PartitionedEventBackend.name: PartitionedEventBackend,
+    LogEventBackend.name: LogEventBackend,
+}
+
+
+def make_backend(name: Optional[str] = None) -> EventBackend:
+    """Crea el backend configurado en EVENT_BACKEND."""
+    name = name or config.EVENT_BACKEND
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"EVENT_BACKEND desconocido: {name} (usa {', '.join(BACKENDS)})") from None
@@ -0,0 +1,88 @@
+"""
+export.py - Exportación columnar del historial numérico de un dispositivo
+
+En vez de iterar objetos ORM, el historial se vuelca a dos array('d')
+contiguos (timestamps UNIX y valores), listos para numpy.frombuffer o para
+escribirse tal cual a disco en un fichero columnar compacto:
+
+    b"EVCOL001" · uint32 nº de filas · uint16 longitud del device_id · device_id (UTF-8)
+    · float64[n] timestamps · float64[n] valores            (todo little-endian)
+"""
+
+from __future__ import annotations
+import datetime as dt
+import struct
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import BinaryIO, Optional
+
+from event_store import EventBackend
+
+MAGIC = b"EVCOL001"
+_HEADER = struct.Struct("<IH")
+
+
+@dataclass
+class Columns:
+    """Historial numérico de un dispositivo en columnas."""
+    device_id: str
+    timestamps: array = field(default_factory=lambda: array("d"))  # segundos UNIX (UTC)
+    values: array = field(default_factory=lambda: array("d"))
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+
+def export_columns(
+    backend: EventBackend,
+    device_id: str,
+    since: Optional[dt.datetime] = None,
+    until: Optional[dt.datetime] = None,
+) -> Columns:
+    """
+    Lee el historial por páginas (EventBackend.history) y se queda con las
+    filas que tienen valor numérico (números, booleanos como 1/0 y horas
+    como segundos desde medianoche); los payloads de texto se omiten.
+    """
+    cols = Columns(device_id)
+    ts_append, val_append = cols.timestamps.append, cols.values.append
+    utc = dt.timezone.utc
+    for row in backend.history(device_id, since, until):
+        if row.value_num is None:
+            continue
+        ts_append(row.created_at.replace(tzinfo=utc).timestamp())
+        val_append(row.value_num)
+    return cols
+
+
+def _le(data: array) -> array:
+    if sys.byteorder == "little":
+        return data
+    swapped = array("d", data)
+    swapped.byteswap()
+    return swapped
+
+
+def write_columns(cols: Columns, fh: BinaryIO) -> None:
+    name = cols.device_id.encode("utf-8")
+    fh.write(MAGIC)
+    fh.write(_HEADER.pack(len(cols), len(name)))
+    fh.write(name)
+    fh.write(_le(cols.timestamps).tobytes())
+    fh.write(_le(cols.values).tobytes())
+
+
+def read_columns(fh: BinaryIO) -> Columns:
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise ValueError("No es un fichero de exportación columnar")
+    count, name_len = _HEADER.unpack(fh.read(_HEADER.size))
+    cols = Columns(fh.read(name_len).decode("utf-8"))
+    cols.timestamps.frombytes(fh.read(count * 8))
+    cols.values.frombytes(fh.read(count * 8))
+    if len(cols.timestamps) != count or len(cols.values) != count:
+        raise ValueError("Fichero de exportación truncado")
+    if sys.byteorder != "little":
+        cols.timestamps.byteswap()
+        cols.values.byteswap()
+    return cols
@@ -0,0 +1,125 @@
+"""
+handoff.py - Cola acotada para pasar eventos de hilos (ingesta, paho) al bucle asyncio
+
+asyncio.Queue no es segura entre hilos y, sin límite, crece sin freno si
+Discord va lento. LoopHandoff guarda los elementos tras un cerrojo en una
+estructura acotada y sólo usa loop.call_soon_threadsafe para despertar al
+consumidor cuando la cola pasa de vacía a no vacía, así que tampoco se
+acumulan callbacks en el bucle.
+
+Políticas al llenarse:
+  drop_oldest  se descarta el elemento más antiguo para hacer sitio
+  drop_newest  se descarta el que llega
+  coalesce     un elemento sustituye al pendiente con la misma clave
+               (p.ej. device_id) sin cambiar su posición; si la clave es
+               nueva y no cabe, se descarta el más antiguo
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "drop_newest", "coalesce")
+
+
+@dataclass
+class HandoffStats:
+    put: int = 0          # elementos ofrecidos
+    dropped: int = 0      # perdidos por desbordamiento
+    coalesced: int = 0    # sustituidos por uno más reciente con la misma clave
+    high_water: int = 0   # máxima ocupación observada
+
+
+class LoopHandoff:
+    """
+    put() desde cualquier hilo; get()/get_nowait() desde el bucle `loop`
+    (misma interfaz que asyncio.Queue para el consumidor).
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int,
+        policy: str = "drop_oldest",
+        key: Optional[Callable[[Any], Hashable]] = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Política no soportada: {policy} (usa {', '.join(POLICIES)})")
+        if policy == "coalesce" and key is None:
+            raise ValueError("La política 'coalesce' necesita una función key")
+        if maxsize <= 0:
+            raise ValueError("maxsize debe ser positivo")
+        self._loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self._key = key
+        self._lock = threading.Lock()
+        self._items = OrderedDict() if policy == "coalesce" else deque()
+        self._ready = asyncio.Event()
+        self.stats = HandoffStats()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    # - Productores (cualquier hilo) -
+    def put(self, item: Any) -> bool:
+        """Encola sin bloquear. Devuelve False si `item` se descartó."""
+        with self._lock:
+            stats = self.stats
+            stats.put += 1
+            items = self._items
+            was_empty = not items
+            if self.policy == "coalesce":
+                k = self._key(item)
+                if k in items:
+                    items[k] = item
+                    stats.coalesced += 1
+                    return True
+                if len(items) >= self.maxsize:
+                    items.popitem(last=False)
+                    stats.dropped += 1
+                items[k] = item
+            elif len(items) >= self.maxsize:
+                stats.dropped += 1
+                if self.policy == "drop_newest":
+                    return False
+                items.popleft()
+                items.append(item)
+            else:
+                items.append(item)
+            if len(items) > stats.high_water:
+                stats.high_water = len(items)
+        if was_empty:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                # El bucle ya se cerró (apagado): nadie va a consumir
+                logger.debug("Bucle cerrado; evento descartado")
+                return False
+        return True
+
+    # - Consumidor (hilo del bucle) -
+    def get_nowait(self) -> Any:
+        with self._lock:
+            if not self._items:
+                self._ready.clear()
+                raise asyncio.QueueEmpty
+            if self.policy == "coalesce":
+                return self._items.popitem(last=False)[1]
+            return self._items.popleft()
+
+    async def get(self) -> Any:
+        while True:
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                await self._ready.wait()
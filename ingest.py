@@ -0,0 +1,332 @@
+"""
+ingest.py - Etapa de ingesta write-behind entre el callback MQTT y SQLite
+"""
+
+from __future__ import annotations
+import datetime as dt
+import logging
+import queue
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, update
+
+import config
+import persistence as db
+from event_store import EventBackend, TableEventBackend
+from payload_types import classify
+from registry import DeviceRegistry
+
+logger = logging.getLogger(__name__)
+
+# Marcas internas de la cola (nunca llegan a la BD)
+_FLUSH = object()
+_STOP = object()
+
+
+@dataclass
+class StatusMessage:
+    """Mensaje de estado recibido por MQTT, pendiente de persistir."""
+    device_id: str
+    payload: str
+    received_at: dt.datetime
+    enqueued: float  # time.monotonic() al encolar, para medir latencia
+
+
+@dataclass
+class ShardStats:
+    """Foto de las métricas de un escritor de ingesta."""
+    name: str
+    queue_depth: int
+    processed: int
+    dropped: int
+    batches: int
+    avg_latency_ms: float  # media móvil exponencial encolado -> notificado
+    max_latency_ms: float
+
+
+class IngestWriter:
+    """
+    Saca los mensajes del hilo de red de paho a una cola acotada y los
+    persiste por lotes (group commit) desde un hilo escritor propio.
+
+    Cada lote se escribe en una única transacción: inserción masiva de los
+    Event (en el EventBackend configurado) y un solo UPDATE de last_state
+    por dispositivo. Los listeners se
+    notifican después del commit y en el mismo orden de llegada.
+    """
+
+    def __init__(
+        self,
+        notify: Callable[[db.Event], None],
+        registry: DeviceRegistry,
+        backend: Optional[EventBackend] = None,
+        flush_size: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        queue_size: Optional[int] = None,
+        name: str = "ingest-writer",
+        put_timeout: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self._notify = notify
+        self._registry = registry
+        self._backend = backend or TableEventBackend()
+        self.flush_size = flush_size or config.INGEST_FLUSH_SIZE
+        self.flush_interval = (
+            config.INGEST_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        )
+        self._q: queue.Queue = queue.Queue(maxsize=queue_size or config.INGEST_QUEUE_SIZE)
+        # Espera máxima con la cola llena; 0 = descartar al momento (p.ej. si
+        # submit se llama desde el bucle asyncio, que no debe bloquearse)
+        self.put_timeout = config.INGEST_PUT_TIMEOUT if put_timeout is None else put_timeout
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+        self.processed = 0
+        self.batches = 0
+        self._latency_avg = 0.0
+        self._latency_max = 0.0
+
+    def start(self) -> None:
+        """Arranca el hilo escritor."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Persiste lo pendiente y detiene el hilo escritor."""
+        if self._thread and self._thread.is_alive():
+            self._q.put(_STOP)
+            self._thread.join()
+        self._thread = None
+
+    def submit(self, device_id: str, payload: str) -> bool:
+        """
+        Encola un mensaje de estado. Se llama desde el hilo de paho (o el
+        bucle asyncio), así que no toca la BD; si la cola sigue llena tras
+        `put_timeout` segundos se descarta el mensaje.
+        """
+        msg = StatusMessage(device_id, payload, dt.datetime.utcnow(), time.monotonic())
+        try:
+            if self.put_timeout > 0:
+                self._q.put(msg, timeout=self.put_timeout)
+            else:
+                self._q.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Cola de ingesta llena: descartado mensaje de '%s'", device_id)
+            return False
+        return True
+
+    def flush(self) -> None:
+        """
+        Bloquea hasta que todo lo encolado esté persistido y notificado.
+        No debe llamarse desde un listener (se ejecutan en el hilo escritor).
+        """
+        if self._thread and self._thread.is_alive():
+            self._q.put(_FLUSH)
+            self._q.join()
+            return
+        # Sin hilo escritor (p.ej. antes de start): vaciamos en este hilo
+        batch: List[StatusMessage] = []
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            self._q.task_done()
+            if isinstance(item, StatusMessage):
+                batch.append(item)
+        if batch:
+            self._write_retrying(batch)
+
+    @property
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    def stats(self) -> ShardStats:
+        return ShardStats(
+            name=self.name,
+            queue_depth=self._q.qsize(),
+            processed=self.processed,
+            dropped=self.dropped,
+            batches=self.batches,
+            avg_latency_ms=self._latency_avg * 1000,
+            max_latency_ms=self._latency_max * 1000,
+        )
+
+    # - Hilo escritor -
+    def _run(self) -> None:
+        while True:
+            first = self._q.get()
+            batch, taken, stop = self._collect(first)
+            try:
+                if batch:
+                    self._write_retrying(batch)
+            finally:
+                for _ in range(taken):
+                    self._q.task_done()
+            if stop:
+                return
+
+    def _collect(self, item) -> Tuple[List[StatusMessage], int, bool]:
+        """
+        Agrupa mensajes hasta llenar flush_size o agotar flush_interval.
+        Devuelve (lote, elementos sacados de la cola, hay que parar).
+        """
+        batch: List[StatusMessage] = []
+        taken = 1
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if item is _STOP:
+                return batch, taken, True
+            if item is _FLUSH:
+                break
+            batch.append(item)
+            if len(batch) >= self.flush_size:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            taken += 1
+        return batch, taken, False
+
+    def _write_retrying(self, batch: List[StatusMessage]) -> None:
+        """
+        Escribe el lote reintentando con espera creciente (con varios shards
+        sobre el mismo SQLite, "database is locked" es pasajero). Si sigue
+        fallando se escribe mensaje a mensaje: sólo se pierden los que
+        fallen solos, y cuentan en `dropped`.
+        """
+        delay = config.INGEST_RETRY_BACKOFF
+        for attempt in range(config.INGEST_WRITE_RETRIES + 1):
+            try:
+                self._write(batch)
+                return
+            except Exception as exc:
+                if attempt == config.INGEST_WRITE_RETRIES:
+                    logger.error("Lote de %d mensajes sin persistir (%s): se escribe uno a uno",
+                                 len(batch), exc)
+                    break
+                logger.warning("Error persistiendo lote de %d mensajes (%s); reintento en %.2fs",
+                               len(batch), exc, delay)
+                time.sleep(delay)
+                delay *= 2
+        for m in batch:
+            try:
+                self._write([m])
+            except Exception:
+                self.dropped += 1
+                logger.exception("Descartado mensaje de '%s'", m.device_id)
+
+    def _write(self, batch: List[StatusMessage]) -> None:
+        """Persiste un lote en una sola transacción y notifica en orden."""
+        events: List[db.Event] = []
+        latest: Dict[str, db.Event] = {}
+
+        with db.get_session() as session:
+            for m in batch:
+                # Pudo borrarse mientras el mensaje esperaba en la cola
+                if m.device_id not in self._registry:
+                    logger.warning("Mensaje ignorado: Dispositivo '%s' no registrado", m.device_id)
+                    continue
+                # El payload se clasifica aquí una vez; nadie más lo re-parsea
+                kind, value = classify(m.payload)
+                ev = db.Event(
+                    device_id=m.device_id, payload=m.payload, created_at=m.received_at,
+                    value_kind=kind, value_num=value,
+                )
+                events.append(ev)
+                latest[m.device_id] = ev
+
+            if not events:
+                return
+
+            self._backend.write(session, events)
+            devices = db.Device.__table__
+            session.execute(
+                update(devices)
+                .where(devices.c.device_id == bindparam("b_device_id"))
+                .values(
+                    last_state=bindparam("b_state"), last_updated=bindparam("b_ts"),
+                    last_kind=bindparam("b_kind"), last_value=bindparam("b_value"),
+                ),
+                [
+                    {"b_device_id": ev.device_id, "b_state": ev.payload, "b_ts": ev.created_at,
+                     "b_kind": ev.value_kind, "b_value": ev.value_num}
+                    for ev in latest.values()
+                ],
+            )
+            session.commit()
+
+        self._registry.update_states(
+            (ev.device_id, ev.payload, ev.created_at, ev.value_kind, ev.value_num)
+            for ev in latest.values()
+        )
+        for event in events:
+            try:
+                self._notify(event)
+            except Exception:
+                logger.exception("Error notificando evento de '%s'", event.device_id)
+
+        now = time.monotonic()
+        for m in batch:
+            latency = now - m.enqueued
+            self._latency_avg += (latency - self._latency_avg) * 0.1
+            self._latency_max = max(self._latency_max, latency)
+        self.processed += len(events)
+        self.batches += 1
+
+
+class IngestPool:
+    """
+    Reparte la ingesta entre N escritores según hash(device_id).
+
+    Todos los mensajes de un dispositivo caen siempre en el mismo escritor,
+    así se conserva el orden por dispositivo, mientras que dispositivos
+    distintos se persisten y notifican en paralelo. Un sensor muy hablador
+    sólo llena la cola de su shard.
+    """
+
+    def __init__(
+        self,
+        notify: Callable[[db.Event], None],
+        registry: DeviceRegistry,
+        backend: Optional[EventBackend] = None,
+        workers: Optional[int] = None,
+        **writer_kwargs,
+    ) -> None:
+        n = workers or config.INGEST_WORKERS
+        self.shards: List[IngestWriter] = [
+            IngestWriter(notify, registry, backend, name=f"ingest-{i}", **writer_kwargs)
+            for i in range(n)
+        ]
+
+    def shard_for(self, device_id: str) -> IngestWriter:
+        # crc32 y no hash(): estable entre procesos y ejecuciones
+        return self.shards[zlib.crc32(device_id.encode()) % len(self.shards)]
+
+    def submit(self, device_id: str, payload: str) -> bool:
+        return self.shard_for(device_id).submit(device_id, payload)
+
+    def start(self) -> None:
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self) -> None:
+        for shard in self.shards:
+            shard.stop()
+
+    def flush(self) -> None:
+        for shard in self.shards:
+            shard.flush()
+
+    def stats(self) -> List[ShardStats]:
+        return [shard.stats() for shard in self.shards]
@@ -24,20 +24,29 @@ def main():
     # 1) Inicializa la BD (si no existe)
     db.init_db()
 
-    # 2) Crea Controller y Rule Engine
+    # 2) Crea Controller y Rule Engine. Con MQTT_LOOP=asyncio el cliente MQTT
+    #    se engancha al bucle que esté corriendo, así que todo arranca dentro de él.
     controller = Controller(config.MQTT_BASE_TOPIC)
-    controller.start()
-    rule_engine = RuleEngine(controller)
 
-    # 3) Crea el Bot, pasándole un "bridge_factory" y el rule_engine
-    def bridge_factory(bot):
-        return Bridge(controller, bot)
-
-    bot = HomeBot(bridge_factory, rule_engine)
-
-    # 4) Lanza la aplicación asíncrona
     async def _runner():
-        await bot.start(config.DISCORD_TOKEN)
+        controller.start()
+        rule_engine = RuleEngine(controller)
+        try:
+            # 3) Crea el Bot, pasándole un "bridge_factory" y el rule_engine
+            def bridge_factory(bot):
+                return Bridge(controller, bot)
+
+            bot = HomeBot(bridge_factory, rule_engine)
+
+            # 4) Lanza la aplicación asíncrona
+            async with bot:
+                await bot.start(config.DISCORD_TOKEN)
+        finally:
+            # También con Ctrl+C (asyncio.run cancela esta tarea): persiste los
+            # lotes pendientes de la ingesta y escribe el snapshot final
+            logger.info("Cerrando motor de reglas y Controller...")
+            rule_engine.close()
+            controller.stop()
 
     try:
         asyncio.run(_runner())
@@ -0,0 +1,37 @@
+"""
+messages.py - Utilidades para componer mensajes de Discord
+"""
+
+from __future__ import annotations
+from typing import Iterable, List
+
+# Límite de caracteres de un mensaje de Discord
+DISCORD_LIMIT = 2000
+
+
+def pack_lines(lines: Iterable[str], limit: int = DISCORD_LIMIT, sep: str = "\n") -> List[str]:
+    """
+    Agrupa líneas en el menor número de mensajes de como mucho `limit`
+    caracteres, sin partir líneas salvo que una sola ya supere el límite.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in lines:
+        if len(line) > limit:
+            if current:
+                chunks.append(sep.join(current))
+                current, size = [], 0
+            while len(line) > limit:
+                chunks.append(line[:limit])
+                line = line[limit:]
+        extra = len(line) + (len(sep) if current else 0)
+        if size + extra > limit:
+            chunks.append(sep.join(current))
+            current, size = [], 0
+            extra = len(line)
+        current.append(line)
+        size += extra
+    if current:
+        chunks.append(sep.join(current))
+    return chunks
@@ -1,18 +1,90 @@
 """
 mqtt_client.py - Pequeño wrapper sobre paho-mqtt para simplificar callbacks
+
+Dos implementaciones con la misma interfaz:
+  MQTTClient       loop_start() de paho: la red va en un hilo propio
+  AsyncMQTTClient  la red la mueve el bucle asyncio del bot (API de bucle
+                   externo de paho: lectores/escritores sobre el socket), así
+                   los mensajes llegan ya en el hilo del bucle
 """
 
 from __future__ import annotations
+import asyncio
 import logging
-import queue
-from typing import Callable, Optional
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
 
 import paho.mqtt.client as mqtt
 import config
+from rule_stats import LatencyHistogram
 
 logger = logging.getLogger(__name__)
 
+_EARLY_TTL = 5.0   # segundos que se guarda un on_publish sin mid registrado
+
+
+@dataclass
+class ConnectionStats:
+    connects: int = 0         # CONNACK correctos (el primero incluido)
+    reconnects: int = 0       # conexiones tras una caída
+    disconnects: int = 0      # caídas inesperadas
+    downtime: float = 0.0     # segundos desconectado acumulados (caídas ya cerradas)
+    queued: int = 0           # publicaciones guardadas mientras no había conexión
+    flushed: int = 0          # enviadas al reconectar
+    expired: int = 0          # caducadas antes de reconectar
+    dropped: int = 0          # expulsadas por cola offline llena
+
+
+@dataclass
+class DeliveryStats:
+    confirmed: int = 0        # on_publish recibido (escrito en QoS 0, PUBACK/PUBCOMP si no)
+    rejected: int = 0         # paho ya tenía MQTT_MAX_QUEUED mensajes pendientes
+    failed: int = 0           # otros errores al publicar
+    # Latencia publish -> confirmación por nivel de QoS
+    latency: Dict[int, LatencyHistogram] = field(
+        default_factory=lambda: {q: LatencyHistogram() for q in (0, 1, 2)}
+    )
+
+
+@dataclass
+class _Outgoing:
+    topic: str
+    payload: str
+    qos: int
+    retain: bool
+    deadline: float           # time.monotonic() a partir del cual ya no se envía si sigue offline
+    future: Future
+
+
+def parse_qos(spec: str) -> List[Tuple[str, int]]:
+    """'casa/+/set=1;alarma/#=2' -> [('casa/+/set', 1), ('alarma/#', 2)]"""
+    rules = []
+    for part in filter(None, (p.strip() for p in spec.split(";"))):
+        pattern, _, qos = part.rpartition("=")
+        if not pattern or qos not in ("0", "1", "2"):
+            raise ValueError(f"MQTT_QOS mal formado: {part!r} (usa filtro=0|1|2)")
+        rules.append((pattern, int(qos)))
+    return rules
+
+
 class MQTTClient:
+    """
+    Reconecta solo (espera exponencial entre MQTT_RECONNECT_MIN y
+    MQTT_RECONNECT_MAX), repite las suscripciones en cada conexión y guarda
+    lo que se publique sin conexión en una cola acotada que se vacía, en
+    orden, al volver; lo que lleve más de su `ttl` esperando se descarta.
+
+    publish() devuelve un Future que se resuelve con la latencia hasta la
+    confirmación (on_publish) o falla si el mensaje no llega a salir. El QoS
+    de cada topic sale de MQTT_QOS. Como mucho MQTT_MAX_INFLIGHT mensajes
+    QoS>0 van sin confirmar; el resto espera en la cola de paho (acotada a
+    MQTT_MAX_QUEUED) y sale al ritmo de las confirmaciones.
+    """
+
     def __init__(
         self,
         on_message: Callable[[str, str], None],
@@ -23,29 +95,232 @@ class MQTTClient:
 
         self._client = mqtt.Client()
         self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
         self._client.on_message = self._on_message
+        self._client.on_publish = self._on_publish
+        self._client.reconnect_delay_set(config.MQTT_RECONNECT_MIN, config.MQTT_RECONNECT_MAX)
+        self._client.max_inflight_messages_set(config.MQTT_MAX_INFLIGHT)
+        self._client.max_queued_messages_set(config.MQTT_MAX_QUEUED)
+        self._qos_rules = parse_qos(config.MQTT_QOS)
+        self._qos_cache: Dict[str, int] = {}
+
+        # Topics suscritos, en orden (se repiten en cada on_connect)
+        self._topics: Dict[str, None] = {}
+        # connected, la cola offline y los topics cambian bajo este cerrojo
+        self._lock = threading.Lock()
+        self.connected = False
+        self._offline: Deque[_Outgoing] = deque()
+        self._down_since: Optional[float] = None
+        self._stopping = False
+        self.stats = ConnectionStats()
+
+        # mid -> (mensaje, instante de publish) hasta su on_publish. Cerrojo
+        # propio y nunca tomado mientras se llama a paho: on_publish llega con
+        # el mutex de mensajes de paho tomado.
+        self._track_lock = threading.Lock()
+        self._inflight: Dict[int, Tuple[_Outgoing, float]] = {}
+        # on_publish llegado antes de registrar el mid. Sólo vale para un
+        # publish anterior a él; lo que nadie reclama caduca (los mid se
+        # reutilizan al pasar de 65535)
+        self._early: Dict[int, float] = {}
+        self.delivery = DeliveryStats()
 
     def connect_and_start(self) -> None:
-        """Conecta al broker y arranca el loop de MQTT en un hilo aparte."""
-        self._client.connect(config.MQTT_BROKER, config.MQTT_PORT, 60)
+        """
+        Arranca el loop de MQTT en un hilo aparte. La conexión (y las
+        reconexiones) las hace ese hilo, así que un broker caído al arrancar
+        no impide iniciar.
+        """
+        self._client.connect_async(config.MQTT_BROKER, config.MQTT_PORT, 60)
         self._client.loop_start()
 
+    def stop(self) -> None:
+        """Detiene el loop de MQTT y se desconecta del broker."""
+        self._stopping = True
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._abandon()
+
+    def _abandon(self) -> None:
+        """Cancela lo que quede sin confirmar o en la cola offline (al parar)."""
+        with self._track_lock:
+            pending = [out for out, _ in self._inflight.values()]
+            self._inflight.clear()
+        with self._lock:
+            pending.extend(self._offline)
+            self._offline.clear()
+        for out in pending:
+            out.future.cancel()
+
+    @property
+    def downtime(self) -> float:
+        """Segundos desconectado en total, incluida la caída en curso."""
+        extra = time.monotonic() - self._down_since if self._down_since is not None else 0.0
+        return self.stats.downtime + extra
+
+    def describe(self) -> str:
+        st = self.stats
+        return (
+            f"MQTT {'conectado' if self.connected else 'DESCONECTADO'} · "
+            f"{st.reconnects} reconexiones, {st.disconnects} caídas, "
+            f"{self.downtime:.1f}s sin conexión · cola offline {len(self._offline)} "
+            f"({st.flushed} enviados, {st.expired} caducados, {st.dropped} descartados)"
+            f"\nEntregas: {self.delivery.confirmed} confirmadas, {len(self._inflight)} sin confirmar, "
+            f"{self.delivery.rejected} rechazadas por cola llena, {self.delivery.failed} fallidas"
+            + "".join(
+                f"\nQoS {q}: p50 {h.percentile(50) * 1e3:.0f}ms, p95 {h.percentile(95) * 1e3:.0f}ms, "
+                f"máx {h.max * 1e3:.0f}ms ({h.count})"
+                for q, h in self.delivery.latency.items() if h.count
+            )
+        )
+
+    def qos_for(self, topic: str) -> int:
+        """QoS del primer filtro de MQTT_QOS que case con `topic` (MQTT_QOS_DEFAULT si ninguno)."""
+        qos = self._qos_cache.get(topic)
+        if qos is None:
+            qos = next(
+                (q for pattern, q in self._qos_rules if mqtt.topic_matches_sub(pattern, topic)),
+                config.MQTT_QOS_DEFAULT,
+            )
+            self._qos_cache[topic] = qos
+        return qos
+
     def subscribe(self, topic: str) -> None:
         logger.debug("Suscribiéndose a %s", topic)
+        with self._lock:
+            self._topics[topic] = None
+            if not self.connected:
+                return  # se suscribirá en on_connect
         self._client.subscribe(topic)
 
-    def publish(self, topic: str, payload: str, retain: bool = False) -> None:
-        """Publica un mensaje en el topic indicado."""
-        self._client.publish(topic, payload, retain=retain)
+    def publish(
+        self,
+        topic: str,
+        payload: str,
+        retain: bool = False,
+        ttl: Optional[float] = None,
+        qos: Optional[int] = None,
+    ) -> Future:
+        """
+        Publica un mensaje en el topic indicado. Sin conexión se guarda y se
+        envía al reconectar, salvo que pasen `ttl` segundos antes
+        (MQTT_OFFLINE_TTL por defecto).
+
+        El Future devuelto se resuelve con los segundos entre el envío y la
+        confirmación; falla con TimeoutError si caduca sin conexión o con
+        ConnectionError si se descarta.
+        """
+        ttl = config.MQTT_OFFLINE_TTL if ttl is None else ttl
+        out = _Outgoing(
+            topic, payload, self.qos_for(topic) if qos is None else qos, retain,
+            time.monotonic() + ttl, Future(),
+        )
+        self._submit(out)
+        return out.future
+
+    def _submit(self, out: _Outgoing) -> None:
+        with self._lock:
+            if self.connected:
+                self._send(out)
+            else:
+                self._enqueue_offline(out)
+
+    def _send(self, out: _Outgoing) -> None:
+        """Con self._lock tomado (para no adelantar a la cola offline)."""
+        sent = time.monotonic()
+        info = self._client.publish(out.topic, out.payload, qos=out.qos, retain=out.retain)
+        if info.rc == mqtt.MQTT_ERR_NO_CONN and out.qos == 0:
+            # Caída aún sin on_disconnect; con QoS>0 paho ya lo guarda y lo reenvía
+            self._enqueue_offline(out)
+            return
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                self.delivery.rejected += 1
+            else:
+                self.delivery.failed += 1
+            logger.warning("No se pudo publicar %s → %s: %s", out.topic, out.payload, mqtt.error_string(info.rc))
+            out.future.set_exception(ConnectionError(mqtt.error_string(info.rc)))
+            return
+        with self._track_lock:
+            done = self._early.pop(info.mid, None)
+            if done is not None and done < sent:
+                done = None                  # de un mensaje anterior con el mismo mid
+            if done is None:
+                self._inflight[info.mid] = (out, sent)
+        if done is not None:
+            self._confirm(out, done - sent)
+
+    def _confirm(self, out: _Outgoing, latency: float) -> None:
+        self.delivery.confirmed += 1
+        self.delivery.latency[out.qos].record(latency)
+        if out.future.set_running_or_notify_cancel():
+            out.future.set_result(latency)
+
+    def _enqueue_offline(self, item: _Outgoing) -> None:
+        """Con el cerrojo tomado."""
+        if len(self._offline) >= config.MQTT_OFFLINE_QUEUE:
+            old = self._offline.popleft()
+            self.stats.dropped += 1
+            logger.warning("Cola offline llena: descartado %s → %s", old.topic, old.payload)
+            old.future.set_exception(ConnectionError("cola offline llena"))
+        self._offline.append(item)
+        self.stats.queued += 1
+        logger.info("Sin conexión MQTT: %s → %s en cola (%d)", item.topic, item.payload, len(self._offline))
 
     def _on_connect(self, client: mqtt.Client, userdata, flags, rc) -> None:
         """Callback interno de paho-mqtt al conectar."""
-        if rc == 0:
-            logger.info("Conectado a MQTT broker %s:%s", config.MQTT_BROKER, config.MQTT_PORT)
-            if self._on_external_connect:
-                self._on_external_connect(client)
-        else:
+        if rc != 0:
             logger.error("No se pudo conectar al broker, rc=%s", rc)
+            return
+        st = self.stats
+        with self._lock:
+            st.connects += 1
+            if self._down_since is not None:
+                st.reconnects += 1
+                st.downtime += time.monotonic() - self._down_since
+                self._down_since = None
+            self.connected = True
+            for topic in self._topics:
+                client.subscribe(topic)
+            # La cola se vacía con el cerrojo tomado: nada publicado ahora se adelanta
+            now = time.monotonic()
+            while self._offline:
+                item = self._offline.popleft()
+                if item.deadline < now:
+                    st.expired += 1
+                    item.future.set_exception(TimeoutError("caducado sin conexión"))
+                    continue
+                self._send(item)
+                st.flushed += 1
+        logger.info(
+            "Conectado a MQTT broker %s:%s (%d topics, reconexión nº %d)",
+            config.MQTT_BROKER, config.MQTT_PORT, len(self._topics), st.reconnects,
+        )
+        if self._on_external_connect:
+            self._on_external_connect(client)
+
+    def _on_disconnect(self, client: mqtt.Client, userdata, rc) -> None:
+        with self._lock:
+            was_connected = self.connected
+            self.connected = False
+            if self._down_since is None:
+                self._down_since = time.monotonic()
+        if rc != mqtt.MQTT_ERR_SUCCESS and not self._stopping:
+            if was_connected:
+                self.stats.disconnects += 1
+            logger.warning("Conexión MQTT perdida (rc=%s); reintentando", rc)
+
+    def _on_publish(self, client, userdata, mid) -> None:
+        now = time.monotonic()
+        with self._track_lock:
+            entry = self._inflight.pop(mid, None)
+            if entry is None:
+                for old in [m for m, t in self._early.items() if now - t > _EARLY_TTL]:
+                    del self._early[old]
+                self._early[mid] = now
+                return
+        out, sent = entry
+        self._confirm(out, now - sent)
 
     def _on_message(self, client, userdata, msg) -> None:
         """Callback interno de paho-mqtt al recibir un mensaje."""
@@ -53,3 +328,192 @@ class MQTTClient:
         payload = msg.payload.decode(errors="ignore")
         logger.debug("Mensaje MQTT %s => %s", topic, payload)
         self._on_external_message(topic, payload)
+
+
+class AsyncMQTTClient(MQTTClient):
+    """
+    Variante dirigida por el bucle asyncio `loop` (por defecto, el que esté
+    corriendo al llamar a connect_and_start). paho sólo se toca desde ese
+    bucle: publish()/subscribe() desde otro hilo (p.ej. las acciones del
+    ActionExecutor) se le pasan con call_soon_threadsafe, y la conexión TCP
+    se abre en un executor para no congelar el bucle. Los callbacks
+    on_message/on_connect se ejecutan en el bucle.
+    """
+
+    # Cada cuánto se llama a loop_misc() (keepalive / PINGREQ)
+    MISC_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        on_message: Callable[[str, str], None],
+        on_connect: Optional[Callable[[mqtt.Client], None]] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        super().__init__(on_message, on_connect)
+        self._loop = loop
+        self._loop_thread: Optional[int] = None
+        # Operaciones de socket pedidas por paho mientras conecta en el executor
+        self._deferred: Optional[List[Callable[[], None]]] = None
+        self._misc_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._retry_delay: Optional[float] = None
+        self._streams: Set[asyncio.Queue] = set()
+
+        c = self._client
+        c.on_socket_open = self._on_socket_open
+        c.on_socket_close = self._on_socket_close
+        c.on_socket_register_write = self._on_socket_register_write
+        c.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def connect_and_start(self) -> None:
+        """
+        Conecta al broker y engancha el socket al bucle asyncio. Si el broker
+        no está, se sigue reintentando en segundo plano.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._client.connect_async(config.MQTT_BROKER, config.MQTT_PORT, 60)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+        self._reconnect_task = self._loop.create_task(self._reconnect_loop(first=True))
+
+    def stop(self) -> None:
+        """Envía DISCONNECT, suelta el socket del bucle y para el keepalive."""
+        self._stopping = True
+        for task in (self._misc_task, self._reconnect_task):
+            if task:
+                task.cancel()
+        self._misc_task = self._reconnect_task = None
+        self._client.disconnect()
+        # Sin esperar al escritor del bucle: el DISCONNECT sale ya y paho cierra el socket
+        self._client.loop_write()
+        self._abandon()
+
+    async def publish_async(
+        self, topic: str, payload: str, qos: Optional[int] = None, retain: bool = False
+    ) -> float:
+        """
+        publish() esperando a que paho lo dé por entregado: escrito en el
+        socket (QoS 0), PUBACK (QoS 1) o PUBCOMP (QoS 2). Devuelve la latencia.
+        """
+        return await asyncio.wrap_future(self.publish(topic, payload, retain=retain, qos=qos))
+
+    def _on_loop(self) -> bool:
+        # Antes de connect_and_start no hay socket: se puede llamar desde cualquier hilo
+        return self._loop_thread is None or threading.get_ident() == self._loop_thread
+
+    def _submit(self, out: _Outgoing) -> None:
+        if self._on_loop():
+            super()._submit(out)
+            return
+        try:
+            self._loop.call_soon_threadsafe(super()._submit, out)
+        except RuntimeError:
+            out.future.set_exception(ConnectionError("bucle asyncio cerrado"))
+
+    def subscribe(self, topic: str) -> None:
+        if self._on_loop():
+            super().subscribe(topic)
+        else:
+            self._loop.call_soon_threadsafe(super().subscribe, topic)
+
+    async def messages(self, maxsize: int = 1000) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Flujo (topic, payload) de los mensajes recibidos a partir de ahora,
+        además del callback on_message. Si el consumidor no da abasto se
+        descartan los más antiguos (como mucho `maxsize` pendientes).
+        """
+        stream: asyncio.Queue = asyncio.Queue(maxsize)
+        self._streams.add(stream)
+        try:
+            while True:
+                yield await stream.get()
+        finally:
+            self._streams.discard(stream)
+
+    # - Callbacks de paho (hilo del bucle) -
+    def _on_message(self, client, userdata, msg) -> None:
+        super()._on_message(client, userdata, msg)
+        if self._streams:
+            item = (msg.topic, msg.payload.decode(errors="ignore"))
+            for stream in self._streams:
+                if stream.full():
+                    stream.get_nowait()
+                stream.put_nowait(item)
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        if rc == 0:
+            self._retry_delay = None
+        super()._on_connect(client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc) -> None:
+        super()._on_disconnect(client, userdata, rc)
+        if rc != mqtt.MQTT_ERR_SUCCESS and not self._stopping:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self) -> None:
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self._loop.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self, first: bool = False) -> None:
+        """
+        Reintenta con espera exponencial (la misma que aplica paho en modo
+        hilo). La espera sólo vuelve al mínimo tras un CONNACK correcto.
+        """
+        while not self._stopping:
+            if first:
+                first = False
+            else:
+                if self._retry_delay is None:
+                    self._retry_delay = config.MQTT_RECONNECT_MIN
+                else:
+                    self._retry_delay = min(self._retry_delay * 2, config.MQTT_RECONNECT_MAX)
+                await asyncio.sleep(self._retry_delay)
+            try:
+                await self._connect()
+                return
+            except OSError as exc:
+                logger.warning("No se pudo conectar al broker (%s); reintentando", exc)
+
+    async def _connect(self) -> None:
+        """
+        DNS + connect TCP + CONNECT en un executor. Lo que paho pida hacer con
+        el socket mientras tanto se aplica aquí, ya en el bucle, al terminar.
+        """
+        self._deferred = []
+        try:
+            await self._loop.run_in_executor(None, self._client.reconnect)
+            ops = self._deferred
+        finally:
+            self._deferred = None
+        for op in ops:
+            op()
+
+    def _socket_op(self, op: Callable, *args) -> None:
+        if self._on_loop():
+            op(*args)
+        elif self._deferred is not None:
+            self._deferred.append(lambda: op(*args))
+        else:
+            self._loop.call_soon_threadsafe(op, *args)
+
+    # Al quitar se usa el descriptor: si la operación se aplaza, el socket ya estará cerrado
+    def _on_socket_open(self, client, userdata, sock) -> None:
+        self._socket_op(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock) -> None:
+        fd = sock.fileno()
+        self._socket_op(self._loop.remove_reader, fd)
+        self._socket_op(self._loop.remove_writer, fd)
+
+    def _on_socket_register_write(self, client, userdata, sock) -> None:
+        self._socket_op(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock) -> None:
+        self._socket_op(self._loop.remove_writer, sock.fileno())
+
+    async def _misc_loop(self) -> None:
+        while True:
+            if self._deferred is None:   # no mientras se conecta en el executor
+                self._client.loop_misc()
+            await asyncio.sleep(self.MISC_INTERVAL)
@@ -0,0 +1,44 @@
+"""
+payload_types.py - Clasificación de payloads en tipos (número, booleano, hora, texto)
+
+La ingesta clasifica cada payload una sola vez y guarda el resultado en
+columnas tipadas (value_kind, value_num), así que reglas, ventanas y
+exportaciones no vuelven a parsear texto.
+"""
+
+from __future__ import annotations
+import math
+import re
+from typing import Optional, Tuple
+
+NUM = "num"     # número finito: value = el número
+BOOL = "bool"   # ON/OFF, TRUE/FALSE: value = 1.0 / 0.0
+TIME = "time"   # HH:MM[:SS]: value = segundos desde medianoche
+TEXT = "text"   # cualquier otra cosa: value = None
+
+KINDS = (NUM, BOOL, TIME, TEXT)
+
+_BOOLS = {"ON": 1.0, "TRUE": 1.0, "OFF": 0.0, "FALSE": 0.0}
+_TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)(?::([0-5]\d))?$")
+
+
+def classify(payload: Optional[str]) -> Tuple[str, Optional[float]]:
+    """Devuelve (tipo, valor numérico o None)."""
+    if payload is None:
+        return TEXT, None
+    text = payload.strip()
+    try:
+        v = float(text)
+    except ValueError:
+        pass
+    else:
+        return (NUM, v) if math.isfinite(v) else (TEXT, None)
+    b = _BOOLS.get(text.upper())
+    if b is not None:
+        return BOOL, b
+    m = _TIME_RE.match(text)
+    if m:
+        h, mi, s = m.groups()
+        return TIME, float(int(h) * 3600 + int(mi) * 60 + int(s or 0))
+    return TEXT, None
+
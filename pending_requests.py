@@ -0,0 +1,124 @@
+"""
+pending_requests.py - Peticiones GET_STATE en vuelo y su tiempo de ida y vuelta
+
+Cada petición deja un Future en la tabla del dispositivo; el siguiente
+/status de ese dispositivo (o un /ack que empiece por su id de correlación)
+la resuelve con el payload y el RTT medido. Los Future son de
+concurrent.futures: se resuelven desde el hilo de red de paho y el bot los
+espera con asyncio.wrap_future.
+
+Las peticiones que nadie resuelve no se acumulan: cada dispositivo tiene
+como mucho `max_pending` y las que superan `timeout` se cancelan al
+registrar la siguiente.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional
+
+from rule_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StatusReply:
+    device_id: str
+    payload: str
+    rtt: float                        # segundos
+    correlation_id: Optional[str] = None
+
+
+@dataclass
+class _Pending:
+    future: Future
+    sent: float                       # time.monotonic() al publicar
+    correlation_id: Optional[str]
+
+
+class PendingRequests:
+    def __init__(self, timeout: float, max_pending: int) -> None:
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._table: Dict[str, Deque[_Pending]] = {}
+        # RTT de toda la flota (sólo se registra desde el hilo de paho)
+        self.rtt = LatencyHistogram()
+        self.answered = 0
+        self.expired = 0
+
+    def add(self, device_id: str, correlation_id: Optional[str] = None) -> Future:
+        """Registra una petición justo antes de publicarla."""
+        fut: Future = Future()
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            queue = self._table.setdefault(device_id, deque())
+            while queue and (len(queue) >= self.max_pending or now - queue[0].sent > self.timeout):
+                stale.append(queue.popleft())
+            queue.append(_Pending(fut, now, correlation_id))
+        for p in stale:
+            if p.future.cancel():
+                self.expired += 1
+        return fut
+
+    def discard(self, device_id: str, fut: Future) -> None:
+        """Quita una petición que ya no se espera (p.ej. tras un timeout)."""
+        with self._lock:
+            queue = self._table.get(device_id)
+            if queue:
+                for p in queue:
+                    if p.future is fut:
+                        queue.remove(p)
+                        self.expired += 1
+                        break
+                if not queue:
+                    del self._table[device_id]
+
+    def resolve(self, device_id: str, payload: str, correlation_id: Optional[str] = None) -> int:
+        """
+        Resuelve las peticiones del dispositivo: todas si `correlation_id` es
+        None (un /status responde a cualquiera), o sólo la que lo lleve.
+        Devuelve cuántas se resolvieron.
+        """
+        if device_id not in self._table:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            queue = self._table.get(device_id)
+            if not queue:
+                return 0
+            if correlation_id is None:
+                done = list(queue)
+                del self._table[device_id]
+            else:
+                done = [p for p in queue if p.correlation_id == correlation_id]
+                for p in done:
+                    queue.remove(p)
+        resolved = 0
+        for p in done:
+            rtt = now - p.sent
+            if p.future.set_running_or_notify_cancel():
+                p.future.set_result(StatusReply(device_id, payload, rtt, p.correlation_id))
+                self.rtt.record(rtt)
+                resolved += 1
+        self.answered += resolved
+        return resolved
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._table.values())
+
+    def describe(self) -> str:
+        rtt = self.rtt
+        return (
+            f"{self.answered} respuestas, {self.expired} sin respuesta, {self.pending()} en curso · "
+            f"RTT medio {rtt.mean * 1e3:.0f}ms (p50 {rtt.percentile(50) * 1e3:.0f}, "
+            f"p95 {rtt.percentile(95) * 1e3:.0f}, p99 {rtt.percentile(99) * 1e3:.0f}, "
+            f"máx {rtt.max * 1e3:.0f})"
+        )
@@ -1,8 +1,10 @@
-
 from __future__ import annotations
 import datetime as dt
 import logging
-from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, Float, Index, Integer, String, UniqueConstraint,
+    DDL, create_engine, event, inspect, select, text, update,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, Session, mapped_column, sessionmaker
 import config
@@ -17,13 +19,36 @@ class Device(Base):
     device_type: Mapped[str] = mapped_column(String)          # sensor|switch|clock
     last_state: Mapped[str | None] = mapped_column(String, nullable=True)
     last_updated: Mapped[dt.datetime | None] = mapped_column(DateTime, nullable=True)
+    # last_state ya clasificado (ver payload_types)
+    last_kind: Mapped[str | None] = mapped_column(String, nullable=True)
+    last_value: Mapped[float | None] = mapped_column(Float, nullable=True)
 
 class Event(Base):
     __tablename__ = "events"
+    # Historial por dispositivo y rango de fechas; también sirve a device_id solo
+    __table_args__ = (Index("ix_events_device_created", "device_id", "created_at"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    device_id: Mapped[str] = mapped_column(String, index=True)
+    device_id: Mapped[str] = mapped_column(String)
     payload: Mapped[str] = mapped_column(String)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+    # Tipo y valor numérico del payload, calculados una vez en la ingesta
+    value_kind: Mapped[str | None] = mapped_column(String, nullable=True)
+    value_num: Mapped[float | None] = mapped_column(Float, nullable=True)
+
+class EventRollup(Base):
+    """Resumen por dispositivo y cubeta de tiempo de eventos ya expirados."""
+    __tablename__ = "event_rollups"
+    __table_args__ = (UniqueConstraint("device_id", "bucket_start", "bucket_seconds"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    device_id: Mapped[str] = mapped_column(String, index=True)
+    bucket_start: Mapped[dt.datetime] = mapped_column(DateTime)
+    bucket_seconds: Mapped[int] = mapped_column(Integer)
+    count: Mapped[int] = mapped_column(Integer)             # todos los eventos
+    value_count: Mapped[int] = mapped_column(Integer)       # los de payload numérico
+    value_min: Mapped[float | None] = mapped_column(Float, nullable=True)
+    value_max: Mapped[float | None] = mapped_column(Float, nullable=True)
+    value_avg: Mapped[float | None] = mapped_column(Float, nullable=True)
+    last_payload: Mapped[str | None] = mapped_column(String, nullable=True)
 
 class Rule(Base):
     __tablename__ = "rules"
@@ -31,6 +56,53 @@ class Rule(Base):
     name: Mapped[str] = mapped_column(String)
     condition: Mapped[str] = mapped_column(String)   # Python expr usando `event`
     action: Mapped[str] = mapped_column(String)      # Python code usando `controller`
+    # Antirrebote: segundos mínimos entre disparos (por dispositivo)
+    cooldown: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    # Sólo dispara en la transición falso -> verdadero
+    edge: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+    # Histéresis: tras disparar no se rearma hasta que esta expresión sea verdadera
+    rearm: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Versión global (rule_meta) en la que cambió; los borrados quedan como lápida
+    version: Mapped[int] = mapped_column(Integer, default=0, server_default="0", index=True)
+    deleted: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+
+class ThresholdRule(Base):
+    """Regla declarativa: si el valor numérico de device_id cumple op → comando."""
+    __tablename__ = "threshold_rules"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String)
+    device_id: Mapped[str] = mapped_column(String, index=True)
+    op: Mapped[str] = mapped_column(String)                    # > | >= | < | <= | between
+    low: Mapped[float] = mapped_column(Float)                  # umbral (o límite inferior)
+    high: Mapped[float | None] = mapped_column(Float, nullable=True)  # sólo 'between'
+    target_device: Mapped[str] = mapped_column(String)
+    command: Mapped[str] = mapped_column(String)
+    cooldown: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    edge: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+    # Banda de histéresis: tras disparar, el valor debe salir del umbral +/- esta cantidad
+    hysteresis: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    version: Mapped[int] = mapped_column(Integer, default=0, server_default="0", index=True)
+    deleted: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+
+class Subscription(Base):
+    """Canal de Discord suscrito a un dispositivo, un tipo o un patrón de device_id."""
+    __tablename__ = "subscriptions"
+    __table_args__ = (UniqueConstraint("channel_id", "kind", "target"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel_id: Mapped[int] = mapped_column(BigInteger)
+    kind: Mapped[str] = mapped_column(String)             # device|type|pattern
+    target: Mapped[str] = mapped_column(String)
+
+class RuleMeta(Base):
+    """Una sola fila: contador que se incrementa con cada cambio de reglas."""
+    __tablename__ = "rule_meta"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+# La fila existe desde que se crea la tabla: así subir la versión es siempre
+# un UPDATE y dos altas simultáneas no compiten por insertarla
+_SEED_RULE_META = "INSERT OR IGNORE INTO rule_meta (id, version) VALUES (1, 0)"
+event.listen(RuleMeta.__table__, "after_create", DDL(_SEED_RULE_META))
 
 _engine = create_engine(f"sqlite:///{config.SQLITE_DB}", echo=config.DEBUG)
 SessionLocal = sessionmaker(bind=_engine, expire_on_commit=False)
@@ -38,6 +110,99 @@ SessionLocal = sessionmaker(bind=_engine, expire_on_commit=False)
 def init_db() -> None:
     logger.info("Inicializando SQLite DB en %s", config.SQLITE_DB)
     Base.metadata.create_all(bind=_engine)
+    _add_missing_columns()
+    _add_missing_indexes()
+    with _engine.begin() as conn:
+        conn.execute(text(_SEED_RULE_META))
+
+def _add_missing_columns() -> None:
+    """
+    create_all no altera tablas existentes: añade las columnas nuevas de los
+    modelos a una BD creada con una versión anterior.
+    """
+    insp = inspect(_engine)
+    with _engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(_engine.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                logger.info("Migrando esquema: %s", ddl)
+                conn.execute(text(ddl))
+
+def _add_missing_indexes() -> None:
+    """Igual que _add_missing_columns, para los índices declarados en los modelos."""
+    with _engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
 
 def get_session() -> Session:
-    return SessionLocal()
\ No newline at end of file
+    return SessionLocal()
+
+# - Reglas versionadas -
+# Toda alta/baja de reglas pasa por aquí para que la versión avance en la
+# misma transacción; así cualquier proceso detecta cambios leyendo un entero.
+RULE_MODELS = (Rule, ThresholdRule)
+
+def _bump_rules_version(session: Session) -> int:
+    session.execute(update(RuleMeta).where(RuleMeta.id == 1).values(version=RuleMeta.version + 1))
+    return session.scalar(select(RuleMeta.version).where(RuleMeta.id == 1))
+
+def add_rule(model: type[Rule] | type[ThresholdRule], **fields) -> Rule | ThresholdRule:
+    """Crea una regla (Python o de umbral) y avanza la versión de reglas."""
+    with get_session() as s:
+        obj = model(**fields)
+        obj.version = _bump_rules_version(s)
+        s.add(obj)
+        s.commit()
+        return obj
+
+def delete_rule(model: type[Rule] | type[ThresholdRule], rule_id: int) -> bool:
+    """Marca una regla como borrada (lápida). False si no existe."""
+    with get_session() as s:
+        obj = s.get(model, rule_id)
+        if obj is None or obj.deleted:
+            return False
+        obj.deleted = True
+        obj.version = _bump_rules_version(s)
+        s.commit()
+        return True
+
+def list_rules(model: type[Rule] | type[ThresholdRule]) -> list:
+    with get_session() as s:
+        return s.query(model).filter(model.deleted.is_not(True)).order_by(model.id).all()
+
+def rules_version() -> int:
+    """Versión actual de las reglas: una lectura de un entero, apta para sondeo."""
+    with get_session() as s:
+        return s.scalar(select(RuleMeta.version).where(RuleMeta.id == 1)) or 0
+
+def _read_rules(session: Session, query) -> tuple[int, list[Rule], list[ThresholdRule]]:
+    """
+    pysqlite no abre transacción para un SELECT, así que cada consulta ve su
+    propia foto de la BD. Como todo cambio de reglas sube la versión en su
+    misma transacción, si la versión no cambió entre antes y después las
+    filas leídas son coherentes con ella; si cambió, se vuelve a leer.
+    """
+    while True:
+        version = session.scalar(select(RuleMeta.version).where(RuleMeta.id == 1)) or 0
+        rules, thresholds = query(Rule).all(), query(ThresholdRule).all()
+        if (session.scalar(select(RuleMeta.version).where(RuleMeta.id == 1)) or 0) == version:
+            return version, rules, thresholds
+        session.expunge_all()
+
+def load_rules() -> tuple[int, list[Rule], list[ThresholdRule]]:
+    """(versión, reglas, reglas de umbral) vigentes, coherentes con esa versión."""
+    with get_session() as s:
+        return _read_rules(
+            s, lambda m: s.query(m).filter(m.deleted.is_not(True)).order_by(m.id)
+        )
+
+def rules_changed_since(version: int) -> tuple[int, list[Rule], list[ThresholdRule]]:
+    """(versión, reglas, reglas de umbral) cambiadas o borradas tras `version`."""
+    with get_session() as s:
+        return _read_rules(s, lambda m: s.query(m).filter(m.version > version))
@@ -0,0 +1,149 @@
+"""
+publisher.py - Publicación de eventos en Discord por lotes, agrupando por dispositivo
+
+En cada ventana de publicación se vacía la cola de eventos, se conserva sólo
+el último valor de cada dispositivo y las líneas se empaquetan en el menor
+número de mensajes de ≤2000 caracteres.
+
+discord.py no expone las cabeceras X-RateLimit-*: su limitador interno las
+consume y, cuando el bucket se agota, simplemente retiene el envío hasta el
+reset (o lanza HTTPException 429 si se agotan los reintentos). Por eso la
+ventana se adapta a lo que sí se observa: si un envío tarda más de
+`slow_send` segundos (estuvo esperando al limitador) o devuelve 429, la
+ventana se duplica; cada envío rápido la reduce un paso, hasta `min_interval`.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+import discord
+from discord.abc import Messageable
+
+import config
+import persistence as db
+from messages import pack_lines
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PublisherStats:
+    events: int = 0          # eventos recibidos de la cola
+    coalesced: int = 0       # descartados por llegar otro más reciente del mismo dispositivo
+    messages: int = 0        # mensajes enviados a Discord
+    rate_limited: int = 0    # envíos lentos o 429 que han ampliado la ventana
+    failed: int = 0          # mensajes que Discord rechazó (se pierden)
+
+
+def format_event(event: db.Event, count: int = 1) -> str:
+    line = f"📟 **{event.device_id}** → `{event.payload}`"
+    return f"{line} (×{count})" if count > 1 else line
+
+
+class EventPublisher:
+    """
+    Consume `queue` (asyncio.Queue o handoff.LoopHandoff) y publica cada
+    evento en los destinos que devuelve `route(evento)` (objetos con un
+    `send(texto)` asíncrono, p.ej. canales de Discord); las líneas de cada
+    destino se empaquetan por separado.
+    run() no termina nunca: se lanza como tarea del bucle del bot.
+    """
+
+    def __init__(
+        self,
+        queue,
+        route: Callable[[db.Event], Iterable[Messageable]],
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        slow_send: Optional[float] = None,
+    ) -> None:
+        self.queue = queue
+        self.route = route
+        self.min_interval = config.PUBLISH_MIN_INTERVAL if min_interval is None else min_interval
+        self.max_interval = config.PUBLISH_MAX_INTERVAL if max_interval is None else max_interval
+        self.slow_send = config.PUBLISH_SLOW_SEND if slow_send is None else slow_send
+        self.interval = self.min_interval
+        self.stats = PublisherStats()
+
+    async def run(self) -> None:
+        while True:
+            batch = await self.collect()
+            await self.flush(batch)
+
+    async def collect(self) -> Dict[str, List]:
+        """
+        Espera al primer evento y recoge los que lleguen durante la ventana.
+        Devuelve device_id -> [último evento, nº de eventos], en orden de
+        primera aparición.
+        """
+        loop = asyncio.get_running_loop()
+        pending: Dict[str, List] = {}
+        self._take(await self.queue.get(), pending)
+        deadline = loop.time() + self.interval
+        while True:
+            try:
+                # Lo que ya está en cola se toma sin ceder el bucle
+                while True:
+                    self._take(self.queue.get_nowait(), pending)
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return pending
+            try:
+                self._take(await asyncio.wait_for(self.queue.get(), remaining), pending)
+            except asyncio.TimeoutError:
+                return pending
+
+    def _take(self, event: db.Event, pending: Dict[str, List]) -> None:
+        self.stats.events += 1
+        slot = pending.get(event.device_id)
+        if slot is None:
+            pending[event.device_id] = [event, 1]
+        else:
+            self.stats.coalesced += 1
+            slot[0] = event
+            slot[1] += 1
+
+    async def flush(self, pending: Dict[str, List]) -> None:
+        # Una resolución de destinos por dispositivo y ventana
+        lines: Dict[Messageable, List[str]] = {}
+        for ev, n in pending.values():
+            line = format_event(ev, n)
+            for dest in self.route(ev):
+                lines.setdefault(dest, []).append(line)
+        for dest, dest_lines in lines.items():
+            await self._send_all(dest, dest_lines)
+
+    async def _send_all(self, dest: Messageable, lines: List[str]) -> None:
+        loop = asyncio.get_running_loop()
+        for chunk in pack_lines(lines):
+            t0 = loop.time()
+            try:
+                await dest.send(chunk)
+            except discord.HTTPException as exc:
+                self.stats.failed += 1
+                logger.warning("No se pudo publicar en Discord: %s", exc)
+                if exc.status == 429:
+                    self._slow_down()
+                continue
+            self.stats.messages += 1
+            if loop.time() - t0 > self.slow_send:
+                self._slow_down()
+            else:
+                self._speed_up()
+
+    def _slow_down(self) -> None:
+        self.stats.rate_limited += 1
+        new = min(max(self.interval * 2, 0.5), self.max_interval)
+        if new != self.interval:
+            logger.info("Límite de Discord alcanzado: publicando cada %.1f s", new)
+        self.interval = new
+
+    def _speed_up(self) -> None:
+        # Reducción aditiva: se vuelve al ritmo normal poco a poco
+        step = max((self.max_interval - self.min_interval) / 20, 0.05)
+        self.interval = max(self.interval - step, self.min_interval)
@@ -0,0 +1,202 @@
+"""
+registry.py - Registro en memoria de dispositivos (device_id -> tipo y último estado)
+"""
+
+from __future__ import annotations
+import datetime as dt
+import logging
+import threading
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import persistence as db
+
+logger = logging.getLogger(__name__)
+
+
+def _epoch(ts: dt.datetime) -> float:
+    return ts.replace(tzinfo=dt.timezone.utc).timestamp()
+
+
+@dataclass(frozen=True)
+class DeviceInfo:
+    """Copia inmutable de una fila de 'devices'."""
+    device_id: str
+    device_type: str
+    last_state: Optional[str] = None
+    last_updated: Optional[dt.datetime] = None
+    last_kind: Optional[str] = None
+    last_value: Optional[float] = None
+
+
+class DeviceRegistry:
+    """
+    Fuente autoritativa en proceso de los dispositivos registrados.
+
+    Se carga entero desde la BD al arrancar; a partir de ahí las altas, bajas
+    y cambios de tipo se escriben en la BD y aquí (write-through) y la
+    ingesta actualiza los últimos estados tras cada commit. Las lecturas
+    son búsquedas en un dict, sin ir a SQLite.
+    """
+
+    def __init__(self) -> None:
+        self._devices: Dict[str, DeviceInfo] = {}
+        self._lock = threading.Lock()
+        # Mientras reconcile() lee la BD, altas, bajas y cambios de tipo se
+        # anotan aquí para repetirlos sobre lo leído (si no, se perderían)
+        self._journal: Optional[List[tuple]] = None
+        # Se llaman (fuera del cerrojo) con el id de cada dispositivo dado de
+        # baja, para que quien guarde estado por dispositivo lo suelte
+        self._remove_listeners: List[Callable[[str], None]] = []
+        # Sube con cada alta, baja o cambio de tipo (no con los estados):
+        # permite a las cachés de listados saber si siguen valiendo
+        self.version = 0
+
+    @staticmethod
+    def _read_db() -> Dict[str, DeviceInfo]:
+        with db.get_session() as s:
+            rows = s.query(db.Device).order_by(db.Device.id).all()
+        return {
+            d.device_id: DeviceInfo(d.device_id, d.device_type, d.last_state, d.last_updated,
+                                    d.last_kind, d.last_value)
+            for d in rows
+        }
+
+    def load(self) -> None:
+        """(Re)carga todos los dispositivos desde la tabla 'devices'."""
+        devices = self._read_db()
+        with self._lock:
+            self._devices = devices
+            self.version += 1
+        logger.info("Registro de dispositivos cargado: %d dispositivos", len(devices))
+
+    # - Snapshot -
+    def dump(self) -> Tuple[tuple, ...]:
+        """Filas planas (aptas para marshal) con todo el registro."""
+        with self._lock:
+            infos = list(self._devices.values())
+        return tuple(
+            (i.device_id, i.device_type, i.last_state,
+             _epoch(i.last_updated) if i.last_updated else None, i.last_kind, i.last_value)
+            for i in infos
+        )
+
+    def restore(self, rows: Iterable[tuple]) -> None:
+        """Sustituye el registro por las filas de dump()."""
+        devices = {
+            r[0]: DeviceInfo(r[0], r[1], r[2],
+                             dt.datetime.utcfromtimestamp(r[3]) if r[3] is not None else None,
+                             r[4], r[5])
+            for r in rows
+        }
+        with self._lock:
+            self._devices = devices
+            self.version += 1
+
+    def reconcile(self) -> Tuple[int, int]:
+        """
+        Pone al día un registro restaurado de un snapshot con la BD: altas,
+        bajas y cambios de tipo mandan desde la BD; el último estado se queda
+        con el más reciente de los dos (la ingesta pudo actualizarlo aquí
+        mientras se leía la BD). Las altas, bajas y cambios de tipo hechos
+        durante la lectura se vuelven a aplicar después. Devuelve
+        (añadidos, eliminados).
+        """
+        with self._lock:
+            self._journal = []
+        try:
+            fresh = self._read_db()
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+        with self._lock:
+            current = self._devices
+            for device_id, info in fresh.items():
+                mine = current.get(device_id)
+                if mine and mine.last_updated and (
+                    info.last_updated is None or mine.last_updated > info.last_updated
+                ):
+                    fresh[device_id] = replace(
+                        info, last_state=mine.last_state, last_updated=mine.last_updated,
+                        last_kind=mine.last_kind, last_value=mine.last_value,
+                    )
+            journal, self._journal = self._journal, None
+            for op, device_id, arg in journal:
+                if op == "put":
+                    fresh[device_id] = arg
+                elif op == "remove":
+                    fresh.pop(device_id, None)
+                elif device_id in fresh:
+                    fresh[device_id] = replace(fresh[device_id], device_type=arg)
+            added = len(fresh.keys() - current.keys())
+            gone = current.keys() - fresh.keys()
+            self._devices = fresh
+            self.version += 1
+        for device_id in gone:
+            self._removed(device_id)
+        return added, len(gone)
+
+    # - Lecturas -
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._devices
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def get(self, device_id: str) -> Optional[DeviceInfo]:
+        return self._devices.get(device_id)
+
+    def all(self) -> List[DeviceInfo]:
+        with self._lock:
+            return list(self._devices.values())
+
+    # - Escrituras (write-through desde Bridge / ingesta) -
+    def put(self, info: DeviceInfo) -> None:
+        with self._lock:
+            self._devices[info.device_id] = info
+            self.version += 1
+            if self._journal is not None:
+                self._journal.append(("put", info.device_id, info))
+
+    def remove(self, device_id: str) -> None:
+        with self._lock:
+            existed = self._devices.pop(device_id, None) is not None
+            if existed:
+                self.version += 1
+            if self._journal is not None:
+                self._journal.append(("remove", device_id, None))
+        if existed:
+            self._removed(device_id)
+
+    def add_remove_listener(self, callback: Callable[[str], None]) -> None:
+        """Registra una función a la que avisar de cada baja."""
+        self._remove_listeners.append(callback)
+
+    def _removed(self, device_id: str) -> None:
+        for callback in self._remove_listeners:
+            try:
+                callback(device_id)
+            except Exception:
+                logger.exception("Error notificando la baja de '%s'", device_id)
+
+    def set_type(self, device_id: str, device_type: str) -> None:
+        with self._lock:
+            info = self._devices.get(device_id)
+            if info:
+                self._devices[device_id] = replace(info, device_type=device_type)
+                self.version += 1
+            if self._journal is not None:
+                self._journal.append(("type", device_id, device_type))
+
+    def update_states(
+        self, states: Iterable[Tuple[str, str, dt.datetime, Optional[str], Optional[float]]]
+    ) -> None:
+        """Aplica (device_id, estado, instante, tipo, valor) ya persistidos. Ignora los borrados."""
+        with self._lock:
+            for device_id, state, ts, kind, value in states:
+                info = self._devices.get(device_id)
+                if info:
+                    self._devices[device_id] = replace(
+                        info, last_state=state, last_updated=ts, last_kind=kind, last_value=value
+                    )
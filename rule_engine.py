@@ -1,41 +1,411 @@
+import ast
 import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from types import CodeType
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import config
+import payload_types
 import persistence as db
+from action_executor import ActionExecutor
+from aggregates import WindowStore, event_time
+from rule_gate import TriggerGate
+from rule_stats import LatencyHistogram, RuleStats, RuleStatsRow, sort_rows
+from threshold_rules import ThresholdIndex, ThresholdSpec
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass(frozen=True)
+class CompiledRule:
+    """Regla con condición y acción ya compiladas a code objects."""
+    id: int
+    name: str
+    condition_src: str
+    action_src: str
+    condition: CodeType
+    action: CodeType
+    devices: Optional[FrozenSet[str]]  # None = comodín (puede casar con cualquiera)
+    rearm: Optional[CodeType] = None   # histéresis: condición para volver a armarse
+    gate: TriggerGate = field(default_factory=TriggerGate, compare=False, repr=False)
+    stats: RuleStats = field(default_factory=RuleStats, compare=False, repr=False)
+
+
+@dataclass(frozen=True)
+class RuleSet:
+    """Conjunto inmutable de reglas compiladas con su índice por dispositivo."""
+    rules: Tuple[CompiledRule, ...] = ()
+    # device_id -> reglas candidatas (específicas + comodín, en orden de id)
+    by_device: Dict[str, Tuple[CompiledRule, ...]] = field(default_factory=dict)
+    wildcard: Tuple[CompiledRule, ...] = ()
+    # Reglas de umbral declarativas, indexadas por dispositivo y valor
+    thresholds: ThresholdIndex = field(default_factory=ThresholdIndex)
+
+    @classmethod
+    def build(cls, rules: List[CompiledRule], thresholds: List[ThresholdSpec] = ()) -> "RuleSet":
+        rules = sorted(rules, key=lambda r: r.id)
+        wildcard = tuple(r for r in rules if r.devices is None)
+        by_device: Dict[str, List[CompiledRule]] = {}
+        for r in rules:
+            for device_id in r.devices or ():
+                by_device.setdefault(device_id, []).append(r)
+        index = {
+            device_id: tuple(sorted(specific + list(wildcard), key=lambda r: r.id))
+            for device_id, specific in by_device.items()
+        }
+        return cls(tuple(rules), index, wildcard, ThresholdIndex(thresholds))
+
+    def for_device(self, device_id: str) -> Tuple[CompiledRule, ...]:
+        return self.by_device.get(device_id, self.wildcard)
+
+
+def _device_ids_in(node: ast.AST) -> Optional[FrozenSet[str]]:
+    """
+    Si `node` es `event.device_id == 'x'` (o `in ('x', 'y')`), devuelve esos ids.
+    """
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1):
+        return None
+    left, op, right = node.left, node.ops[0], node.comparators[0]
+
+    def is_device_attr(n):
+        return (isinstance(n, ast.Attribute) and n.attr == "device_id"
+                and isinstance(n.value, ast.Name) and n.value.id == "event")
+
+    def const_str(n):
+        return n.value if isinstance(n, ast.Constant) and isinstance(n.value, str) else None
+
+    if isinstance(op, ast.Eq):
+        if is_device_attr(left) and const_str(right) is not None:
+            return frozenset({const_str(right)})
+        if is_device_attr(right) and const_str(left) is not None:
+            return frozenset({const_str(left)})
+    if isinstance(op, ast.In) and is_device_attr(left) and isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+        values = [const_str(e) for e in right.elts]
+        if all(v is not None for v in values):
+            return frozenset(values)
+    return None
+
+
+def referenced_devices(condition: str) -> Optional[FrozenSet[str]]:
+    """
+    Dispositivos a los que se limita una condición, o None si puede casar con
+    cualquiera. Sólo se tienen en cuenta comparaciones sobre event.device_id
+    en el nivel superior de la expresión o de un `and`: bajo `or`/`not` no
+    restringen nada.
+    """
+    body = ast.parse(condition, mode="eval").body
+    terms = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+    devices = None
+    for term in terms:
+        ids = _device_ids_in(term)
+        if ids is not None:
+            devices = ids if devices is None else devices & ids
+    return devices
+
+
+def compile_rule(rule: db.Rule) -> CompiledRule:
+    """Compila una fila de 'rules'. Lanza SyntaxError si el código no es válido."""
+    return CompiledRule(
+        id=rule.id,
+        name=rule.name,
+        condition_src=rule.condition,
+        action_src=rule.action,
+        condition=compile(rule.condition, f"<rule {rule.id} condition>", "eval"),
+        action=compile(rule.action, f"<rule {rule.id} action>", "exec"),
+        devices=referenced_devices(rule.condition),
+        rearm=compile(rule.rearm, f"<rule {rule.id} rearm>", "eval") if rule.rearm else None,
+        gate=TriggerGate(rule.cooldown or 0.0, rearm_required=bool(rule.edge or rule.rearm)),
+    )
+
+
 class RuleEngine:
     """Carga reglas desde la BD y evalúa cada evento que llega."""
 
     def __init__(self, controller):
         self.controller = controller
-        self._rules = []
-        self._load_rules_from_db()
+        # Las acciones se ejecutan fuera del hilo de ingesta, con timeout
+        self.executor = ActionExecutor(controller)
+        # Agregados por dispositivo para las reglas: window.mean, window.max...
+        self.windows = WindowStore()
+        # Un id dado de baja y vuelto a dar de alta empieza con la ventana vacía
+        controller.registry.add_remove_listener(self.windows.discard)
+        # Coste de la búsqueda de umbrales por dispositivo (para stats())
+        self._lookup_stats: Dict[str, LatencyHistogram] = {}
+        self._ruleset = RuleSet()
+        self._version = 0
+        self._reload_lock = threading.Lock()
+        self._load_rules()
+        # Las reglas compiladas viajan en el snapshot del Controller
+        controller.add_snapshot_section("rules", self.dump_rules)
 
         # el controller avisará de cada nuevo Event
         controller.register_listener(self._on_event)
 
+        # Sondeo barato de rule_meta.version para ver cambios de otros procesos
+        self._stop = threading.Event()
+        self.poll_interval = config.RULE_POLL_INTERVAL
+        if self.poll_interval > 0:
+            threading.Thread(target=self._poll, name="rule-poller", daemon=True).start()
+
+    @staticmethod
+    def _compile_rows(rows, threshold_rows):
+        compiled = {}
+        for rule in rows:
+            try:
+                compiled[rule.id] = compile_rule(rule)
+            except SyntaxError as exc:
+                logger.error("Regla '%s' no compila, se ignora: %s", rule.name, exc)
+        thresholds = {}
+        for row in threshold_rows:
+            try:
+                thresholds[row.id] = ThresholdSpec.from_row(row)
+            except ValueError as exc:
+                logger.error("Regla de umbral '%s' no válida, se ignora: %s", row.name, exc)
+        return compiled, thresholds
+
     def _load_rules_from_db(self) -> None:
-        """Lee todas las reglas de la tabla 'rules'."""
-        with db.get_session() as s:
-            self._rules = s.query(db.Rule).all()
-        logger.info("Cargadas %d reglas", len(self._rules))
+        """Lee las reglas de 'rules' y 'threshold_rules', las compila y las indexa."""
+        with self._reload_lock:
+            version, rows, threshold_rows = db.load_rules()
+            compiled, thresholds = self._compile_rows(rows, threshold_rows)
+            # Una sola asignación: un evento en curso sigue con el RuleSet anterior
+            self._ruleset = RuleSet.build(list(compiled.values()), list(thresholds.values()))
+            self._version = version
+        logger.info("Cargadas %d reglas (%d de umbral), versión %d",
+                    len(compiled), len(thresholds), version)
+
+    def _load_rules(self) -> None:
+        """
+        Si el Controller arrancó desde un snapshot, restaura de ahí las reglas
+        ya compiladas y aplica sólo los cambios posteriores; si no, las lee
+        y compila desde la BD.
+        """
+        sections = getattr(self.controller, "snapshot", None)
+        snap = sections.get("rules") if isinstance(sections, dict) else None
+        if snap is not None and snap["version"] > db.rules_version():
+            # BD restaurada o sustituida: el snapshot trae reglas que ya no existen
+            logger.warning("Snapshot de reglas (versión %d) más nuevo que la BD; se ignora",
+                           snap["version"])
+            snap = None
+        if snap is not None:
+            t0 = time.perf_counter()
+            try:
+                self._restore_rules(snap)
+            except Exception:
+                logger.exception("Reglas del snapshot no utilizables; se cargan desde la BD")
+            else:
+                logger.info("Restauradas %d reglas (%d de umbral) del snapshot en %.1f ms, versión %d",
+                            len(self._ruleset.rules), len(self._ruleset.thresholds),
+                            (time.perf_counter() - t0) * 1000, self._version)
+                self.refresh()
+                return
+        self._load_rules_from_db()
+
+    def dump_rules(self) -> dict:
+        """Sección 'rules' del snapshot: versión y reglas con sus code objects."""
+        with self._reload_lock:
+            ruleset, version = self._ruleset, self._version
+        return {
+            "version": version,
+            "rules": tuple(
+                (r.id, r.name, r.condition_src, r.action_src, r.condition, r.action,
+                 tuple(r.devices) if r.devices is not None else None, r.rearm,
+                 r.gate.cooldown, r.gate.rearm_required)
+                for r in ruleset.rules
+            ),
+            "thresholds": tuple(
+                (t.id, t.name, t.device_id, t.op, t.low, t.high, t.target_device, t.command,
+                 t.cooldown, t.edge, t.hysteresis)
+                for t in ruleset.thresholds.specs
+            ),
+        }
+
+    def _restore_rules(self, snap: dict) -> None:
+        rules = [
+            CompiledRule(
+                id=id_, name=name, condition_src=cond_src, action_src=action_src,
+                condition=cond, action=action,
+                devices=frozenset(devices) if devices is not None else None,
+                rearm=rearm, gate=TriggerGate(cooldown, rearm_required=rearm_required),
+            )
+            for (id_, name, cond_src, action_src, cond, action, devices, rearm,
+                 cooldown, rearm_required) in snap["rules"]
+        ]
+        thresholds = [ThresholdSpec(*row) for row in snap["thresholds"]]
+        with self._reload_lock:
+            self._ruleset = RuleSet.build(rules, thresholds)
+            self._version = snap["version"]
+
+    def refresh(self) -> bool:
+        """
+        Aplica sólo los cambios posteriores a la versión cargada: compila las
+        reglas nuevas o modificadas, quita las borradas y conserva el resto
+        (con su estado de flanco/cooldown). Devuelve True si hubo cambios.
+        """
+        current = db.rules_version()
+        if current == self._version:
+            return False
+        if current < self._version:
+            # La versión sólo crece: si baja, la BD se ha restaurado o cambiado
+            # y los cambios incrementales no dirían qué sobra
+            logger.warning("La versión de reglas de la BD (%d) es menor que la cargada (%d); "
+                           "recarga completa", current, self._version)
+            self._load_rules_from_db()
+            return True
+        with self._reload_lock:
+            version, rows, threshold_rows = db.rules_changed_since(self._version)
+            if version == self._version:
+                return False
+            current = self._ruleset
+            rules = {r.id: r for r in current.rules}
+            thresholds = {t.id: t for t in current.thresholds.specs}
+            for row in rows:
+                rules.pop(row.id, None)
+            for row in threshold_rows:
+                thresholds.pop(row.id, None)
+            compiled, new_thresholds = self._compile_rows(
+                [r for r in rows if not r.deleted], [t for t in threshold_rows if not t.deleted]
+            )
+            rules.update(compiled)
+            thresholds.update(new_thresholds)
+            self._ruleset = RuleSet.build(list(rules.values()), list(thresholds.values()))
+            self._version = version
+        logger.info("Reglas actualizadas a la versión %d (%d cambios)",
+                    version, len(rows) + len(threshold_rows))
+        return True
 
     def reload_rules(self) -> None:
         """
         Permite recargar las reglas desde la BD sin reiniciar el motor.
+        Sólo se recompilan las que han cambiado desde la última carga.
         """
-        self._load_rules_from_db()
+        self.refresh()
         logger.info("Las reglas se han recargado correctamente.")
 
+    def _poll(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Error sondeando cambios de reglas")
+
+    def close(self) -> None:
+        self._stop.set()
+        self.executor.shutdown()
+
+    def rules_for(self, device_id: str) -> Tuple[CompiledRule, ...]:
+        """Reglas que pueden casar con un evento de `device_id`."""
+        return self._ruleset.for_device(device_id)
+
     def _on_event(self, event: db.Event) -> None:
         """
-        Para cada evento, comprueba las reglas y ejecuta la acción si procede.
+        Para cada evento, comprueba las reglas y encola la acción si procede.
+        Las condiciones se evalúan aquí; las acciones, en el ActionExecutor.
         """
-        for rule in self._rules:
+        ruleset = self._ruleset
+        # Ventanas y umbrales usan el valor ya clasificado en la ingesta
+        kind, value = event.value_kind, event.value_num
+        if kind is None:
+            # Evento no pasado por la ingesta (p.ej. construido a mano)
+            kind, value = payload_types.classify(event.payload)
+        if kind != payload_types.NUM:
+            value = None
+        window = self.windows.push(event.device_id, event_time(event.created_at), value)
+        names = {"event": event, "window": window, "window_of": self.windows.get}
+
+        device_id = event.device_id
+        now = time.monotonic()
+
+        for rule in ruleset.for_device(device_id):
+            stats = rule.stats
+            stats.evaluations += 1
+            t0 = time.perf_counter()
             try:
-                # Evaluamos la condición textual:
-                if eval(rule.condition, {}, {"event": event}):
-                    logger.info("Regla '%s' disparada", rule.name)
-                    exec(rule.action, {}, {"controller": self.controller, "event": event})
+                fire = self._should_fire(rule, names, device_id, now)
             except Exception as exc:
+                stats.errors += 1
                 logger.error("Error en regla '%s': %s", rule.name, exc)
+                continue
+            finally:
+                stats.condition.record(time.perf_counter() - t0)
+            if fire:
+                stats.fires += 1
+                logger.info("Regla '%s' disparada", rule.name)
+                self.executor.submit(
+                    f"{rule.name} (#{rule.id})", event,
+                    _timed(stats, lambda ctl, code=rule.action: exec(code, {}, {**names, "controller": ctl})),
+                )
+
+        if value is None or not len(ruleset.thresholds):
+            return
+        t0 = time.perf_counter()
+        for spec in ruleset.thresholds.gated(device_id):
+            if not spec.gate.is_armed(device_id) and spec.rearms(value):
+                spec.gate.arm(device_id)
+        matched = ruleset.thresholds.match(device_id, value)
+        elapsed = time.perf_counter() - t0
+        lookups = self._lookup_stats.get(device_id)
+        if lookups is None:
+            lookups = self._lookup_stats[device_id] = LatencyHistogram()
+        lookups.record(elapsed)
+        for spec in matched:
+            if not spec.gate.try_fire(device_id, now):
+                continue
+            spec.stats.fires += 1
+            logger.info("Regla '%s' disparada", spec.name)
+            self.executor.submit(
+                f"{spec.name} (#T{spec.id})", event,
+                _timed(spec.stats, lambda ctl, s=spec: ctl.send_command(s.target_device, s.command)),
+            )
+
+    @staticmethod
+    def _should_fire(rule: CompiledRule, names: dict, device_id: str, now: float) -> bool:
+        """Evalúa la condición y aplica flanco/histéresis/cooldown de la regla."""
+        active = eval(rule.condition, {}, names)
+        gate = rule.gate
+        if gate.plain or (not active and gate.is_armed(device_id)):
+            return bool(active)
+        if not gate.is_armed(device_id):
+            # Flanco: se rearma al volver a falso; histéresis: con `rearm`
+            if rule.rearm is not None:
+                if eval(rule.rearm, {}, names):
+                    gate.arm(device_id)
+            elif not active:
+                gate.arm(device_id)
+        return bool(active) and gate.try_fire(device_id, now)
+
+    def stats(self, sort_by: str = "total_time") -> List[RuleStatsRow]:
+        """
+        Métricas de cada regla vigente, de más a menos costosa (o por
+        evaluations/fires/errors). En las de umbral la evaluación es la
+        búsqueda en el índice de su dispositivo, compartida entre ellas.
+        Los contadores se actualizan sin cerrojo: son aproximados si varios
+        shards evalúan la misma regla a la vez.
+        """
+        ruleset = self._ruleset
+        rows = [RuleStatsRow.from_stats(str(r.id), r.name, r.stats) for r in ruleset.rules]
+        for spec in ruleset.thresholds.specs:
+            merged = RuleStats()
+            lookups = self._lookup_stats.get(spec.device_id)
+            if lookups is not None:
+                merged.evaluations = lookups.count
+                merged.condition = lookups
+            merged.fires, merged.errors, merged.action = spec.stats.fires, spec.stats.errors, spec.stats.action
+            rows.append(RuleStatsRow.from_stats(f"T{spec.id}", spec.name, merged))
+        return sort_rows(rows, sort_by)
+
+
+def _timed(stats: RuleStats, action):
+    """Envuelve una acción para medir su duración y contar sus errores."""
+    def run(ctl):
+        t0 = time.perf_counter()
+        try:
+            action(ctl)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.action.record(time.perf_counter() - t0)
+    return run
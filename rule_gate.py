@@ -0,0 +1,55 @@
+"""
+rule_gate.py - Antirrebote, disparo por flanco e histéresis de las reglas
+"""
+
+from __future__ import annotations
+import math
+from typing import Dict, List
+
+
+class TriggerGate:
+    """
+    Estado de disparo de una regla, por dispositivo.
+
+    - cooldown: segundos mínimos entre dos disparos para el mismo dispositivo.
+    - rearm_required: tras disparar la regla queda desarmada hasta que quien
+      la evalúa llame a arm() (al volver a falso en modo flanco, o al salir de
+      la banda de histéresis).
+
+    Cada dispositivo se procesa siempre en el mismo shard de ingesta, así que
+    su estado sólo lo toca un hilo y no hace falta cerrojo.
+    """
+
+    __slots__ = ("cooldown", "rearm_required", "_state")
+
+    def __init__(self, cooldown: float = 0.0, rearm_required: bool = False) -> None:
+        self.cooldown = cooldown or 0.0
+        self.rearm_required = rearm_required
+        # device_id -> [armada, instante del último disparo]
+        self._state: Dict[str, List] = {}
+
+    @property
+    def plain(self) -> bool:
+        """Sin cooldown ni rearme: la regla dispara siempre que se cumple."""
+        return not self.cooldown and not self.rearm_required
+
+    def is_armed(self, device_id: str) -> bool:
+        state = self._state.get(device_id)
+        return state is None or state[0]
+
+    def arm(self, device_id: str) -> None:
+        state = self._state.get(device_id)
+        if state is not None:
+            state[0] = True
+
+    def try_fire(self, device_id: str, now: float) -> bool:
+        """Registra un disparo si la regla está armada y fuera de cooldown."""
+        if self.plain:
+            return True
+        state = self._state.setdefault(device_id, [True, -math.inf])
+        if not state[0] or now - state[1] < self.cooldown:
+            return False
+        state[1] = now
+        if self.rearm_required:
+            state[0] = False
+        return True
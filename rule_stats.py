@@ -0,0 +1,115 @@
+"""
+rule_stats.py - Métricas por regla: evaluaciones, disparos, errores y latencias
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import List
+
+# Cubetas log2 en microsegundos: la i cubre [2^(i-1), 2^i) µs; la última, el resto
+_BUCKETS = 32
+
+
+class LatencyHistogram:
+    """
+    Histograma de latencias con cubetas potencia de dos: registrar es un
+    bit_length y una suma, sin listas que crezcan. Los percentiles son
+    aproximados (cota superior de la cubeta).
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0   # segundos
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        i = int(seconds * 1_000_000).bit_length()
+        self.buckets[i if i < _BUCKETS else _BUCKETS - 1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Percentil p (0-100) aproximado, en segundos."""
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1_000_000, self.max)
+        return self.max
+
+
+class RuleStats:
+    """Contadores e histogramas de una regla."""
+
+    __slots__ = ("evaluations", "fires", "errors", "condition", "action")
+
+    def __init__(self) -> None:
+        self.evaluations = 0
+        self.fires = 0
+        self.errors = 0
+        self.condition = LatencyHistogram()
+        self.action = LatencyHistogram()
+
+    @property
+    def total_time(self) -> float:
+        return self.condition.total + self.action.total
+
+
+@dataclass(frozen=True)
+class RuleStatsRow:
+    """Resumen de RuleStats para mostrar u ordenar."""
+    key: str             # id de la regla ('3', 'T3' para las de umbral)
+    name: str
+    evaluations: int
+    fires: int
+    errors: int
+    condition_avg_us: float
+    condition_p95_us: float
+    action_avg_ms: float
+    action_p95_ms: float
+    total_time_s: float
+
+    @classmethod
+    def from_stats(cls, key: str, name: str, stats: RuleStats) -> "RuleStatsRow":
+        return cls(
+            key=key,
+            name=name,
+            evaluations=stats.evaluations,
+            fires=stats.fires,
+            errors=stats.errors,
+            condition_avg_us=stats.condition.mean * 1e6,
+            condition_p95_us=stats.condition.percentile(95) * 1e6,
+            action_avg_ms=stats.action.mean * 1e3,
+            action_p95_ms=stats.action.percentile(95) * 1e3,
+            total_time_s=stats.total_time,
+        )
+
+    def describe(self) -> str:
+        return (
+            f"**{self.key}** {self.name}: {self.evaluations} eval, {self.fires} disparos, "
+            f"{self.errors} errores · cond {self.condition_avg_us:.0f}µs (p95 {self.condition_p95_us:.0f}) "
+            f"· acción {self.action_avg_ms:.1f}ms (p95 {self.action_p95_ms:.1f}) "
+            f"· total {self.total_time_s:.3f}s"
+        )
+
+
+SORT_KEYS = ("total_time", "evaluations", "fires", "errors")
+
+
+def sort_rows(rows: List[RuleStatsRow], sort_by: str = "total_time") -> List[RuleStatsRow]:
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"Orden no soportado: {sort_by} (usa {', '.join(SORT_KEYS)})")
+    attr = "total_time_s" if sort_by == "total_time" else sort_by
+    return sorted(rows, key=lambda r: getattr(r, attr), reverse=True)
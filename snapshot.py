@@ -0,0 +1,73 @@
+"""
+snapshot.py - Instantánea en disco del estado del Controller para arrancar en milisegundos
+
+Un snapshot es un diccionario de secciones (registro de dispositivos,
+reglas ya compiladas...) serializado con marshal, que admite code objects,
+así que las reglas no se vuelven a parsear ni compilar al arrancar.
+
+Formato: b"IOTSNAP1" · magic de bytecode de Python (4 bytes) · crc32 (uint32)
+· payload marshal. marshal sólo es estable dentro de una misma versión de
+Python: si el magic no coincide, el snapshot se ignora y se arranca desde
+SQLite como siempre.
+"""
+
+from __future__ import annotations
+import importlib.util
+import logging
+import marshal
+import os
+import struct
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"IOTSNAP1"
+_CRC = struct.Struct("<I")
+_HEADER_SIZE = len(MAGIC) + len(importlib.util.MAGIC_NUMBER) + _CRC.size
+
+
+def save(path: str, sections: Dict[str, Any]) -> int:
+    """
+    Escribe el snapshot de forma atómica (fichero temporal + rename).
+    Devuelve el tamaño en bytes.
+    """
+    payload = marshal.dumps({"written_at": time.time(), "sections": sections})
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(importlib.util.MAGIC_NUMBER)
+        fh.write(_CRC.pack(zlib.crc32(payload)))
+        fh.write(payload)
+    os.replace(tmp, path)
+    return _HEADER_SIZE + len(payload)
+
+
+def load(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Lee un snapshot: {"written_at": epoch, "sections": {...}}. None si no
+    existe o no es utilizable (otra versión de Python, corrupto...).
+    """
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return None
+    if data[:len(MAGIC)] != MAGIC:
+        logger.warning("Snapshot %s ignorado: formato desconocido", path)
+        return None
+    magic = data[len(MAGIC):len(MAGIC) + len(importlib.util.MAGIC_NUMBER)]
+    if magic != importlib.util.MAGIC_NUMBER:
+        logger.info("Snapshot %s ignorado: escrito con otra versión de Python", path)
+        return None
+    (crc,) = _CRC.unpack_from(data, _HEADER_SIZE - _CRC.size)
+    payload = data[_HEADER_SIZE:]
+    if zlib.crc32(payload) != crc:
+        logger.warning("Snapshot %s ignorado: checksum incorrecto", path)
+        return None
+    try:
+        return marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        logger.warning("Snapshot %s ignorado: no se puede decodificar", path)
+        return None
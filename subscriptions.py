@@ -0,0 +1,68 @@
+"""
+subscriptions.py - Índice de suscripciones canal <- dispositivo / tipo / patrón
+
+Una suscripción liga un canal de Discord a:
+  device   un device_id concreto            (!subscribe temp01)
+  type     todos los de un tipo             (!subscribe type:sensor)
+  pattern  device_ids que casan con un glob (!subscribe "temp*")
+
+El índice es inmutable: se reconstruye entero al cambiar las suscripciones
+(pocas y poco frecuentes) y cada evento se resuelve con una búsqueda en un
+dict; el resultado se memoriza por (device_id, tipo), así los patrones sólo
+se evalúan la primera vez que aparece cada dispositivo.
+"""
+
+from __future__ import annotations
+import fnmatch
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+KINDS = ("device", "type", "pattern")
+_GLOB_CHARS = set("*?[")
+
+
+def parse_target(text: str) -> Tuple[str, str]:
+    """'type:sensor' -> ('type', 'sensor'); 'temp*' -> ('pattern', 'temp*'); si no, device."""
+    if text.lower().startswith("type:") and len(text) > 5:
+        return "type", text[5:]
+    if _GLOB_CHARS & set(text):
+        return "pattern", text
+    return "device", text
+
+
+def describe_target(kind: str, target: str) -> str:
+    return {"device": target, "type": f"type:{target}", "pattern": f"`{target}`"}[kind]
+
+
+class SubscriptionIndex:
+    """device_id / tipo / patrón -> ids de canal."""
+
+    def __init__(self, rows: Iterable[Tuple[int, str, str]] = ()) -> None:
+        self._by_device: Dict[str, set] = {}
+        self._by_type: Dict[str, set] = {}
+        patterns: Dict[str, set] = {}
+        self.size = 0
+        for channel_id, kind, target in rows:
+            table = {"device": self._by_device, "type": self._by_type, "pattern": patterns}[kind]
+            table.setdefault(target, set()).add(channel_id)
+            self.size += 1
+        self._patterns: List[Tuple[str, FrozenSet[int]]] = [
+            (p, frozenset(ids)) for p, ids in patterns.items()
+        ]
+        self._cache: Dict[Tuple[str, Optional[str]], FrozenSet[int]] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def channels_for(self, device_id: str, device_type: Optional[str] = None) -> FrozenSet[int]:
+        key = (device_id, device_type)
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit
+        ids = set(self._by_device.get(device_id, ()))
+        if device_type is not None:
+            ids.update(self._by_type.get(device_type, ()))
+        for pattern, channels in self._patterns:
+            if fnmatch.fnmatchcase(device_id, pattern):
+                ids.update(channels)
+        result = self._cache[key] = frozenset(ids)
+        return result
@@ -0,0 +1,82 @@
+"""
+Pruebas de la capa asíncrona de BD: mismas tablas y misma versión de reglas
+que el lado síncrono.
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+import async_persistence as adb
+import persistence as db
+
+class TestAsyncPersistence(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # Fichero temporal: los dos motores tienen que ver la misma BD
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "test.db")
+
+        db._engine.dispose()
+        db._engine = db.create_engine(f"sqlite:///{path}", echo=False)
+        db.Base.metadata.create_all(bind=db._engine)
+        db.SessionLocal.configure(bind=db._engine)
+
+        adb._engine = adb.create_async_engine(f"sqlite+aiosqlite:///{path}", echo=False)
+        adb.AsyncSessionLocal.configure(bind=adb._engine)
+
+    async def asyncTearDown(self):
+        await adb.dispose()
+        db._engine.dispose()
+
+    async def test_device_crud(self):
+        self.assertIsNotNone(await adb.add_device("temp01", "sensor"))
+        self.assertIsNone(await adb.add_device("temp01", "sensor"))
+        self.assertTrue(await adb.set_device_type("temp01", "switch"))
+        with db.get_session() as s:
+            self.assertEqual(s.query(db.Device).filter_by(device_id="temp01").one().device_type, "switch")
+        self.assertTrue(await adb.delete_device("temp01"))
+        self.assertFalse(await adb.delete_device("temp01"))
+        self.assertFalse(await adb.set_device_type("temp01", "sensor"))
+
+    async def test_rules_bump_shared_version(self):
+        """Las altas y bajas async avanzan la versión que sondea el motor de reglas."""
+        rule = await adb.add_rule(db.Rule, name="r", condition="True", action="pass")
+        await adb.add_rule(db.ThresholdRule, name="t", device_id="temp01", op=">", low=1.0,
+                           target_device="boiler", command="ON")
+        self.assertEqual(db.rules_version(), 2)
+        self.assertEqual([r.name for r in await adb.list_rules(db.Rule)], ["r"])
+
+        self.assertTrue(await adb.delete_rule(db.Rule, rule.id))
+        self.assertFalse(await adb.delete_rule(db.Rule, rule.id))
+        self.assertEqual(await adb.list_rules(db.Rule), [])
+        version, changed, _ = db.rules_changed_since(2)
+        self.assertEqual((version, [r.deleted for r in changed]), (3, [True]))
+
+    async def test_rules_version_row_seeded(self):
+        """
+        La fila de versión existe desde el principio (también en una BD
+        antigua sin ella), así que altas simultáneas sólo hacen UPDATE.
+        """
+        self.assertEqual(db.rules_version(), 0)
+        with db._engine.begin() as conn:
+            conn.execute(db.text("DELETE FROM rule_meta"))
+        db.init_db()
+        self.assertEqual(db.rules_version(), 0)
+
+        await asyncio.gather(*(
+            adb.add_rule(db.Rule, name=f"r{i}", condition="True", action="pass") for i in range(5)
+        ))
+        self.assertEqual(db.rules_version(), 5)
+
+    async def test_subscriptions(self):
+        channel = 123456789012345678   # los ids de Discord no caben en 32 bits
+        self.assertTrue(await adb.add_subscription(channel, "type", "sensor"))
+        self.assertFalse(await adb.add_subscription(channel, "type", "sensor"))
+        subs = await adb.list_subscriptions()
+        self.assertEqual([(s.channel_id, s.kind, s.target) for s in subs], [(channel, "type", "sensor")])
+        self.assertTrue(await adb.delete_subscription(channel, "type", "sensor"))
+        self.assertFalse(await adb.delete_subscription(channel, "type", "sensor"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,17 @@
 Pruebas del Controller: rechazo de dispositivos desconocidos, notificación a listeners, etc.
 """
 
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
+from sqlalchemy.pool import StaticPool
+import config
 import persistence as db
+import rule_engine
 from controller import Controller
 from mqtt_client import MQTTClient
+from registry import DeviceInfo
 from rule_engine import RuleEngine
 
 class TestController(unittest.TestCase):
@@ -16,10 +22,21 @@ class TestController(unittest.TestCase):
         y crea un Controller con un MQTTClient mockeado.
         """
         db._engine.dispose()
-        db._engine = db.create_engine("sqlite:///:memory:", echo=False)
+        # StaticPool: el hilo escritor de la ingesta comparte la misma BD en memoria
+        db._engine = db.create_engine(
+            "sqlite:///:memory:",
+            echo=False,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
         db.Base.metadata.create_all(bind=db._engine)
         db.SessionLocal.configure(bind=db._engine)
 
+        # Sin snapshot en disco: cada test arranca sólo desde la BD
+        patcher = patch.object(config, "SNAPSHOT_PATH", "")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         self.mock_mqtt = MagicMock(spec=MQTTClient)
         with patch("controller.MQTTClient", return_value=self.mock_mqtt):
             self.controller = Controller("redes2/9999/99")
@@ -27,6 +44,9 @@ class TestController(unittest.TestCase):
         # Arrancamos el Controller
         self.controller.start()
 
+    def tearDown(self):
+        self.controller.stop()
+
     def test_ignore_unregistered_device(self):
         """
         Verifica que el Controller ignora (rechaza) mensajes de un device_id no registrado.
@@ -37,6 +57,7 @@ class TestController(unittest.TestCase):
             "redes2/9999/99/no_existe/status",
             "SOME_STATE"
         )
+        self.controller.flush()
         # Comprobamos en la BD que no haya creado un device "no_existe"
         with db.get_session() as session:
             dev = session.query(db.Device).filter_by(device_id="no_existe").one_or_none()
@@ -52,6 +73,7 @@ class TestController(unittest.TestCase):
             session.add(d)
             session.commit()
             d_id = d.id
+        self.controller.registry.load()
 
         # Registramos un listener de prueba
         fake_listener = MagicMock()
@@ -62,6 +84,7 @@ class TestController(unittest.TestCase):
             "redes2/9999/99/sensorTest/status",
             "22.5"
         )
+        self.controller.flush()
 
         # Revisamos que 'fake_listener' se invocó una vez con un evento
         fake_listener.assert_called_once()
@@ -81,22 +104,287 @@ class TestController(unittest.TestCase):
         """
         # Crea RuleEngine
         re = RuleEngine(self.controller)
+        self.addCleanup(re.close)
         # No hay reglas, pero al registrar uno con (controller.register_listener)
         # ya tenemos su "listener" en la pipeline.
         # Simulamos un dispositivo conocido:
         with db.get_session() as s:
             s.add(db.Device(device_id="some_dev", device_type="switch"))
             s.commit()
+        self.controller.registry.load()
 
         # Mandamos un mensaje:
         self.controller._handle_mqtt_message(
             "redes2/9999/99/some_dev/status",
             "ON"
         )
-  
+        self.controller.flush()
+
         with db.get_session() as s:
             evt = s.query(db.Event).filter_by(device_id="some_dev").first()
             self.assertIsNotNone(evt, "Se debió persistir un evento")
 
+    def test_batched_ingest_keeps_order(self):
+        """
+        Varios mensajes se persisten en lote: todos los eventos, el último estado
+        por dispositivo, y los listeners reciben los eventos de cada dispositivo
+        en orden de llegada.
+        """
+        with db.get_session() as s:
+            s.add_all([
+                db.Device(device_id="a", device_type="sensor"),
+                db.Device(device_id="b", device_type="sensor"),
+            ])
+            s.commit()
+        self.controller.registry.load()
+
+        received = []
+        self.controller.register_listener(lambda ev: received.append((ev.device_id, ev.payload)))
+
+        msgs = [("a", "1"), ("b", "10"), ("a", "2"), ("ghost", "x"), ("a", "3"), ("b", "20")]
+        for dev_id, payload in msgs:
+            self.controller._handle_mqtt_message(f"redes2/9999/99/{dev_id}/status", payload)
+        self.controller.flush()
+
+        # El orden se garantiza por dispositivo (cada uno cae siempre en el mismo shard)
+        for dev_id in ("a", "b"):
+            self.assertEqual(
+                [m for m in received if m[0] == dev_id],
+                [m for m in msgs if m[0] == dev_id],
+            )
+        with db.get_session() as s:
+            self.assertEqual(s.query(db.Event).count(), 5)
+            states = {d.device_id: d.last_state for d in s.query(db.Device).all()}
+        self.assertEqual(states, {"a": "3", "b": "20"})
+        self.assertEqual(self.controller.registry.get("a").last_state, "3")
+
+    def test_payloads_classified_once(self):
+        """La ingesta guarda el tipo y el valor numérico del payload en el evento y el dispositivo."""
+        with db.get_session() as s:
+            s.add(db.Device(device_id="boiler", device_type="switch"))
+            s.commit()
+        self.controller.registry.load()
+        for payload in ("21.5", "ON", "07:30", "ERR"):
+            self.controller._handle_mqtt_message("redes2/9999/99/boiler/status", payload)
+        self.controller.flush()
+
+        with db.get_session() as s:
+            typed = [(e.value_kind, e.value_num) for e in s.query(db.Event).order_by(db.Event.id)]
+        self.assertEqual(typed, [("num", 21.5), ("bool", 1.0), ("time", 27000.0), ("text", None)])
+        info = self.controller.registry.get("boiler")
+        self.assertEqual((info.last_kind, info.last_value), ("text", None))
+
+    def test_ingest_shard_stats(self):
+        """
+        Los mensajes de un mismo dispositivo van siempre al mismo shard y sus
+        métricas reflejan lo procesado.
+        """
+        with db.get_session() as s:
+            s.add(db.Device(device_id="chatty", device_type="sensor"))
+            s.commit()
+        self.controller.registry.load()
+
+        for i in range(20):
+            self.controller._handle_mqtt_message("redes2/9999/99/chatty/status", str(i))
+        self.controller.flush()
+
+        stats = self.controller.ingest_stats()
+        busy = [st for st in stats if st.processed]
+        self.assertEqual(len(busy), 1)
+        self.assertEqual(busy[0].processed, 20)
+        self.assertEqual(busy[0].queue_depth, 0)
+        self.assertGreaterEqual(busy[0].max_latency_ms, busy[0].avg_latency_ms)
+
+    def test_ingest_retries_failed_batch(self):
+        """
+        Un fallo pasajero al escribir el lote (p.ej. "database is locked") se
+        reintenta; si un mensaje falla siempre, sólo se pierde ése y cuenta
+        en dropped.
+        """
+        from sqlalchemy.exc import OperationalError
+        with db.get_session() as s:
+            s.add(db.Device(device_id="temp01", device_type="sensor"))
+            s.commit()
+        self.controller.registry.load()
+        store = self.controller.event_store
+        real_write = store.write
+        calls = []
+
+        def flaky_write(session, events):
+            calls.append(len(events))
+            if len(calls) == 1 or any(ev.payload == "bad" for ev in events):
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+            real_write(session, events)
+
+        with patch.object(config, "INGEST_RETRY_BACKOFF", 0), \
+                patch.object(store, "write", flaky_write):
+            for payload in ("1", "2"):
+                self.controller._handle_mqtt_message("redes2/9999/99/temp01/status", payload)
+            self.controller.flush()
+            with db.get_session() as s:
+                self.assertEqual([e.payload for e in s.query(db.Event).order_by(db.Event.id)], ["1", "2"])
+            self.assertEqual(sum(st.dropped for st in self.controller.ingest_stats()), 0)
+
+            for payload in ("3", "bad", "4"):
+                self.controller._handle_mqtt_message("redes2/9999/99/temp01/status", payload)
+            self.controller.flush()
+        with db.get_session() as s:
+            self.assertEqual([e.payload for e in s.query(db.Event).order_by(db.Event.id)],
+                             ["1", "2", "3", "4"])
+        self.assertEqual(sum(st.dropped for st in self.controller.ingest_stats()), 1)
+        self.assertEqual(self.controller.registry.get("temp01").last_state, "4")
+
+    def test_duplicate_commands_suppressed(self):
+        """
+        Un comando idéntico al último enviado a ese dispositivo dentro de la
+        ventana se suprime y se contabiliza; uno distinto o manual sí se envía.
+        """
+        self.assertTrue(self.controller.send_command("boiler", "ON"))
+        self.assertIsNone(self.controller.send_command("boiler", "ON"))
+        self.assertTrue(self.controller.send_command("boiler", "OFF"))
+        self.assertTrue(self.controller.send_command("boiler", "OFF", dedup=False))
+
+        self.assertEqual(self.mock_mqtt.publish.call_count, 3)
+        self.assertEqual(self.controller.commands_suppressed["boiler"], 1)
+        self.assertEqual(self.controller.commands_sent, 3)
+
+    def test_request_status_resolved_by_reply(self):
+        """
+        request_status devuelve un Future que se resuelve con la siguiente
+        respuesta del dispositivo (status, o ack con su id de correlación)
+        y anota el RTT en el histograma de la flota.
+        """
+        with db.get_session() as session:
+            session.add(db.Device(device_id="probe", device_type="sensor"))
+            session.commit()
+        self.controller.registry.load()
+
+        fut = self.controller.request_status("probe")
+        self.mock_mqtt.publish.assert_called_with("redes2/9999/99/probe", "GET_STATE", ttl=5.0)
+        self.assertFalse(fut.done())
+        self.controller._handle_mqtt_message("redes2/9999/99/probe/status", "ON")
+        reply = fut.result(timeout=1)
+        self.assertEqual((reply.device_id, reply.payload), ("probe", "ON"))
+        self.assertGreaterEqual(reply.rtt, 0)
+
+        fut = self.controller.request_status("probe", correlation_id="abc")
+        self.mock_mqtt.publish.assert_called_with("redes2/9999/99/probe", "GET_STATE abc", ttl=5.0)
+        self.controller._handle_mqtt_message("redes2/9999/99/probe/ack", "otro OFF")
+        self.assertFalse(fut.done())
+        self.controller._handle_mqtt_message("redes2/9999/99/probe/ack", "abc OFF")
+        self.assertEqual(fut.result(timeout=1).payload, "OFF")
+
+        self.assertEqual(self.controller.requests.rtt.count, 2)
+        self.assertEqual(self.controller.requests.pending(), 0)
+
+    def test_unanswered_requests_bounded(self):
+        """
+        Las peticiones sin respuesta no se acumulan: se cancelan al superar
+        el máximo por dispositivo o tras un timeout.
+        """
+        requests = self.controller.requests
+        requests.max_pending = 2
+        futs = [self.controller.request_status("mudo") for _ in range(3)]
+        self.assertTrue(futs[0].cancelled())
+        self.assertEqual(requests.pending(), 2)
+
+        requests.discard("mudo", futs[1])
+        self.assertEqual(requests.pending(), 1)
+        self.assertEqual(requests.expired, 2)
+
+    def test_snapshot_restart(self):
+        """
+        Tras un reinicio, registro y reglas compiladas salen del snapshot sin
+        recompilar; las reglas posteriores se aplican de forma incremental y el
+        registro se reconcilia con la BD.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.controller.snapshot_path = os.path.join(tmp.name, "state.snapshot")
+        with db.get_session() as s:
+            s.add_all([db.Device(device_id="temp01", device_type="sensor"),
+                       db.Device(device_id="boiler", device_type="switch")])
+            s.commit()
+        self.controller.registry.load()
+        db.add_rule(db.Rule, name="calor", condition="event.device_id == 'temp01' and event.value_num > 25",
+                    action="controller.send_command('boiler', 'OFF')", cooldown=30.0)
+        db.add_rule(db.ThresholdRule, name="frio", device_id="temp01", op="<", low=18.0,
+                    target_device="boiler", command="ON")
+        re = RuleEngine(self.controller)
+        self.addCleanup(re.close)
+        self.controller._handle_mqtt_message("redes2/9999/99/temp01/status", "21.5")
+        self.controller.flush()
+        self.assertGreater(self.controller.write_snapshot(), 0)
+
+        # Cambios tras el snapshot
+        db.add_rule(db.Rule, name="nueva", condition="False", action="pass")
+        with db.get_session() as s:
+            s.query(db.Device).filter_by(device_id="boiler").delete()
+            s.commit()
+
+        with patch("controller.MQTTClient", return_value=MagicMock(spec=MQTTClient)):
+            restarted = Controller("redes2/9999/99")
+        restarted.snapshot_path = self.controller.snapshot_path
+        with patch.object(restarted, "_reconcile"):
+            restarted._restore_state()
+        self.assertIsNotNone(restarted.snapshot_load_ms)
+        self.assertEqual(restarted.registry.get("temp01").last_value, 21.5)
+        self.assertIn("boiler", restarted.registry)
+
+        with patch.object(rule_engine, "compile_rule", wraps=rule_engine.compile_rule) as compiled:
+            re2 = RuleEngine(restarted)
+            self.addCleanup(re2.close)
+        # Sólo se compila la regla posterior al snapshot
+        self.assertEqual([c.args[0].name for c in compiled.call_args_list], ["nueva"])
+        self.assertEqual([r.name for r in re2.rules_for("temp01")], ["calor", "nueva"])
+        self.assertEqual(re2.rules_for("temp01")[0].gate.cooldown, 30.0)
+        self.assertEqual(len(re2._ruleset.thresholds), 1)
+
+        self.assertEqual(restarted.registry.reconcile(), (0, 1))
+        self.assertNotIn("boiler", restarted.registry)
+        self.assertEqual(restarted.registry.get("temp01").last_state, "21.5")
+
+    def test_reconcile_keeps_changes_made_while_reading(self):
+        """Un alta o baja de Bridge mientras reconcile() lee la BD no se pierde."""
+        registry = self.controller.registry
+        with db.get_session() as s:
+            s.add_all([db.Device(device_id="temp01", device_type="sensor"),
+                       db.Device(device_id="boiler", device_type="switch")])
+            s.commit()
+        registry.load()
+        read_db = registry._read_db
+
+        def racing_read():
+            rows = read_db()
+            # Bridge escribe en la BD y en el registro justo después de la lectura
+            registry.put(DeviceInfo("lamp", "switch"))
+            registry.remove("boiler")
+            registry.set_type("temp01", "thermostat")
+            return rows
+
+        with patch.object(registry, "_read_db", racing_read):
+            self.assertEqual(registry.reconcile(), (0, 0))
+        self.assertIn("lamp", registry)
+        self.assertNotIn("boiler", registry)
+        self.assertEqual(registry.get("temp01").device_type, "thermostat")
+        self.assertIsNone(registry._journal)
+
+    def test_removed_device_window_discarded(self):
+        """Al dar de baja un dispositivo se olvida su ventana; si vuelve, empieza de cero."""
+        with db.get_session() as s:
+            s.add(db.Device(device_id="temp01", device_type="sensor"))
+            s.commit()
+        self.controller.registry.load()
+        re = RuleEngine(self.controller)
+        self.addCleanup(re.close)
+        for payload in ("20", "30"):
+            self.controller._handle_mqtt_message("redes2/9999/99/temp01/status", payload)
+        self.controller.flush()
+        self.assertEqual(re.windows.get("temp01").max, 30.0)
+
+        self.controller.registry.remove("temp01")
+        self.controller.registry.put(DeviceInfo("temp01", "sensor"))
+        self.assertEqual(re.windows.get("temp01").count, 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,64 @@
+"""
+Pruebas de los listados de dispositivos: paginación, filtros y caché
+invalidada por cambios en el registro.
+"""
+
+import unittest
+from unittest.mock import patch
+from device_listing import DeviceListingCache, paginate
+from registry import DeviceInfo, DeviceRegistry
+
+class TestDeviceListing(unittest.TestCase):
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        for i in range(60):
+            kind = "switch" if i % 3 == 0 else "sensor"
+            state = "ON" if i % 2 else "OFF"
+            self.registry.put(DeviceInfo(f"dev{i:03d}", kind, state))
+        self.cache = DeviceListingCache(self.registry, ttl=60, per_page=25)
+
+    def test_pages_and_filters(self):
+        listing = self.cache.get()
+        self.assertEqual((listing.total, len(listing.pages)), (60, 3))
+        self.assertTrue(listing.pages[0].startswith("• **dev000** (switch)"))
+        self.assertEqual(listing.pages[2].count("\n"), 9)
+
+        switches_on = self.cache.get("SWITCH", "on")
+        self.assertEqual(switches_on.total, 10)
+        self.assertNotIn("sensor", switches_on.pages[0])
+
+    def test_page_char_limit(self):
+        pages = paginate(["x" * 1500] * 5, per_page=25, limit=4096)
+        self.assertEqual([p.count("x") for p in pages], [3000, 3000, 1500])
+
+    def test_cache_hits_and_invalidation(self):
+        first = self.cache.get()
+        self.assertIs(self.cache.get(), first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Los estados no invalidan; altas, bajas y cambios de tipo sí
+        self.registry.update_states([("dev000", "ON", None, "bool", 1.0)])
+        self.assertIs(self.cache.get(), first)
+        self.registry.remove("dev000")
+        self.assertEqual(self.cache.get().total, 59)
+
+        # Pasado el TTL se vuelve a renderizar
+        with patch("device_listing.time.monotonic", return_value=1e12):
+            self.assertIn("`ON`", self.cache.get().pages[0].splitlines()[0])
+
+class TestDevicePager(unittest.IsolatedAsyncioTestCase):
+    async def test_buttons_follow_page(self):
+        from bot import DevicePager
+        registry = DeviceRegistry()
+        for i in range(30):
+            registry.put(DeviceInfo(f"d{i:02d}", "sensor"))
+        pager = DevicePager(DeviceListingCache(registry, per_page=10).get())
+        self.assertTrue(pager.previous.disabled)
+        self.assertFalse(pager.next.disabled)
+        pager.page = 2
+        pager._sync()
+        self.assertTrue(pager.next.disabled)
+        self.assertEqual(pager.embed().footer.text, "Página 3/3 · 30 dispositivos")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+"""
+Pruebas del almacenamiento de eventos particionado por día: escritura, resumen y retención.
+"""
+
+import datetime as dt
+import io
+import os
+import tempfile
+import unittest
+from sqlalchemy import select
+from sqlalchemy.pool import StaticPool
+import persistence as db
+from event_log import RECORD, EventLog
+from export import export_columns, read_columns, write_columns
+from payload_types import classify
+from unittest import mock
+from event_store import LogEventBackend, PartitionedEventBackend, TableEventBackend, make_backend
+
+class TestPartitionedEventStore(unittest.TestCase):
+    def setUp(self):
+        db._engine.dispose()
+        db._engine = db.create_engine(
+            "sqlite:///:memory:",
+            echo=False,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        db.Base.metadata.create_all(bind=db._engine)
+        db.SessionLocal.configure(bind=db._engine)
+        self.store = PartitionedEventBackend(retention_days=2, rollup_seconds=3600)
+
+    def _write(self, events):
+        with db.get_session() as s:
+            self.store.write(s, events)
+            s.commit()
+
+    def test_rollup_and_drop_expired_partitions(self):
+        """
+        Las particiones fuera de retención se resumen por cubeta y se eliminan;
+        las recientes se conservan intactas.
+        """
+        now = dt.datetime.utcnow().replace(microsecond=0)
+        old = (now - dt.timedelta(days=1)).replace(hour=10, minute=0, second=0)
+        self._write([
+            db.Event(device_id="temp01", payload="20", created_at=old),
+            db.Event(device_id="temp01", payload="24", created_at=old + dt.timedelta(minutes=10)),
+            db.Event(device_id="temp01", payload="ERR", created_at=old + dt.timedelta(minutes=20)),
+            db.Event(device_id="temp01", payload="30", created_at=old + dt.timedelta(hours=1)),
+            db.Event(device_id="temp01", payload="21", created_at=now),
+        ])
+        with db.get_session() as s:
+            self.assertEqual(len(self.store.partitions(s)), 2)
+
+        # Dos días después, ayer queda fuera de retención y hoy no; la
+        # partición del día siguiente se crea por adelantado
+        later = now + dt.timedelta(days=2)
+        self.assertEqual(self.store.maintain(later), 1)
+
+        with db.get_session() as s:
+            parts = self.store.partitions(s)
+            rollups = s.scalars(select(db.EventRollup).order_by(db.EventRollup.bucket_start)).all()
+        self.assertEqual([day for day, _ in parts], [now.date(), later.date() + dt.timedelta(days=1)])
+        self.assertEqual(len(rollups), 2)
+        first = rollups[0]
+        self.assertEqual((first.count, first.value_count), (3, 2))
+        self.assertEqual((first.value_min, first.value_max, first.value_avg), (20.0, 24.0, 22.0))
+        self.assertEqual(first.bucket_start, old)
+        self.assertEqual(rollups[1].value_avg, 30.0)
+
+        # Un evento anterior a la retención no recrea su partición
+        self._write([db.Event(device_id="temp01", payload="1", created_at=now - dt.timedelta(days=5))])
+        with db.get_session() as s:
+            self.assertEqual(len(self.store.partitions(s)), 2)
+
+    def test_partition_created_elsewhere(self):
+        """Otro escritor (shard o proceso) que ya creó la partición no hace fallar el lote."""
+        now = dt.datetime.utcnow()
+        self._write([db.Event(device_id="temp01", payload="20", created_at=now)])
+        other = PartitionedEventBackend(retention_days=2, rollup_seconds=3600)
+        with db.get_session() as s:
+            other.write(s, [db.Event(device_id="temp01", payload="21", created_at=now)])
+            s.commit()
+        self.assertEqual([r.payload for r in self.store.history("temp01")], ["20", "21"])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            make_backend("nope")
+
+class TestHistory(unittest.TestCase):
+    """Historial paginado con cada backend: mismas filas, en el orden pedido."""
+
+    def setUp(self):
+        db._engine.dispose()
+        db._engine = db.create_engine(
+            "sqlite:///:memory:",
+            echo=False,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        db.Base.metadata.create_all(bind=db._engine)
+        db.SessionLocal.configure(bind=db._engine)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmpdir = tmp.name
+        # Páginas diminutas para cruzar muchas fronteras de página
+        patcher = mock.patch.object(db.config, "HISTORY_PAGE_SIZE", 7)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        now = dt.datetime.utcnow().replace(microsecond=0)
+        # Dos eventos por instante para ejercitar el desempate por id
+        self.events = [
+            (dev, now - dt.timedelta(hours=30) + dt.timedelta(minutes=i // 2), str(i))
+            for i in range(100) for dev in ("temp01", "temp02")
+        ]
+
+    def _fill(self, backend):
+        with db.get_session() as s:
+            backend.write(s, [
+                db.Event(device_id=d, created_at=t, payload=p, value_kind="num", value_num=float(p))
+                for d, t, p in self.events
+            ])
+            s.commit()
+        return backend
+
+    def _check(self, backend):
+        mine = [(t, p) for d, t, p in self.events if d == "temp01"]
+        got = [(r.created_at, r.payload) for r in backend.history("temp01")]
+        self.assertEqual(got, mine)
+
+        since, until = mine[20][0], mine[61][0]
+        got = [r.payload for r in backend.history("temp01", since, until)]
+        self.assertEqual(got, [p for t, p in mine if since <= t <= until])
+
+        got = [r.payload for r in backend.history("temp01", limit=5, newest_first=True)]
+        self.assertEqual(got, ["99", "98", "97", "96", "95"])
+
+        got = [r.payload for r in backend.history("temp01", since, until, newest_first=True)]
+        self.assertEqual(got, [p for t, p in reversed(mine) if since <= t <= until])
+
+    def test_table_backend(self):
+        self._check(self._fill(TableEventBackend()))
+
+    def test_partitioned_backend(self):
+        self._check(self._fill(PartitionedEventBackend(retention_days=30)))
+
+    def test_partitioned_reads_legacy_table(self):
+        """Lo escrito en 'events' antes de pasar a particiones sigue en el historial."""
+        half = len(self.events) // 2
+        events, self.events = self.events, self.events[:half]
+        self._fill(TableEventBackend())
+        self.events = events[half:]
+        backend = self._fill(PartitionedEventBackend(retention_days=30))
+        self.events = events
+        self._check(backend)
+
+    def test_log_backend(self):
+        backend = LogEventBackend(directory=self.tmpdir)
+        self.addCleanup(backend.log.close)
+        self._check(self._fill(backend))
+
+    def test_log_reads_legacy_table(self):
+        """Lo escrito en 'events' antes de pasar al registro binario sigue en el historial."""
+        half = len(self.events) // 2
+        events, self.events = self.events, self.events[:half]
+        self._fill(TableEventBackend())
+        self.events = events[half:]
+        backend = LogEventBackend(directory=self.tmpdir)
+        self.addCleanup(backend.log.close)
+        self._fill(backend)
+        self.events = events
+        self._check(backend)
+
+    def test_export_columns(self):
+        """Exportación a arrays contiguos y fichero columnar ida y vuelta."""
+        backend = self._fill(TableEventBackend())
+        with db.get_session() as s:
+            backend.write(s, [db.Event(device_id="temp01", created_at=self.events[-1][1],
+                                       payload="ERR", value_kind="text")])
+            s.commit()
+        cols = export_columns(backend, "temp01")
+        self.assertEqual(len(cols), 100)   # el texto no se exporta
+        self.assertEqual(cols.values[:3].tolist(), [0.0, 1.0, 2.0])
+        self.assertEqual(cols.timestamps[0], self.events[0][1].replace(tzinfo=dt.timezone.utc).timestamp())
+
+        buf = io.BytesIO()
+        write_columns(cols, buf)
+        self.assertEqual(len(buf.getvalue()), 8 + 6 + len("temp01") + 100 * 16)
+        buf.seek(0)
+        back = read_columns(buf)
+        self.assertEqual((back.device_id, back.timestamps, back.values),
+                         (cols.device_id, cols.timestamps, cols.values))
+
+    def test_parse_when(self):
+        from bot import parse_when
+        now = dt.datetime(2024, 5, 1, 12, 0)
+        self.assertEqual(parse_when("2h", now), dt.datetime(2024, 5, 1, 10, 0))
+        self.assertEqual(parse_when("2024-04-30T08:15"), dt.datetime(2024, 4, 30, 8, 15))
+        with self.assertRaises(ValueError):
+            parse_when("ayer")
+
+class TestPayloadTypes(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify("21.5"), ("num", 21.5))
+        self.assertEqual(classify(" 3 "), ("num", 3.0))
+        self.assertEqual(classify("off"), ("bool", 0.0))
+        self.assertEqual(classify("23:59:59"), ("time", 86399.0))
+        self.assertEqual(classify("nan"), ("text", None))
+        self.assertEqual(classify("25:00"), ("text", None))
+        self.assertEqual(classify(None), ("text", None))
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        # Segmentos pequeños e índice muy disperso para forzar varios de cada
+        self.log = EventLog(self.tmp.name, segment_bytes=8 + RECORD.size * 50, index_stride=4)
+        self.addCleanup(self.log.close)
+        self.t0 = dt.datetime(2024, 1, 1)
+        events = []
+        for i in range(120):
+            ts = self.t0 + dt.timedelta(seconds=i)
+            events.append(("temp01", ts, str(i)))
+            events.append(("door01", ts, "OPEN" if i % 2 else "CLOSED"))
+        self.log.append(events)
+
+    def test_replay_and_typed_values(self):
+        """
+        La reproducción secuencial devuelve todo en orden, con valores
+        numéricos como float y el resto como texto.
+        """
+        records = list(self.log.replay())
+        self.assertEqual(len(records), 240)
+        self.assertEqual(records[0].value, 0.0)
+        self.assertEqual(records[1].value, "CLOSED")
+        self.assertEqual(records[2].payload, "1")
+        self.assertEqual(records[-1].created_at, self.t0 + dt.timedelta(seconds=119))
+        self.assertGreater(len([f for f in os.listdir(self.tmp.name) if f.endswith(".log")]), 1)
+
+    def test_range_scan_matches_filter(self):
+        """El rango acotado por el índice disperso coincide con filtrar todo."""
+        start = self.t0 + dt.timedelta(seconds=17)
+        end = self.t0 + dt.timedelta(seconds=83)
+        got = [r.payload for r in self.log.scan("temp01", start, end)]
+        self.assertEqual(got, [str(i) for i in range(17, 84)])
+        self.assertEqual(list(self.log.scan("nadie")), [])
+
+    def test_reverse_scan(self):
+        """Hacia atrás, por bloques y cruzando segmentos, sin materializar el rango."""
+        start = self.t0 + dt.timedelta(seconds=17)
+        with mock.patch("event_log._READ_CHUNK", 3):
+            got = [r.payload for r in self.log.scan("temp01", start, reverse=True)]
+        self.assertEqual(got, [str(i) for i in range(119, 16, -1)])
+
+    def test_reopen_discards_torn_record(self):
+        """Al reabrir se recupera el índice y se descarta un registro a medias."""
+        self.log.close()
+        last = sorted(f for f in os.listdir(self.tmp.name) if f.endswith(".log"))[-1]
+        with open(os.path.join(self.tmp.name, last), "ab") as fh:
+            fh.write(b"\x00" * 5)
+
+        log = EventLog(self.tmp.name, segment_bytes=8 + RECORD.size * 50, index_stride=4)
+        self.addCleanup(log.close)
+        self.assertEqual(len(list(log.replay())), 240)
+        log.append([("temp01", self.t0 + dt.timedelta(seconds=500), "99.5")])
+        self.assertEqual(list(log.scan("temp01", self.t0 + dt.timedelta(seconds=119)))[-1].value, 99.5)
+
+    def test_reopen_discards_torn_dictionary_line(self):
+        """
+        Una entrada a medias en strings.txt se recorta al reabrir, así que la
+        siguiente entrada no se pega a ella y el log vuelve a abrir después.
+        """
+        self.log.close()
+        with open(os.path.join(self.tmp.name, "strings.txt"), "ab") as fh:
+            fh.write(b'"AJA')
+
+        log = EventLog(self.tmp.name, segment_bytes=8 + RECORD.size * 50, index_stride=4)
+        log.append([("door01", self.t0 + dt.timedelta(seconds=500), "AJAR")])
+        log.close()
+        log = EventLog(self.tmp.name, segment_bytes=8 + RECORD.size * 50, index_stride=4)
+        self.addCleanup(log.close)
+        self.assertEqual(list(log.scan("door01"))[-1].payload, "AJAR")
+
+    def test_payload_text_preserved(self):
+        """Los números con otra escritura ("21.50", "007", "1e3") vuelven tal cual."""
+        ts = self.t0 + dt.timedelta(seconds=500)
+        sent = ["21.50", "007", "1e3", "21.5", "-3"]
+        self.log.append([("temp02", ts, p) for p in sent])
+        records = list(self.log.scan("temp02"))
+        self.assertEqual([r.payload for r in records], sent)
+        self.assertEqual(records[3].value, 21.5)
+
+    def test_drop_before(self):
+        """La retención borra segmentos cerrados completos, nunca el activo."""
+        self.assertGreater(self.log.drop_before(self.t0 + dt.timedelta(seconds=60)), 0)
+        first = next(self.log.replay())
+        self.assertGreater(first.created_at, self.t0)
+        self.assertEqual(self.log.drop_before(self.t0 + dt.timedelta(days=1)), 2)
+        self.assertEqual(len(list(self.log.replay())), 40)
+
+if __name__ == "__main__":
+    unittest.main()
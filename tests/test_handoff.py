@@ -0,0 +1,61 @@
+"""
+Pruebas de LoopHandoff: entrega desde otros hilos al bucle asyncio y
+políticas de desbordamiento.
+"""
+
+import asyncio
+import threading
+import unittest
+from handoff import LoopHandoff
+
+class TestLoopHandoff(unittest.IsolatedAsyncioTestCase):
+    async def test_threads_to_loop(self):
+        """Varios hilos productores; el consumidor del bucle recibe todo sin pérdidas."""
+        q = LoopHandoff(asyncio.get_running_loop(), maxsize=10000)
+        threads = [
+            threading.Thread(target=lambda n=n: [q.put((n, i)) for i in range(500)])
+            for n in range(4)
+        ]
+        for t in threads:
+            t.start()
+
+        async def drain():
+            return [await q.get() for _ in range(2000)]
+
+        got = await asyncio.wait_for(drain(), 5)
+        for t in threads:
+            t.join()
+        for n in range(4):
+            self.assertEqual([i for m, i in got if m == n], list(range(500)))
+        self.assertEqual((q.stats.put, q.stats.dropped), (2000, 0))
+        with self.assertRaises(asyncio.QueueEmpty):
+            q.get_nowait()
+
+    async def test_overflow_policies(self):
+        loop = asyncio.get_running_loop()
+
+        oldest = LoopHandoff(loop, maxsize=3)
+        for i in range(5):
+            oldest.put(i)
+        self.assertEqual([oldest.get_nowait() for _ in range(3)], [2, 3, 4])
+
+        newest = LoopHandoff(loop, maxsize=3, policy="drop_newest")
+        self.assertEqual([newest.put(i) for i in range(5)], [True, True, True, False, False])
+        self.assertEqual([newest.get_nowait() for _ in range(3)], [0, 1, 2])
+        self.assertEqual((newest.stats.dropped, newest.stats.high_water), (2, 3))
+
+        latest = LoopHandoff(loop, maxsize=2, policy="coalesce", key=lambda ev: ev[0])
+        for ev in [("a", 1), ("b", 1), ("a", 2), ("c", 1)]:
+            latest.put(ev)
+        # 'a' se sustituyó en su sitio y después salió por ser la más antigua
+        self.assertEqual([latest.get_nowait() for _ in range(2)], [("b", 1), ("c", 1)])
+        self.assertEqual((latest.stats.coalesced, latest.stats.dropped), (1, 1))
+
+    async def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            LoopHandoff(asyncio.get_running_loop(), 10, policy="coalesce")
+        with self.assertRaises(ValueError):
+            LoopHandoff(asyncio.get_running_loop(), 10, policy="lifo")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+"""
+Pruebas de AsyncMQTTClient contra un broker mínimo en el propio bucle
+(sólo CONNECT, SUBSCRIBE y PUBLISH con QoS 0/1).
+"""
+
+import asyncio
+import struct
+import threading
+import time
+import unittest
+from unittest.mock import patch
+import config
+from mqtt_client import AsyncMQTTClient
+
+
+def _packet(header: int, body: bytes) -> bytes:
+    """Cabecera fija MQTT + longitud restante (varint) + cuerpo."""
+    n, length = len(body), b""
+    while True:
+        n, digit = divmod(n, 128)
+        length += bytes([digit | (0x80 if n else 0)])
+        if not n:
+            return bytes([header]) + length + body
+
+
+class FakeBroker:
+    def __init__(self) -> None:
+        self.published = []
+        self.subscribed = []
+        self.writer = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    def send(self, topic: str, payload: bytes) -> None:
+        t = topic.encode()
+        self.writer.write(_packet(0x30, struct.pack("!H", len(t)) + t + payload))
+
+    async def _serve(self, reader, writer) -> None:
+        self.writer = writer
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = header & 0xF0
+                if kind == 0x10:                       # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == 0x80:                     # SUBSCRIBE
+                    (tlen,) = struct.unpack("!H", body[2:4])
+                    self.subscribed.append(body[4:4 + tlen].decode())
+                    writer.write(_packet(0x90, body[:2] + b"\x00"))
+                elif kind == 0x30:                     # PUBLISH
+                    (tlen,) = struct.unpack("!H", body[:2])
+                    topic = body[2:2 + tlen].decode()
+                    rest = body[2 + tlen:]
+                    if header & 0x06:                  # QoS 1 -> PUBACK
+                        writer.write(_packet(0x40, rest[:2]))
+                        rest = rest[2:]
+                    self.published.append((topic, rest.decode()))
+                elif kind == 0xE0:                     # DISCONNECT
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+
+class TestAsyncMQTTClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.broker = FakeBroker()
+        port = await self.broker.start()
+        patcher = patch.multiple(
+            config, MQTT_BROKER="127.0.0.1", MQTT_PORT=port, MQTT_RECONNECT_MIN=0.05,
+            MQTT_QOS="casa/+/set=1", MQTT_QOS_DEFAULT=0,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.broker.close()
+
+    async def test_publish_and_receive_on_loop(self):
+        """Publicar se puede esperar y los mensajes llegan en el hilo del bucle."""
+        received = []
+        connected = asyncio.Event()
+        client = AsyncMQTTClient(
+            on_message=lambda t, p: received.append((t, p)),
+            on_connect=lambda c: connected.set(),
+        )
+        client.connect_and_start()
+        await asyncio.wait_for(connected.wait(), 5)
+        client.subscribe("casa/+/status")
+
+        await asyncio.wait_for(client.publish_async("casa/boiler/set", "ON", qos=1), 5)
+        await asyncio.wait_for(client.publish_async("casa/boiler/set", "OFF", qos=0), 5)
+        self.assertEqual(self.broker.published, [("casa/boiler/set", "ON"), ("casa/boiler/set", "OFF")])
+
+        stream = client.messages()
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        self.broker.send("casa/temp01/status", b"21.5")
+        self.assertEqual(await asyncio.wait_for(first, 5), ("casa/temp01/status", "21.5"))
+        self.assertEqual(received, [("casa/temp01/status", "21.5")])
+        await stream.aclose()
+
+        client.stop()
+
+    async def test_offline_queue_and_reconnect(self):
+        """
+        Lo publicado sin conexión sale en orden al conectar (salvo lo
+        caducado) y tras una caída se reconecta y se repiten las suscripciones.
+        """
+        connected = asyncio.Event()
+        client = AsyncMQTTClient(on_message=lambda t, p: None, on_connect=lambda c: connected.set())
+        client.subscribe("casa/+/status")
+        client.publish("casa/a/set", "1")
+        client.publish("casa/b/set", "caduca", ttl=0)
+        client.publish("casa/c/set", "2")
+        self.assertEqual(client.stats.queued, 3)
+
+        await asyncio.sleep(0.01)
+        client.connect_and_start()
+        await asyncio.wait_for(connected.wait(), 5)
+        for _ in range(100):
+            if len(self.broker.published) == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.broker.published, [("casa/a/set", "1"), ("casa/c/set", "2")])
+        self.assertEqual((client.stats.flushed, client.stats.expired), (2, 1))
+
+        connected.clear()
+        self.broker.writer.close()
+        await asyncio.wait_for(connected.wait(), 5)
+        self.assertEqual(client.stats.reconnects, 1)
+        self.assertEqual(client.stats.disconnects, 1)
+        self.assertGreater(client.stats.downtime, 0)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.broker.subscribed, ["casa/+/status", "casa/+/status"])
+
+        client.stop()
+
+    async def test_qos_window_and_delivery_futures(self):
+        """
+        Cada topic usa su QoS; los Future se resuelven con la latencia al
+        confirmarse y, con la cola de paho llena, se rechaza en vez de acumular.
+        """
+        connected = asyncio.Event()
+        with patch.multiple(config, MQTT_MAX_INFLIGHT=1, MQTT_MAX_QUEUED=2):
+            client = AsyncMQTTClient(on_message=lambda t, p: None, on_connect=lambda c: connected.set())
+        self.assertEqual((client.qos_for("casa/boiler/set"), client.qos_for("casa/boiler")), (1, 0))
+        client.connect_and_start()
+        await asyncio.wait_for(connected.wait(), 5)
+
+        futs = [client.publish("casa/boiler/set", str(i)) for i in range(3)]
+        with self.assertRaises(ConnectionError):
+            futs[2].result(timeout=0)
+        latencies = [await asyncio.wait_for(asyncio.wrap_future(f), 5) for f in futs[:2]]
+        self.assertTrue(all(lat >= 0 for lat in latencies))
+        self.assertEqual(self.broker.published, [("casa/boiler/set", "0"), ("casa/boiler/set", "1")])
+
+        await asyncio.wait_for(client.publish_async("casa/boiler", "GET_STATE"), 5)
+        d = client.delivery
+        self.assertEqual((d.confirmed, d.rejected), (3, 1))
+        self.assertEqual((d.latency[1].count, d.latency[0].count), (2, 1))
+        self.assertEqual(client._inflight, {})
+
+        client.stop()
+
+    async def test_publish_from_other_thread(self):
+        """
+        publish() desde otro hilo (acciones de reglas) se pasa al bucle: paho
+        sólo se toca desde él y el Future se resuelve igual.
+        """
+        connected = asyncio.Event()
+        client = AsyncMQTTClient(on_message=lambda t, p: None, on_connect=lambda c: connected.set())
+        client.connect_and_start()
+        await asyncio.wait_for(connected.wait(), 5)
+
+        loop_thread = threading.get_ident()
+        seen = []
+        real_publish = client._client.publish
+        def spy(*args, **kwargs):
+            seen.append(threading.get_ident())
+            return real_publish(*args, **kwargs)
+        client._client.publish = spy
+
+        futs = []
+        worker = threading.Thread(target=lambda: futs.append(client.publish("casa/boiler/set", "ON")))
+        worker.start()
+        worker.join()
+        await asyncio.wait_for(asyncio.wrap_future(futs[0]), 5)
+        self.assertEqual(seen, [loop_thread])
+        self.assertEqual(self.broker.published, [("casa/boiler/set", "ON")])
+
+        client.stop()
+
+    async def test_stale_early_ack_ignored(self):
+        """
+        Un on_publish sin reclamar de un mid ya reutilizado no confirma el
+        mensaje nuevo, y los que nadie reclama caducan.
+        """
+        connected = asyncio.Event()
+        client = AsyncMQTTClient(on_message=lambda t, p: None, on_connect=lambda c: connected.set())
+        client.connect_and_start()
+        await asyncio.wait_for(connected.wait(), 5)
+
+        old = time.monotonic() - 60
+        client._early[client._client._last_mid + 1] = old
+        fut = client.publish("casa/boiler/set", "ON")
+        self.assertFalse(fut.done())
+        latency = await asyncio.wait_for(asyncio.wrap_future(fut), 5)
+        self.assertLess(latency, 5)
+
+        client._early[1234] = old
+        client._on_publish(None, None, 4321)
+        self.assertEqual(client._early.keys(), {4321})
+
+        client.stop()
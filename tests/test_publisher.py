@@ -0,0 +1,105 @@
+"""
+Pruebas del publicador de eventos: agrupación por dispositivo, empaquetado
+en mensajes de Discord, adaptación de la ventana al límite de envío y
+enrutado por suscripciones.
+"""
+
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+import discord
+import persistence as db
+from publisher import EventPublisher
+from subscriptions import SubscriptionIndex, parse_target
+
+class FakeChannel:
+    def __init__(self, send=None):
+        self.sent = []
+        if send:
+            self.send = send
+
+    async def send(self, text):
+        self.sent.append(text)
+
+class TestEventPublisher(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.queue = asyncio.Queue()
+        self.channel = FakeChannel()
+        self.sent = self.channel.sent
+
+    def _put(self, device_id, payload):
+        self.queue.put_nowait(db.Event(device_id=device_id, payload=payload))
+
+    async def test_coalesce_and_pack(self):
+        """Sólo el último valor de cada dispositivo, en mensajes de ≤2000 caracteres."""
+        pub = EventPublisher(self.queue, lambda ev: [self.channel], min_interval=0.01, max_interval=1)
+        for i in range(300):
+            self._put(f"sensor{i % 150:03d}", str(i))
+        await pub.flush(await pub.collect())
+
+        text = "\n".join(self.sent)
+        self.assertEqual(text.count("📟"), 150)
+        self.assertIn("**sensor000** → `150` (×2)", text)
+        self.assertTrue(all(len(m) <= 2000 for m in self.sent))
+        self.assertLess(len(self.sent), 10)
+        self.assertEqual((pub.stats.events, pub.stats.coalesced), (300, 150))
+        self.assertEqual(pub.stats.messages, len(self.sent))
+
+    async def test_interval_adapts_to_rate_limit(self):
+        """Un envío retenido o un 429 amplían la ventana; los rápidos la reducen."""
+        delays = [0.05, 0.0]
+
+        async def send(text):
+            await asyncio.sleep(delays.pop(0) if delays else 0)
+
+        channel = FakeChannel(send)
+        pub = EventPublisher(self.queue, lambda ev: [channel], min_interval=0.01, max_interval=4,
+                             slow_send=0.02)
+        self._put("a", "1")
+        await pub.flush(await pub.collect())
+        self.assertEqual((pub.interval, pub.stats.rate_limited), (0.5, 1))
+
+        response = MagicMock(status=429, reason="Too Many Requests")
+        channel.send = MagicMock(side_effect=discord.HTTPException(response, "rate limited"))
+        await pub.flush({"a": [db.Event(device_id="a", payload="2"), 1]})
+        self.assertEqual(pub.interval, 1.0)
+
+        channel.send = send
+        await pub.flush({"a": [db.Event(device_id="a", payload="3"), 1]})
+        self.assertLess(pub.interval, 1.0)
+
+    async def test_routes_per_channel(self):
+        """Cada canal recibe sólo las líneas de sus dispositivos, en mensajes propios."""
+        index = SubscriptionIndex([
+            (1, *parse_target("temp01")),
+            (2, *parse_target("type:switch")),
+            (2, *parse_target("temp0?")),
+        ])
+        types = {"temp01": "sensor", "temp02": "sensor", "boiler": "switch", "clock": "clock"}
+        channels = {1: FakeChannel(), 2: FakeChannel()}
+        route = lambda ev: [channels[i] for i in index.channels_for(ev.device_id, types[ev.device_id])]
+        pub = EventPublisher(self.queue, route, min_interval=0.01)
+        for dev in types:
+            self._put(dev, "x")
+        await pub.flush(await pub.collect())
+
+        self.assertEqual(channels[1].sent, ["📟 **temp01** → `x`"])
+        self.assertEqual(len(channels[2].sent), 1)
+        for dev, expected in (("temp01", True), ("temp02", True), ("boiler", True), ("clock", False)):
+            self.assertEqual(f"**{dev}**" in channels[2].sent[0], expected)
+
+class TestSubscriptionIndex(unittest.TestCase):
+    def test_parse_target(self):
+        self.assertEqual(parse_target("temp01"), ("device", "temp01"))
+        self.assertEqual(parse_target("type:sensor"), ("type", "sensor"))
+        self.assertEqual(parse_target("garage_*"), ("pattern", "garage_*"))
+
+    def test_lookup(self):
+        index = SubscriptionIndex([(1, "device", "a"), (2, "type", "sensor"), (3, "pattern", "a*")])
+        self.assertEqual(index.channels_for("a", "sensor"), {1, 2, 3})
+        self.assertEqual(index.channels_for("ab", "switch"), {3})
+        self.assertEqual(index.channels_for("b"), frozenset())
+        self.assertEqual(len(index), 3)
+
+if __name__ == "__main__":
+    unittest.main()
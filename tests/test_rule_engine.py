@@ -0,0 +1,277 @@
+"""
+Pruebas del RuleEngine: compilación de reglas, índice por dispositivo y evaluación.
+"""
+
+import unittest
+from unittest.mock import MagicMock
+from sqlalchemy.pool import StaticPool
+import persistence as db
+import time
+from action_executor import ActionExecutor
+from aggregates import DeviceWindow
+from rule_engine import RuleEngine, referenced_devices
+from threshold_rules import ThresholdIndex, ThresholdSpec
+
+class TestRuleEngine(unittest.TestCase):
+    def setUp(self):
+        db._engine.dispose()
+        db._engine = db.create_engine(
+            "sqlite:///:memory:",
+            echo=False,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        db.Base.metadata.create_all(bind=db._engine)
+        db.SessionLocal.configure(bind=db._engine)
+        self.controller = MagicMock()
+
+    def _engine(self):
+        engine = RuleEngine(self.controller)
+        self.addCleanup(engine.close)
+        return engine
+
+    def _add_rule(self, name, condition, action):
+        with db.get_session() as s:
+            s.add(db.Rule(name=name, condition=condition, action=action))
+            s.commit()
+
+    def test_referenced_devices(self):
+        """
+        Sólo las comparaciones sobre event.device_id en el nivel superior o bajo
+        un `and` restringen la regla a unos dispositivos.
+        """
+        self.assertEqual(referenced_devices("event.device_id == 'temp01'"), {"temp01"})
+        self.assertEqual(
+            referenced_devices("'temp01' == event.device_id and float(event.payload) > 25"),
+            {"temp01"},
+        )
+        self.assertEqual(referenced_devices("event.device_id in ('a', 'b')"), {"a", "b"})
+        self.assertIsNone(referenced_devices("float(event.payload) > 25"))
+        self.assertIsNone(referenced_devices("event.device_id == 'a' or event.payload == 'ON'"))
+
+    def test_only_matching_rules_are_evaluated(self):
+        """
+        Un evento sólo evalúa las reglas de su dispositivo más las comodín, en orden de id.
+        """
+        self._add_rule("temp", "event.device_id == 'temp01' and float(event.payload) > 25",
+                       "controller.send_command('boiler', 'ON')")
+        self._add_rule("any", "event.payload == 'PANIC'", "controller.send_command('siren', 'ON')")
+        self._add_rule("other", "event.device_id == 'clock01'", "controller.send_command('x', 'y')")
+        self._add_rule("broken", "event.payload ==", "pass")
+
+        engine = self._engine()
+        self.assertEqual([r.name for r in engine.rules_for("temp01")], ["temp", "any"])
+        self.assertEqual([r.name for r in engine.rules_for("unknown")], ["any"])
+
+        engine._on_event(db.Event(device_id="temp01", payload="30"))
+        self.assertTrue(engine.executor.join(timeout=2))
+        self.controller.send_command.assert_called_once_with("boiler", "ON")
+
+    def test_threshold_index_matches_by_binary_search(self):
+        """
+        El índice de umbrales devuelve exactamente las reglas que cumple el valor.
+        """
+        def spec(i, op, low, high=None, device="temp01"):
+            return ThresholdSpec(i, f"r{i}", device, op, low, high, "boiler", "ON")
+
+        specs = [
+            spec(1, ">", 25), spec(2, ">=", 25), spec(3, "<", 25), spec(4, "<=", 25),
+            spec(5, "between", 20, 30), spec(6, ">", 10, device="other"), spec(7, ">", 30),
+        ]
+        index = ThresholdIndex(specs)
+        ids = lambda value: [s.id for s in index.match("temp01", value)]
+        self.assertEqual(ids(25), [2, 4, 5])
+        self.assertEqual(ids(26), [1, 2, 5])
+        self.assertEqual(ids(31), [1, 2, 7])
+        self.assertEqual(ids(10), [3, 4])
+        self.assertEqual(index.match("nobody", 50), [])
+
+    def test_threshold_rule_fires_command(self):
+        """
+        Las reglas de umbral guardadas en la BD disparan su comando; payloads no numéricos se ignoran.
+        """
+        with db.get_session() as s:
+            s.add(db.ThresholdRule(name="alta", device_id="temp01", op=">", low=25,
+                                   target_device="boiler", command="OFF"))
+            s.commit()
+        engine = self._engine()
+
+        engine._on_event(db.Event(device_id="temp01", payload="ON"))
+        engine._on_event(db.Event(device_id="temp01", payload="20"))
+        engine.executor.join(timeout=2)
+        self.controller.send_command.assert_not_called()
+        engine._on_event(db.Event(device_id="temp01", payload="26.5"))
+        engine.executor.join(timeout=2)
+        self.controller.send_command.assert_called_once_with("boiler", "OFF")
+
+    def test_action_executor_limits_and_timeouts(self):
+        """
+        Una acción lenta no bloquea al que la encola, respeta el límite por regla
+        y, pasado su plazo, no puede publicar más comandos (queda en dead-letter).
+        """
+        executor = ActionExecutor(self.controller, workers=2, timeout=0.1, max_per_rule=1)
+        event = db.Event(device_id="temp01", payload="30")
+
+        def slow(ctl):
+            time.sleep(0.3)
+            ctl.send_command("boiler", "ON")
+
+        start = time.monotonic()
+        self.assertTrue(executor.submit("lenta", event, slow))
+        self.assertFalse(executor.submit("lenta", event, slow))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertTrue(executor.join(timeout=2))
+        executor.shutdown()
+
+        self.controller.send_command.assert_not_called()
+        reasons = [d.reason for d in executor.dead_letters]
+        self.assertEqual(reasons, ["rule_busy", "timeout"])
+
+    def test_device_window_aggregates(self):
+        """
+        La ventana mantiene media, mínimo, máximo y tasa al entrar y salir muestras.
+        """
+        now = time.time()
+        window = DeviceWindow(max_samples=3, max_age=60)
+        for i, v in enumerate([5.0, 1.0, 3.0, 4.0]):
+            window.push(now - 10 + i, v)
+        # La primera (5.0) salió por capacidad
+        self.assertEqual(window.count, 3)
+        self.assertAlmostEqual(window.mean, 8.0 / 3)
+        self.assertEqual((window.min, window.max), (1.0, 4.0))
+        self.assertAlmostEqual(window.rate, 1.5)
+        self.assertAlmostEqual(window.gap, 1.0)
+
+        window.push(now - 9, None)  # payload no numérico: sólo cuenta como evento
+        self.assertEqual(window.count, 3)
+        old = DeviceWindow(max_samples=10, max_age=5)
+        old.push(now - 30, 1.0)
+        self.assertEqual(old.count, 0)
+        self.assertFalse(old.mean > 0)
+
+    def test_rule_uses_window(self):
+        """
+        Las reglas ven la ventana de su dispositivo como `window`.
+        """
+        self._add_rule("media", "window.count >= 3 and window.mean > 25",
+                       "controller.send_command('boiler', 'OFF')")
+        engine = self._engine()
+        for payload in ("20", "26", "27"):
+            engine._on_event(db.Event(device_id="temp01", payload=payload))
+        engine.executor.join(timeout=2)
+        self.controller.send_command.assert_not_called()
+        engine._on_event(db.Event(device_id="temp01", payload="28"))
+        engine.executor.join(timeout=2)
+        self.controller.send_command.assert_called_once_with("boiler", "OFF")
+
+    def test_threshold_hysteresis_and_edge(self):
+        """
+        Con histéresis, un valor que oscila alrededor del umbral dispara una sola
+        vez hasta que baja de umbral - banda.
+        """
+        with db.get_session() as s:
+            s.add(db.ThresholdRule(name="alta", device_id="temp01", op=">", low=25,
+                                   target_device="boiler", command="OFF", hysteresis=1.0))
+            s.commit()
+        engine = self._engine()
+
+        for payload in ("25.1", "24.9", "25.2", "24.5", "25.3"):
+            engine._on_event(db.Event(device_id="temp01", payload=payload))
+        engine.executor.join(timeout=2)
+        self.assertEqual(self.controller.send_command.call_count, 1)
+
+        for payload in ("23.9", "25.1"):
+            engine._on_event(db.Event(device_id="temp01", payload=payload))
+        engine.executor.join(timeout=2)
+        self.assertEqual(self.controller.send_command.call_count, 2)
+
+    def test_python_rule_edge_and_cooldown(self):
+        """
+        En modo flanco la regla sólo dispara en la transición falso -> verdadero;
+        el cooldown impide disparos seguidos aunque haya transición.
+        """
+        with db.get_session() as s:
+            s.add(db.Rule(name="on", condition="event.payload == 'ON'",
+                          action="controller.send_command('luz', 'ON')", edge=True))
+            s.add(db.Rule(name="cd", condition="event.payload == 'ON'",
+                          action="controller.send_command('sirena', 'ON')", cooldown=60))
+            s.commit()
+        engine = self._engine()
+        for payload in ("ON", "ON", "OFF", "ON"):
+            engine._on_event(db.Event(device_id="sw", payload=payload))
+        engine.executor.join(timeout=2)
+        targets = [c.args[0] for c in self.controller.send_command.call_args_list]
+        self.assertEqual(targets.count("luz"), 2)
+        self.assertEqual(targets.count("sirena"), 1)
+
+    def test_incremental_refresh(self):
+        """
+        refresh() sólo aplica lo que cambió desde la versión cargada: las reglas
+        intactas se conservan (mismo objeto compilado) y las borradas desaparecen.
+        """
+        keep = db.add_rule(db.Rule, name="keep", condition="True", action="pass")
+        gone = db.add_rule(db.Rule, name="gone", condition="True", action="pass")
+        engine = self._engine()
+        self.assertFalse(engine.refresh())
+        before = {r.id: r for r in engine._ruleset.rules}
+
+        db.delete_rule(db.Rule, gone.id)
+        db.add_rule(db.Rule, name="new", condition="event.device_id == 'x'", action="pass")
+        db.add_rule(db.ThresholdRule, name="t", device_id="x", op=">", low=1,
+                    target_device="y", command="ON")
+        self.assertTrue(engine.refresh())
+
+        after = {r.id: r for r in engine._ruleset.rules}
+        self.assertIs(after[keep.id], before[keep.id])
+        self.assertNotIn(gone.id, after)
+        self.assertEqual([r.name for r in engine.rules_for("x")], ["keep", "new"])
+        self.assertEqual(len(engine._ruleset.thresholds), 1)
+        self.assertEqual([r.name for r in db.list_rules(db.Rule)], ["keep", "new"])
+
+    def test_db_version_behind_loaded_rules(self):
+        """
+        Si la BD se sustituye por una con versión de reglas menor, ni refresh()
+        ni el snapshot mantienen las reglas antiguas: se recarga todo.
+        """
+        db.add_rule(db.Rule, name="vieja1", condition="True", action="pass")
+        db.add_rule(db.Rule, name="vieja2", condition="True", action="pass")
+        engine = self._engine()
+        snap = engine.dump_rules()
+
+        db.Base.metadata.drop_all(bind=db._engine)
+        db.Base.metadata.create_all(bind=db._engine)
+        db.add_rule(db.Rule, name="nueva", condition="True", action="pass")
+        self.assertTrue(engine.refresh())
+        self.assertEqual([r.name for r in engine._ruleset.rules], ["nueva"])
+
+        self.controller.snapshot = {"rules": snap}
+        restarted = self._engine()
+        self.assertEqual([r.name for r in restarted._ruleset.rules], ["nueva"])
+
+    def test_rule_stats(self):
+        """
+        stats() cuenta evaluaciones, disparos y errores por regla y ordena por coste.
+        """
+        self._add_rule("lenta", "True", "__import__('time').sleep(0.05)")
+        self._add_rule("rota", "1/0", "pass")
+        with db.get_session() as s:
+            s.add(db.ThresholdRule(name="umbral", device_id="temp01", op=">", low=25,
+                                   target_device="boiler", command="OFF"))
+            s.commit()
+        engine = self._engine()
+        for payload in ("20", "30"):
+            engine._on_event(db.Event(device_id="temp01", payload=payload))
+        engine.executor.join(timeout=2)
+
+        rows = {r.name: r for r in engine.stats()}
+        self.assertEqual((rows["lenta"].evaluations, rows["lenta"].fires), (2, 2))
+        self.assertEqual((rows["rota"].errors, rows["rota"].fires), (2, 0))
+        self.assertEqual((rows["umbral"].key, rows["umbral"].evaluations, rows["umbral"].fires),
+                         ("T1", 2, 1))
+        self.assertEqual(engine.stats()[0].name, "lenta")
+        self.assertEqual(engine.stats("errors")[0].name, "rota")
+        with self.assertRaises(ValueError):
+            engine.stats("nope")
+
+if __name__ == "__main__":
+    unittest.main()
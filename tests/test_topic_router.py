@@ -0,0 +1,58 @@
+"""
+Pruebas del TopicRouter: comodines MQTT, capturas y rechazo de patrones mal formados.
+"""
+
+import unittest
+from topic_router import TopicRouter
+
+class TestTopicRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = TopicRouter()
+        self.calls = []
+
+    def _handler(self, name):
+        return lambda caps, payload: self.calls.append((name, caps, payload))
+
+    def test_plus_captures_device_at_any_depth(self):
+        """
+        El prefijo puede tener cualquier profundidad; '+' captura el nivel del device_id.
+        """
+        self.router.add("home/floor1/kitchen/+/status", self._handler("status"))
+        self.router.add("home/floor1/kitchen/+/ack", self._handler("ack"))
+
+        self.assertTrue(self.router.dispatch("home/floor1/kitchen/temp01/status", "21.5"))
+        self.assertEqual(self.calls, [("status", ("temp01",), "21.5")])
+        self.assertFalse(self.router.dispatch("home/floor1/kitchen/temp01/other", "x"))
+        self.assertFalse(self.router.dispatch("home/floor1/temp01/status", "x"))
+
+    def test_hash_matches_rest_and_parent(self):
+        """
+        '#' casa con el resto del topic (incluido el nivel padre) pero no con $SYS.
+        """
+        self.router.add("base/#", self._handler("all"))
+        self.router.add("#", self._handler("root"))
+
+        self.router.dispatch("base/a/b", "1")
+        self.router.dispatch("base", "2")
+        self.router.dispatch("$SYS/broker/uptime", "3")
+        self.assertIn(("all", ("a/b",), "1"), self.calls)
+        self.assertIn(("all", ("",), "2"), self.calls)
+        self.assertNotIn("3", [c[2] for c in self.calls])
+
+    def test_many_patterns(self):
+        """
+        Con miles de patrones sólo se invoca el que casa.
+        """
+        for i in range(5000):
+            self.router.add(f"site/{i}/+/status", self._handler(i))
+        self.router.dispatch("site/4321/dev/status", "ON")
+        self.assertEqual(self.calls, [(4321, ("dev",), "ON")])
+
+    def test_invalid_patterns(self):
+        with self.assertRaises(ValueError):
+            self.router.add("a/#/b", self._handler("x"))
+        with self.assertRaises(ValueError):
+            self.router.add("a/b+/c", self._handler("x"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+"""
+threshold_rules.py - Reglas de umbral declarativas e índice ordenado por dispositivo
+"""
+
+from __future__ import annotations
+import bisect
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import persistence as db
+from rule_gate import TriggerGate
+from rule_stats import RuleStats
+
+OPS = (">", ">=", "<", "<=", "between")
+
+
+@dataclass(frozen=True)
+class ThresholdSpec:
+    """Copia inmutable de una fila de 'threshold_rules'."""
+    id: int
+    name: str
+    device_id: str
+    op: str
+    low: float
+    high: Optional[float]
+    target_device: str
+    command: str
+    cooldown: float = 0.0
+    edge: bool = False
+    hysteresis: float = 0.0
+    gate: TriggerGate = field(default=None, compare=False, hash=False, repr=False)
+    stats: RuleStats = field(default_factory=RuleStats, compare=False, hash=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.gate is None:
+            gate = TriggerGate(self.cooldown, rearm_required=self.edge or self.hysteresis > 0)
+            object.__setattr__(self, "gate", gate)
+
+    @classmethod
+    def from_row(cls, row: db.ThresholdRule) -> "ThresholdSpec":
+        validate(row.op, row.low, row.high)
+        return cls(row.id, row.name, row.device_id, row.op, row.low, row.high,
+                   row.target_device, row.command,
+                   row.cooldown or 0.0, bool(row.edge), row.hysteresis or 0.0)
+
+    def matches(self, value: float) -> bool:
+        op = self.op
+        if op == ">":
+            return value > self.low
+        if op == ">=":
+            return value >= self.low
+        if op == "<":
+            return value < self.low
+        if op == "<=":
+            return value <= self.low
+        return self.low <= value <= self.high
+
+    def rearms(self, value: float) -> bool:
+        """Tras disparar, ¿ha salido el valor de la banda de histéresis?"""
+        h = self.hysteresis
+        if not h:
+            return not self.matches(value)
+        if self.op in (">", ">="):
+            return value <= self.low - h
+        if self.op in ("<", "<="):
+            return value >= self.low + h
+        return value < self.low - h or value > self.high + h
+
+    def describe(self) -> str:
+        if self.op == "between":
+            cond = f"{self.low} <= {self.device_id} <= {self.high}"
+        else:
+            cond = f"{self.device_id} {self.op} {self.low}"
+        text = f"si {cond} → {self.target_device} {self.command}"
+        extras = []
+        if self.edge:
+            extras.append("flanco")
+        if self.hysteresis:
+            extras.append(f"histéresis {self.hysteresis}")
+        if self.cooldown:
+            extras.append(f"cooldown {self.cooldown}s")
+        return f"{text} ({', '.join(extras)})" if extras else text
+
+
+def validate(op: str, low: float, high: Optional[float]) -> None:
+    """Lanza ValueError si la comparación no es válida."""
+    if op not in OPS:
+        raise ValueError(f"Operador no soportado: {op} (usa {', '.join(OPS)})")
+    if op == "between" and (high is None or high < low):
+        raise ValueError("'between' necesita dos límites con inferior <= superior")
+
+
+@dataclass
+class _DeviceIndex:
+    """Umbrales de un dispositivo, ordenados para búsqueda binaria."""
+    gt: Tuple[List[float], List[ThresholdSpec]] = field(default_factory=lambda: ([], []))
+    ge: Tuple[List[float], List[ThresholdSpec]] = field(default_factory=lambda: ([], []))
+    lt: Tuple[List[float], List[ThresholdSpec]] = field(default_factory=lambda: ([], []))
+    le: Tuple[List[float], List[ThresholdSpec]] = field(default_factory=lambda: ([], []))
+    # Intervalos ordenados por límite inferior
+    between: Tuple[List[float], List[ThresholdSpec]] = field(default_factory=lambda: ([], []))
+
+
+_SLOT = {">": "gt", ">=": "ge", "<": "lt", "<=": "le", "between": "between"}
+
+
+class ThresholdIndex:
+    """
+    Índice inmutable device_id -> umbrales ordenados.
+
+    Para un valor v, las reglas `> X` que casan son las de X < v (un prefijo
+    de la lista ordenada), las `< X` las de X > v (un sufijo), etc.; cada
+    grupo se localiza con una búsqueda binaria en vez de evaluar regla a regla.
+    """
+
+    def __init__(self, specs: Iterable[ThresholdSpec] = ()) -> None:
+        self.specs: Tuple[ThresholdSpec, ...] = tuple(specs)
+        grouped: Dict[str, Dict[str, List[ThresholdSpec]]] = {}
+        for spec in self.specs:
+            grouped.setdefault(spec.device_id, {}).setdefault(_SLOT[spec.op], []).append(spec)
+
+        self._index: Dict[str, _DeviceIndex] = {}
+        # Reglas que, una vez disparadas, hay que rearmar mirando cada valor
+        self._gated: Dict[str, List[ThresholdSpec]] = {}
+        self.size = 0
+        for device_id, slots in grouped.items():
+            idx = _DeviceIndex()
+            for slot, items in slots.items():
+                items.sort(key=lambda s: (s.low, s.id))
+                setattr(idx, slot, ([s.low for s in items], items))
+                self.size += len(items)
+            self._index[device_id] = idx
+            gated = [s for items in slots.values() for s in items if s.gate.rearm_required]
+            if gated:
+                self._gated[device_id] = gated
+
+    def __len__(self) -> int:
+        return self.size
+
+    def gated(self, device_id: str) -> List[ThresholdSpec]:
+        """Reglas del dispositivo en modo flanco o con histéresis."""
+        return self._gated.get(device_id, [])
+
+    def match(self, device_id: str, value: float) -> List[ThresholdSpec]:
+        """Reglas de `device_id` que se cumplen con `value`, en orden de id."""
+        idx = self._index.get(device_id)
+        if idx is None:
+            return []
+        found: List[ThresholdSpec] = []
+
+        keys, items = idx.gt                       # X < v
+        found.extend(items[:bisect.bisect_left(keys, value)])
+        keys, items = idx.ge                       # X <= v
+        found.extend(items[:bisect.bisect_right(keys, value)])
+        keys, items = idx.lt                       # X > v
+        found.extend(items[bisect.bisect_right(keys, value):])
+        keys, items = idx.le                       # X >= v
+        found.extend(items[bisect.bisect_left(keys, value):])
+        keys, items = idx.between                  # low <= v <= high
+        found.extend(s for s in items[:bisect.bisect_right(keys, value)] if value <= s.high)
+
+        if len(found) > 1:
+            found.sort(key=lambda s: s.id)
+        return found
@@ -0,0 +1,91 @@
+"""
+topic_router.py - Enrutado de topics MQTT con patrones (+/#) precompilados en un trie
+"""
+
+from __future__ import annotations
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# handler(capturas, payload): capturas = un valor por cada '+' y, si el
+# patrón acaba en '#', el resto del topic como último elemento.
+Handler = Callable[[Tuple[str, ...], str], None]
+
+
+class _Node:
+    __slots__ = ("children", "plus", "handlers", "hash_handlers")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _Node] = {}
+        self.plus: Optional[_Node] = None
+        self.handlers: List[Handler] = []        # el patrón termina en este nivel
+        self.hash_handlers: List[Handler] = []   # el patrón termina en '#' tras este nivel
+
+
+class TopicRouter:
+    """
+    Trie de patrones de suscripción MQTT.
+
+    Los patrones se compilan una vez (al registrar los handlers en el
+    arranque) y cada topic se resuelve recorriendo sus niveles: el coste
+    depende de la profundidad del topic, no del número de patrones.
+    """
+
+    def __init__(self) -> None:
+        self._root = _Node()
+        self.patterns: List[str] = []
+
+    def add(self, pattern: str, handler: Handler) -> None:
+        """Registra un handler para un patrón de suscripción MQTT."""
+        levels = pattern.split("/")
+        node = self._root
+        for i, level in enumerate(levels):
+            if level == "#":
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' sólo puede ir al final del patrón: {pattern}")
+                node.hash_handlers.append(handler)
+                break
+            if level == "+":
+                if node.plus is None:
+                    node.plus = _Node()
+                node = node.plus
+            elif "+" in level or "#" in level:
+                raise ValueError(f"Comodín que no ocupa un nivel completo: {pattern}")
+            else:
+                node = node.children.setdefault(level, _Node())
+        else:
+            node.handlers.append(handler)
+        self.patterns.append(pattern)
+
+    def match(self, topic: str) -> List[Tuple[Handler, Tuple[str, ...]]]:
+        """Devuelve los (handler, capturas) cuyos patrones casan con el topic."""
+        levels = topic.split("/")
+        depth = len(levels)
+        # Los topics de sistema ($SYS/...) no casan con comodines en el primer nivel
+        wild_root = not topic.startswith("$")
+        found: List[Tuple[Handler, Tuple[str, ...]]] = []
+        stack: List[Tuple[_Node, int, Tuple[str, ...]]] = [(self._root, 0, ())]
+        while stack:
+            node, i, caps = stack.pop()
+            wild = i > 0 or wild_root
+            if node.hash_handlers and wild:
+                rest = "/".join(levels[i:])
+                found.extend((h, caps + (rest,)) for h in node.hash_handlers)
+            if i == depth:
+                found.extend((h, caps) for h in node.handlers)
+                continue
+            level = levels[i]
+            child = node.children.get(level)
+            if child is not None:
+                stack.append((child, i + 1, caps))
+            if node.plus is not None and wild:
+                stack.append((node.plus, i + 1, caps + (level,)))
+        return found
+
+    def dispatch(self, topic: str, payload: str) -> bool:
+        """Llama a los handlers del topic. Devuelve False si ninguno casa."""
+        matches = self.match(topic)
+        for handler, caps in matches:
+            handler(caps, payload)
+        return bool(matches)